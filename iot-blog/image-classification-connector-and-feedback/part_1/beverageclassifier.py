@@ -10,6 +10,7 @@
 # To be used alongside part 1 of the accompanying blog post.
 #
 
+import io
 import json
 import os
 import time
@@ -27,6 +28,11 @@ import greengrass_machine_learning_sdk as ml
 # configured as a local resource in GG.
 LOCAL_RESOURCE_DIR = "/raw_field_data"
 
+# By default frames are captured into memory and only
+# written to LOCAL_RESOURCE_DIR when they are kept.
+# Set IN_MEMORY_CAPTURE=false to capture to a file first.
+IN_MEMORY_CAPTURE = os.environ.get('IN_MEMORY_CAPTURE', 'true').lower() != 'false'
+
 # Categories listed in the order defined in the
 # .lst used to train the model (alphabetical).
 CATEGORIES = ['beer-mug', 'clutter', 'coffee-mug', 'soda-can', 'wine-bottle']
@@ -40,14 +46,25 @@ ml_client = ml.client('inference')
 # in image distortion.
 camera = PiCamera(resolution=(400,400))
 
+# Reused for every capture so each frame doesn't
+# allocate a new buffer.
+image_buffer = io.BytesIO()
+
 def capture_and_save_image_as(filename):
     camera.capture(filename, format='jpeg')
 
-def get_inference(image_filename):
-    logging.info('Invoking Greengrass ML Inference Service')
-    
+def capture_image():
+    image_buffer.seek(0)
+    image_buffer.truncate()
+    camera.capture(image_buffer, format='jpeg')
+    return image_buffer.getvalue()
+
+def read_image(image_filename):
     with open(image_filename, 'rb') as image_file:
-        image = image_file.read()
+        return image_file.read()
+
+def get_inference(image):
+    logging.info('Invoking Greengrass ML Inference Service')
 
     try:
         response = ml_client.invoke_inference_service(
@@ -85,15 +102,22 @@ def create_image_filename():
     return filename
 
 def function_handler(event, context):
-    image_filename = create_image_filename()
-    capture_and_save_image_as(image_filename)
+    if IN_MEMORY_CAPTURE:
+        # Nothing is kept in part 1, so the frame never touches the SD card
+        image_filename = None
+        image = capture_image()
+    else:
+        image_filename = create_image_filename()
+        capture_and_save_image_as(image_filename)
+        image = read_image(image_filename)
 
-    predicted_category, prediction_confidence = get_inference(image_filename)
+    predicted_category, prediction_confidence = get_inference(image)
 
     gg_client.publish(
         topic='/response/prediction/beverage_container',
         payload=json.dumps({'message':'Classified image as {} with a confidence of {}'.format(predicted_category, str(prediction_confidence))})
     )
-    
-    os.remove(image_filename)
+
+    if image_filename is not None:
+        os.remove(image_filename)
     return
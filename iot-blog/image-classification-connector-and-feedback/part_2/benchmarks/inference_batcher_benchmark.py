@@ -0,0 +1,150 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# inference_batcher_benchmark.py
+# Throughput against added latency of inference_batcher.py, using a simulated
+# image-classification connector: every request pays a fixed overhead
+# (--overhead-ms, IPC and JPEG decode, overlaps between concurrent requests)
+# plus the model's compute time (--compute-ms per image, one image at a time
+# as on a single-core model server). Needs nothing but the standard library.
+#
+# --callers threads (cameras, or pipeline inference workers) each classify
+# one frame after another for --duration seconds. Compared are:
+#
+#   serial   one caller at a time straight to the connector (the original)
+#   direct   all callers straight to the connector, no batching
+#   burst    the batcher sending each batch as concurrent single-image calls
+#   batch    the batcher sending each batch as one multi-image request
+#
+# Usage:
+#   python benchmarks/inference_batcher_benchmark.py
+#   python benchmarks/inference_batcher_benchmark.py --callers 8 --json results.json
+#
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from inference_batcher import InferenceBatcher
+
+PREDICTIONS = b"[0.05, 0.1, 0.7, 0.1, 0.05]"
+
+
+class SimulatedConnector(object):
+
+    def __init__(self, overhead, compute):
+        self.overhead = overhead
+        self.compute = compute
+        self._model = threading.Lock()
+
+    def infer(self, image):
+        time.sleep(self.overhead)
+        with self._model:
+            time.sleep(self.compute)
+        return PREDICTIONS
+
+    def infer_batch(self, images):
+        time.sleep(self.overhead)
+        with self._model:
+            time.sleep(self.compute * len(images))
+        return [PREDICTIONS] * len(images)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run(classify, callers, duration):
+    latencies = []
+    lock = threading.Lock()
+    stop_at = time.time() + duration
+
+    def caller():
+        while time.time() < stop_at:
+            start = time.time()
+            classify(b"frame")
+            with lock:
+                latencies.append(time.time() - start)
+
+    threads = [threading.Thread(target=caller) for i in range(callers)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    return {
+        'frames': len(latencies),
+        'throughput_per_second': len(latencies) / elapsed,
+        'avg_latency_ms': 1000 * sum(latencies) / len(latencies),
+        'p95_latency_ms': 1000 * percentile(latencies, 0.95),
+    }
+
+
+def run_batcher(connector, mode, max_batch, max_delay, max_in_flight, callers, duration):
+    batch_infer = connector.infer_batch if mode == 'batch' else None
+    batcher = InferenceBatcher(connector.infer, max_batch, max_delay, batch_infer, max_in_flight)
+    batcher.start()
+    try:
+        result = run(batcher.infer, callers, duration)
+    finally:
+        batcher.stop()
+    stats = batcher.stats()
+    result['avg_batch_size'] = stats['avg_batch_size']
+    result['avg_wait_ms'] = 1000 * stats['avg_wait']
+    return result
+
+
+def benchmark(args):
+    connector = SimulatedConnector(args.overhead_ms / 1000.0, args.compute_ms / 1000.0)
+    cases = [('serial', 1, 0, run(connector.infer, 1, args.duration)),
+             ('direct', 1, 0, run(connector.infer, args.callers, args.duration))]
+    for mode in ('burst', 'batch'):
+        for max_batch in args.batch_sizes:
+            for delay_ms in args.delays_ms:
+                cases.append((mode, max_batch, delay_ms,
+                              run_batcher(connector, mode, max_batch, delay_ms / 1000.0, args.in_flight,
+                                          args.callers, args.duration)))
+    results = []
+    for mode, max_batch, delay_ms, result in cases:
+        result.update({'mode': mode, 'max_batch': max_batch, 'max_delay_ms': delay_ms})
+        results.append(result)
+    return results
+
+
+def report(results):
+    print("{:<8} {:>6} {:>9} {:>11} {:>10} {:>9} {:>9} {:>9}".format(
+        "mode", "batch", "delay ms", "frames/s", "avg batch", "wait ms", "avg ms", "p95 ms"))
+    for result in results:
+        print("{:<8} {:>6} {:>9} {:>11.1f} {:>10.2f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+            result['mode'], result['max_batch'], result['max_delay_ms'], result['throughput_per_second'],
+            result.get('avg_batch_size', 1.0), result.get('avg_wait_ms', 0.0),
+            result['avg_latency_ms'], result['p95_latency_ms']))
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--callers", type=int, default=4, help="Threads classifying frames concurrently")
+parser.add_argument("--duration", type=float, default=2.0, help="Seconds per case")
+parser.add_argument("--overhead-ms", type=float, default=20.0, help="Per-request connector overhead")
+parser.add_argument("--compute-ms", type=float, default=10.0, help="Model time per image")
+parser.add_argument("--batch-sizes", type=int, nargs='+', default=[1, 2, 4, 8])
+parser.add_argument("--delays-ms", type=float, nargs='+', default=[5.0, 50.0])
+parser.add_argument("--in-flight", type=int, default=2, help="Batches outstanding at a time")
+parser.add_argument("--json", help="Write the results to this file")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    results = benchmark(args)
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
@@ -12,28 +12,49 @@
 # To be used alongside part 2 of the accompanying blog post.
 #
 
+import io
 import json
 import os
+import threading
 import time
 
-import boto3
 import logging
-import numpy as np
 from picamera import PiCamera
 
 import greengrasssdk
 import greengrass_machine_learning_sdk as ml
 
+from capture_controller import CaptureController, default_levels
+from inference_batcher import InferenceBatcher
+from phash_index import PerceptualHashIndex
+from pipeline import Pipeline, Stage
+from prediction_decoding import decode_prediction
+from s3_uploader import SpooledS3Uploader, create_s3_client
+from scene_gate import LUMA_SIZE, SceneGate, luma_from_yuv
+from upload_budget import UploadBudget
+
 # This directory will be used to store our
 # unlabeled training data. It should be
 # configured as a local resource in GG.
 LOCAL_RESOURCE_DIR = "/raw_field_data"
 
+# By default frames are captured into memory and only
+# written to LOCAL_RESOURCE_DIR when they are kept.
+# Set IN_MEMORY_CAPTURE=false to capture to a file first.
+IN_MEMORY_CAPTURE = os.environ.get('IN_MEMORY_CAPTURE', 'true').lower() != 'false'
+
 # Fill this in with the name of the bucket
 # you want to store the inference results in.
 # This bucket should already exist.
 S3_BUCKET_NAME = "[Fill Me In]"
 
+# Images selected for upload are spooled here and uploaded
+# in the background, so they survive an uplink outage or a
+# restart. Like LOCAL_RESOURCE_DIR it must be writable.
+UPLOAD_SPOOL_DIR = os.environ.get('UPLOAD_SPOOL_DIR', LOCAL_RESOURCE_DIR + "/upload_spool")
+UPLOAD_SPOOL_MAX_BYTES = int(os.environ.get('UPLOAD_SPOOL_MAX_BYTES', str(256 * 1024 * 1024)))
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', '2'))
+
 # Categories listed in the order defined in the
 # .lst used to train the model (alphabetical).
 CATEGORIES = ['beer-mug', 'clutter', 'coffee-mug', 'soda-can', 'wine-bottle']
@@ -45,6 +66,44 @@ CATEGORIES = ['beer-mug', 'clutter', 'coffee-mug', 'soda-can', 'wine-bottle']
 INFERENCE_CONFIDENCE_THRESHOLD_UPPER = .9
 INFERENCE_CONFIDENCE_THRESHOLD_LOWER = .6
 
+# With SELECTION_POLICY=budget (the default) the thresholds above
+# aren't used. Instead the UPLOAD_BUDGET_PER_HOUR most informative
+# frames of every hour are uploaded when the hour is over, scored by
+# SELECTION_SCORE: "margin" prefers frames whose two best categories
+# are closest, "entropy" frames whose predictions are spread out the
+# most. SELECTION_POLICY=threshold uploads by confidence band.
+SELECTION_POLICY = os.environ.get('SELECTION_POLICY', 'budget')
+SELECTION_SCORE = os.environ.get('SELECTION_SCORE', 'margin')
+UPLOAD_BUDGET_PER_HOUR = int(os.environ.get('UPLOAD_BUDGET_PER_HOUR', '60'))
+
+# Capture resolution, a centered crop (CAPTURE_ROI as x,y,w,h
+# fractions of the field of view) and JPEG quality are lowered
+# step by step while capture plus inference takes longer than
+# CAPTURE_TARGET_MS (or 1/CAPTURE_TARGET_FPS if that is set),
+# and raised again once there is room. Set CAPTURE_CONTROL=false
+# to always capture 400x400 at full view.
+CAPTURE_CONTROL = os.environ.get('CAPTURE_CONTROL', 'true').lower() != 'false'
+CAPTURE_TARGET_MS = float(os.environ.get('CAPTURE_TARGET_MS', '1000'))
+CAPTURE_TARGET_FPS = float(os.environ.get('CAPTURE_TARGET_FPS', '0'))
+CAPTURE_ROI = tuple(float(value) for value in os.environ.get('CAPTURE_ROI', '0.1,0.1,0.8,0.8').split(','))
+
+# Before every capture a tiny greyscale frame is compared with
+# the frames of the last few predictions. If the scene hasn't
+# changed, the earlier prediction is published again instead of
+# capturing and classifying a full frame. SCENE_MAX_AGE bounds
+# (in seconds) how long a prediction is reused.
+# Set SCENE_GATE=false to classify every frame.
+SCENE_GATE = os.environ.get('SCENE_GATE', 'true').lower() != 'false'
+SCENE_MAX_AGE = float(os.environ.get('SCENE_MAX_AGE', '60'))
+
+# Images selected for upload are compared with the last
+# UPLOAD_DEDUP_SIZE uploaded ones by perceptual hash, and near-
+# duplicates (at most UPLOAD_DEDUP_DISTANCE of 64 bits differ)
+# are not uploaded. Set UPLOAD_DEDUP=false to upload them all.
+UPLOAD_DEDUP = os.environ.get('UPLOAD_DEDUP', 'true').lower() != 'false'
+UPLOAD_DEDUP_SIZE = int(os.environ.get('UPLOAD_DEDUP_SIZE', '1024'))
+UPLOAD_DEDUP_DISTANCE = int(os.environ.get('UPLOAD_DEDUP_DISTANCE', '6'))
+
 gg_client = greengrasssdk.client('iot-data')
 ml_client = ml.client('inference')
 
@@ -54,17 +113,59 @@ ml_client = ml.client('inference')
 # in image distortion.
 camera = PiCamera(resolution=(400,400))
 
-# Set up S3
-s3 = boto3.client('s3')
+capture_controller = CaptureController(1.0 / CAPTURE_TARGET_FPS if CAPTURE_TARGET_FPS else CAPTURE_TARGET_MS / 1000.0,
+                                       default_levels(CAPTURE_ROI))
+# The settings the camera is configured with
+capture_settings = capture_controller.levels[0]
+
+# Reused for every capture so each frame doesn't
+# allocate a new buffer.
+image_buffer = io.BytesIO()
+luma_buffer = io.BytesIO()
+
+scene_gate = SceneGate(max_age=SCENE_MAX_AGE)
+upload_index = PerceptualHashIndex(UPLOAD_DEDUP_SIZE, UPLOAD_DEDUP_DISTANCE)
+
+# Set up S3. One client (and connection pool) is shared by
+# all upload workers; S3_ENDPOINT_URL points it at a local
+# S3 stand-in for testing.
+s3 = create_s3_client(UPLOAD_WORKERS)
+uploader = SpooledS3Uploader(s3, S3_BUCKET_NAME, UPLOAD_SPOOL_DIR, UPLOAD_SPOOL_MAX_BYTES, UPLOAD_WORKERS)
+uploader.start()
+
+# Only called from the capture stage, so the camera is never
+# reconfigured during a capture
+def apply_capture_settings(settings):
+    global capture_settings
+    if settings == capture_settings:
+        return
+    camera.resolution = settings.resolution
+    camera.zoom = settings.zoom
+    capture_settings = settings
 
 def capture_and_save_image_as(filename):
-    camera.capture(filename, format='jpeg')
+    camera.capture(filename, format='jpeg', quality=capture_settings.quality)
 
-def get_inference(image_filename):
-    logging.info('Invoking Greengrass ML Inference Service')
-    
+def capture_image():
+    image_buffer.seek(0)
+    image_buffer.truncate()
+    camera.capture(image_buffer, format='jpeg', quality=capture_settings.quality)
+    return image_buffer.getvalue()
+
+# Grabs a LUMA_SIZE greyscale frame from the video port,
+# which is much faster than a full still capture
+def capture_luma():
+    luma_buffer.seek(0)
+    luma_buffer.truncate()
+    camera.capture(luma_buffer, format='yuv', resize=LUMA_SIZE, use_video_port=True)
+    return luma_from_yuv(luma_buffer.getvalue(), *LUMA_SIZE)
+
+def read_image(image_filename):
     with open(image_filename, 'rb') as image_file:
-        image = image_file.read()
+        return image_file.read()
+
+def invoke_inference_service(image):
+    logging.info('Invoking Greengrass ML Inference Service')
 
     try:
         response = ml_client.invoke_inference_service(
@@ -80,28 +181,45 @@ def get_inference(image_filename):
         logging.info('Dependency exception {}("{}")'.format(e.__class__.__name__, e))
         raise
 
-    inference = response['Body'].read()
-    inference = inference[1:-1]
-    predictions = np.fromstring(inference, dtype=np.float, sep=',')
+    return response['Body'].read()
 
-    logging.info("Received the following predictions from beverage-classifier model:" + str(predictions))
+# INFERENCE_WORKERS frames are classified at the same time. With
+# INFERENCE_BATCH_SIZE above 1, frames from all inference workers go
+# through one batcher: it collects up to that many, or waits at most
+# INFERENCE_BATCH_DELAY_MS for more, and sends them to the connector
+# as one concurrent burst. A batch can't be larger than the number of
+# workers feeding it. The connector takes a single image per request,
+# so this does not beat calling it directly from the same number of
+# workers (see benchmarks/inference_batcher_benchmark.py); it only
+# bounds how many calls run at once. The default of 1 calls the
+# connector directly, without the batcher.
+INFERENCE_WORKERS = int(os.environ.get('INFERENCE_WORKERS', '1'))
+INFERENCE_BATCH_SIZE = int(os.environ.get('INFERENCE_BATCH_SIZE', '1'))
+INFERENCE_BATCH_DELAY_MS = float(os.environ.get('INFERENCE_BATCH_DELAY_MS', '20'))
 
-    # Get the prediction that has the highest confidence
-    prediction_confidence = predictions.max()
+inference_batcher = None
+if INFERENCE_BATCH_SIZE > 1:
+    inference_batcher = InferenceBatcher(invoke_inference_service, INFERENCE_BATCH_SIZE, INFERENCE_BATCH_DELAY_MS / 1000.0)
+    inference_batcher.start()
 
-    # The indicies of the inference result will match our CATEGORIES
-    # array. Find the index of the highest prediction confidence,
-    # and index into the CATEGORIES array to find the category name.
-    predicted_category = CATEGORIES[predictions.argmax()]
+# Returns a prediction_decoding.Prediction. The indices of the
+# inference result match our CATEGORIES array.
+def get_inference(image):
+    if inference_batcher is not None:
+        inference = inference_batcher.infer(image)
+    else:
+        inference = invoke_inference_service(image)
+    prediction = decode_prediction(inference, CATEGORIES)
 
-    return predicted_category, prediction_confidence
+    logging.info("Received the following predictions from beverage-classifier model:" + str(prediction.scores))
 
+    return prediction
+
+# Moves local_filename into the upload spool; it is uploaded
+# (and retried until it is) by the background uploader.
 def upload_to_s3(local_filename, s3_file_name):
-    try:
-        s3.upload_file(local_filename, S3_BUCKET_NAME, s3_file_name)
-        logging.info("Successfully uploaded file {} to S3 bucket {}/{}.".format(local_filename, S3_BUCKET_NAME, s3_file_name))
-    except Exception as e:
-        print("Error: could not upload file:" + local_filename + " to s3:" + str(e))
+    uploader.enqueue_file(local_filename, s3_file_name)
+    logging.info("Queued file {} for upload to S3 bucket {}/{}.".format(local_filename, S3_BUCKET_NAME, s3_file_name))
 
 def create_image_filename():
     current_time_millis = int(time.time() * 1000)
@@ -116,30 +234,201 @@ def create_s3_filename(image_filename, predicted_category, prediction_confidence
         s3_file_name = "{}_{}_{}{}".format(filename_no_ext, predicted_category, str(round(prediction_confidence, 4)), os.path.splitext(image_filename)[1])
         return s3_file_name
 
-def function_handler(event, context):
+# Time frames spent queued rather than being worked on: from the request in
+# function_handler until the capture stage took it, and from the end of the
+# capture until the inference stage took the frame
+frame_waits = {'frames': 0, 'capture_wait_seconds': 0.0, 'inference_wait_seconds': 0.0}
+frame_waits_lock = threading.Lock()
+
+def record_frame_waits(capture_wait, inference_wait):
+    with frame_waits_lock:
+        frame_waits['frames'] += 1
+        frame_waits['capture_wait_seconds'] += capture_wait
+        frame_waits['inference_wait_seconds'] += inference_wait
+
+def frame_wait_stats():
+    with frame_waits_lock:
+        frames = frame_waits['frames']
+        return {
+            'frames': frames,
+            'avg_capture_wait': frame_waits['capture_wait_seconds'] / frames if frames else 0.0,
+            'avg_inference_wait': frame_waits['inference_wait_seconds'] / frames if frames else 0.0,
+        }
+
+# Pipeline stage 1: capture a frame. requested_at is when
+# function_handler asked for it.
+def capture_frame(requested_at):
+    capture_wait = time.time() - requested_at
+    luma = None
+    if SCENE_GATE or UPLOAD_DEDUP:
+        luma = capture_luma()
+    if SCENE_GATE:
+        prediction = scene_gate.lookup(luma)
+        if prediction is not None:
+            # Nothing changed since this prediction was made
+            return {'luma': luma, 'cached_prediction': prediction,
+                    'capture_wait': capture_wait, 'captured_at': time.time()}
+    if CAPTURE_CONTROL:
+        apply_capture_settings(capture_controller.current())
+    capture_started = time.time()
     image_filename = create_image_filename()
-    capture_and_save_image_as(image_filename)
+    if IN_MEMORY_CAPTURE:
+        # The frame stays in memory; it is only written to
+        # image_filename if it is selected for upload
+        image = capture_image()
+        image_saved = False
+    else:
+        capture_and_save_image_as(image_filename)
+        image = read_image(image_filename)
+        image_saved = True
+    captured_at = time.time()
+    return {'image_filename': image_filename, 'image': image, 'image_saved': image_saved, 'luma': luma,
+            'settings': capture_settings, 'capture_seconds': captured_at - capture_started,
+            'capture_wait': capture_wait, 'captured_at': captured_at}
 
-    predicted_category, prediction_confidence = get_inference(image_filename)
+# Pipeline stage 2: classify the frame and publish the result.
+# Returns the frame if it should be uploaded, None otherwise.
+def classify_frame(frame):
+    record_frame_waits(frame['capture_wait'], time.time() - frame['captured_at'])
+    prediction = cached_prediction = frame.get('cached_prediction')
+    if cached_prediction is None:
+        inference_started = time.time()
+        prediction = get_inference(frame['image'])
+        if CAPTURE_CONTROL:
+            # Only the work on this frame counts; time spent queued
+            # between the stages doesn't depend on the capture settings
+            latency = frame['capture_seconds'] + time.time() - inference_started
+            capture_controller.observe(frame['settings'], latency, prediction.confidence)
+        if SCENE_GATE:
+            scene_gate.remember(frame['luma'], prediction)
+    predicted_category, prediction_confidence = prediction.category, prediction.confidence
 
     gg_client.publish(
         topic='/response/prediction/beverage_container',
         payload=json.dumps({'message':'Classified image as {} with a confidence of {}'.format(predicted_category, str(prediction_confidence))})
     )
 
-    if prediction_confidence < INFERENCE_CONFIDENCE_THRESHOLD_LOWER or \
-       prediction_confidence > INFERENCE_CONFIDENCE_THRESHOLD_UPPER:
+    # A reused prediction was already considered for upload
+    # when its scene was classified
+    if cached_prediction is not None:
+        return None
+
+    if SELECTION_POLICY == 'budget':
+        # The budget owns the frame from here on: it is uploaded at the
+        # end of the hour if it is still among the most informative ones
+        # (and not a near-duplicate of an upload by then)
+        frame['s3_file_name'] = "image-classification" + create_s3_filename(frame['image_filename'], predicted_category, prediction_confidence)
+        frame['selection_score'] = selection_score(prediction)
+        upload_budget.offer(frame['selection_score'], frame)
+        return None
+
+    if is_upload_candidate(prediction) and not is_duplicate_upload(frame):
         # We will store our raw data in a folder under our
         # configured S3 bucket called /image-classification
-        s3_file_name = "image-classification" + create_s3_filename(image_filename, predicted_category, prediction_confidence)
+        s3_file_name = "image-classification" + create_s3_filename(frame['image_filename'], predicted_category, prediction_confidence)
 
         gg_client.publish(
             topic='/response/prediction/beverage_container',
             payload=json.dumps({'message':'Prediction fell above upper threshold ({}) or below lower threshold ({}). Uploading to S3 ({}/{}) for manual labeling.'\
                 .format(str(INFERENCE_CONFIDENCE_THRESHOLD_UPPER), str(INFERENCE_CONFIDENCE_THRESHOLD_LOWER), S3_BUCKET_NAME, s3_file_name)})
         )
+        frame['s3_file_name'] = s3_file_name
+        return frame
+
+    discard_frame(frame)
+    return None
+
+def is_upload_candidate(prediction):
+    return prediction.confidence < INFERENCE_CONFIDENCE_THRESHOLD_LOWER or \
+           prediction.confidence > INFERENCE_CONFIDENCE_THRESHOLD_UPPER
+
+# Higher is more informative
+def selection_score(prediction):
+    if SELECTION_SCORE == 'entropy':
+        return prediction.entropy
+    return prediction.uncertainty()
+
+def discard_frame(frame):
+    if frame['image_saved']:
+        os.remove(frame['image_filename'])
+
+# Called by upload_budget for every selected frame once its hour is over.
+# Only frames that are really uploaded go into the dedup index.
+def upload_selected_frame(frame):
+    if is_duplicate_upload(frame):
+        discard_frame(frame)
+        return
+    gg_client.publish(
+        topic='/response/prediction/beverage_container',
+        payload=json.dumps({'message':'Image is among the {} most informative this hour ({} score {}). Uploading to S3 ({}/{}) for manual labeling.'\
+            .format(str(UPLOAD_BUDGET_PER_HOUR), SELECTION_SCORE, str(round(frame['selection_score'], 4)), S3_BUCKET_NAME, frame['s3_file_name'])})
+    )
+    upload_frame(frame)
+
+upload_budget = UploadBudget(upload_selected_frame, UPLOAD_BUDGET_PER_HOUR, discard_frame)
+
+# True if a near-identical image was uploaded recently
+def is_duplicate_upload(frame):
+    if not UPLOAD_DEDUP:
+        return False
+    if upload_index.check(frame['luma'], len(frame['image'])):
+        logging.info("Not uploading {}, a near-duplicate was uploaded recently".format(frame['image_filename']))
+        return True
+    return False
+
+# Pipeline stage 3: hand a selected frame to the uploader
+def upload_frame(frame):
+    if frame['image_saved']:
+        upload_to_s3(frame['image_filename'], frame['s3_file_name'])
+    else:
+        uploader.enqueue_image(frame['image'], frame['s3_file_name'])
+    return None
+
+# Capture, inference and upload run as separate stages with bounded queues,
+# so the camera captures the next frame while the model classifies the
+# current one and the previous one is uploaded. A full queue blocks the
+# stage feeding it, so the slowest stage sets the pace without frames piling
+# up in memory. This needs a long-lived (pinned) lambda, since the stages
+# keep working after function_handler returns. Set PIPELINED=false to handle
+# each frame start to finish inside function_handler instead.
+PIPELINED = os.environ.get('PIPELINED', 'true').lower() != 'false'
+STATS_INTERVAL = int(os.environ.get('PIPELINE_STATS_INTERVAL', '60'))
+
+frame_pipeline = Pipeline([
+    Stage('capture', capture_frame, queue_size=1),
+    Stage('inference', classify_frame, queue_size=2 * INFERENCE_WORKERS, workers=INFERENCE_WORKERS),
+    Stage('upload', upload_frame, queue_size=4),
+])
+if PIPELINED:
+    frame_pipeline.start()
+last_stats = time.time()
+
+def log_pipeline_stats():
+    global last_stats
+    if not STATS_INTERVAL or time.time() - last_stats < STATS_INTERVAL:
+        return
+    last_stats = time.time()
+    logging.info("Pipeline stats (bottleneck: {}): {}".format(frame_pipeline.bottleneck(), json.dumps(frame_pipeline.stats())))
+    logging.info("Frame queue waits: {}".format(json.dumps(frame_wait_stats())))
+    logging.info("Scene gate stats: {}".format(json.dumps(scene_gate.stats())))
+    logging.info("Upload dedup stats: {}".format(json.dumps(upload_index.stats())))
+    if inference_batcher is not None:
+        logging.info("Inference batch stats: {}".format(json.dumps(inference_batcher.stats())))
+    logging.info("Upload budget stats: {}".format(json.dumps(upload_budget.stats())))
+    logging.info("Upload stats: {}".format(json.dumps(uploader.stats())))
+    logging.info("Capture control stats: {}".format(json.dumps(capture_controller.stats())))
+
+def function_handler(event, context):
+    # Uploads the last hour's selection once the hour is over
+    upload_budget.poll()
+
+    if PIPELINED:
+        # Blocks while the capture stage is still busy with earlier requests
+        frame_pipeline.submit(time.time())
+        log_pipeline_stats()
+        return
 
-        upload_to_s3(image_filename, s3_file_name)
-    
-    os.remove(image_filename)
+    frame = classify_frame(capture_frame(time.time()))
+    if frame is not None:
+        upload_frame(frame)
     return
@@ -0,0 +1,134 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# capture_controller.py
+# Adapts capture settings in beverageclassifier.py to an end-to-end latency
+# target.
+#
+# The controller steps through a ladder of capture settings, from the best
+# quality (the original 400x400, full field of view, default JPEG quality)
+# down to cheaper ones: lower resolution, a region-of-interest crop that
+# keeps the object large in the smaller frame, and lower JPEG quality. For
+# every classified frame it is told how long capture plus inference took,
+# not counting the time the frame waited in a queue between the two.
+# Once a window of frames averages above the target (by more than
+# `tolerance`) it steps one level down; once a window averages well below
+# the target (`headroom`) it steps back up. Each change needs a full window
+# under the new settings first, so it can't oscillate frame by frame.
+#
+# Whether cheaper settings hurt the model shows in its confidence, so every
+# change is logged together with the confidence distribution under the old
+# settings and how it differs from the settings before them.
+#
+
+import collections
+import logging
+import threading
+
+import numpy as np
+
+CaptureSettings = collections.namedtuple('CaptureSettings', ['resolution', 'zoom', 'quality'])
+
+FULL_VIEW = (0.0, 0.0, 1.0, 1.0)
+CENTER_ROI = (0.1, 0.1, 0.8, 0.8)
+CONFIDENCE_HISTORY = 1000     # frames per settings the distribution is taken over
+
+
+# Best quality first. The model's input is 224x224, so there is no point
+# going below that.
+def default_levels(roi=CENTER_ROI):
+    return [
+        CaptureSettings((400, 400), FULL_VIEW, 85),
+        CaptureSettings((320, 320), FULL_VIEW, 80),
+        CaptureSettings((320, 320), roi, 75),
+        CaptureSettings((256, 256), roi, 70),
+        CaptureSettings((224, 224), roi, 65),
+    ]
+
+
+def describe(settings):
+    return "{}x{} zoom={} quality={}".format(settings.resolution[0], settings.resolution[1],
+                                             settings.zoom, settings.quality)
+
+
+def confidence_summary(confidences):
+    if not confidences:
+        return {'frames': 0}
+    values = np.asarray(confidences, dtype=np.float64)
+    p10, p50 = np.percentile(values, [10, 50])
+    return {'frames': len(values), 'mean': float(values.mean()), 'p10': float(p10), 'p50': float(p50)}
+
+
+class CaptureController(object):
+
+    def __init__(self, target_latency, levels=None, window=20, tolerance=1.1, headroom=0.7):
+        self.target_latency = target_latency
+        self.levels = levels or default_levels()
+        self.window = window
+        self.tolerance = tolerance
+        self.headroom = headroom
+        self._lock = threading.Lock()
+        self._level = 0
+        self._latencies = []
+        self._confidences = collections.deque(maxlen=CONFIDENCE_HISTORY)   # under the current settings
+        self._previous_summary = None   # confidence under the settings before
+
+        # counters exposed through stats()
+        self.observed = 0
+        self.step_downs = 0
+        self.step_ups = 0
+
+    def current(self):
+        with self._lock:
+            return self.levels[self._level]
+
+    # Records one classified frame captured with settings. latency is the
+    # time spent capturing and classifying it, without queue waits.
+    def observe(self, settings, latency, confidence):
+        with self._lock:
+            if settings != self.levels[self._level]:
+                return      # captured before the last change
+            self.observed += 1
+            self._latencies.append(latency)
+            self._confidences.append(confidence)
+            if len(self._latencies) < self.window:
+                return
+            average = sum(self._latencies[-self.window:]) / self.window
+            if average > self.target_latency * self.tolerance and self._level < len(self.levels) - 1:
+                self.step_downs += 1
+                self._change_locked(self._level + 1, average)
+            elif average < self.target_latency * self.headroom and self._level > 0:
+                self.step_ups += 1
+                self._change_locked(self._level - 1, average)
+            else:
+                del self._latencies[:-self.window]
+
+    def stats(self):
+        with self._lock:
+            recent = self._latencies[-self.window:]
+            return {
+                'level': self._level,
+                'settings': describe(self.levels[self._level]),
+                'avg_latency': sum(recent) / len(recent) if recent else 0.0,
+                'target_latency': self.target_latency,
+                'observed': self.observed,
+                'step_downs': self.step_downs,
+                'step_ups': self.step_ups,
+                'confidence': confidence_summary(self._confidences),
+            }
+
+    def _change_locked(self, level, average):
+        old, new = self.levels[self._level], self.levels[level]
+        summary = confidence_summary(self._confidences)
+        message = "Capture settings {} -> {}: average latency {:.0f} ms, target {:.0f} ms. " \
+                  "Confidence under the old settings: {} frames, mean {:.3f}, p10 {:.3f}, p50 {:.3f}".format(
+                      describe(old), describe(new), 1000 * average, 1000 * self.target_latency,
+                      summary['frames'], summary['mean'], summary['p10'], summary['p50'])
+        if self._previous_summary is not None:
+            message += " ({:+.3f} mean, {:+.3f} p10 against the settings before)".format(
+                summary['mean'] - self._previous_summary['mean'], summary['p10'] - self._previous_summary['p10'])
+        logging.info(message)
+        self._level = level
+        self._latencies = []
+        self._confidences.clear()
+        self._previous_summary = summary
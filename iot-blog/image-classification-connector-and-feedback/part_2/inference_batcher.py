@@ -0,0 +1,248 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# inference_batcher.py
+# A micro-batching front-end for the inference client used by
+# beverageclassifier.py.
+#
+# Callers (one per camera, or several pipeline workers) hand their image to
+# submit() and get a future back. Requests are collected until max_batch of
+# them are waiting or the oldest has waited max_delay seconds, whichever
+# comes first, and are then sent together:
+#
+#   - with batch_infer(images) if the backend accepts several images in one
+#     request, paying the per-request overhead once per batch
+#   - otherwise as one concurrent burst of infer(image) calls, so the
+#     per-request round trips of the batch overlap instead of queuing up
+#     behind each other
+#
+# Each result (or exception) is set on the future of the request it belongs
+# to. Up to max_in_flight batches are outstanding at a time, so the overhead
+# of one overlaps the model working on another; while they are, the next
+# batch keeps collecting. Under load batches therefore fill up on their own
+# and max_delay only bounds the latency added when traffic is light.
+# max_batch=1 turns batching off: every request is sent as soon as it
+# arrives and a slot is free.
+#
+# benchmarks/inference_batcher_benchmark.py shows throughput against the
+# added latency for a few batch sizes and deadlines. Against a backend that
+# takes one image per request (like the image-classification connector) the
+# burst mode is no faster than the same callers calling it directly, and
+# slower at some settings: with its defaults (4 callers) direct calls reach
+# about 91-94 frames/s, bursts of 4 about 61-76. Batching only pays off with
+# batch_infer, so beverageclassifier.py bypasses the batcher unless
+# INFERENCE_BATCH_SIZE is set above 1.
+#
+
+import logging
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue   # Python 2
+
+_STOP = object()
+
+
+class InferenceFuture(object):
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+        self.submitted = time.time()
+        self.dispatched = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    # Blocks until the result is there and returns it, or raises the
+    # exception the inference raised
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError("Inference result not available after {} seconds".format(timeout))
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+class InferenceBatcher(object):
+
+    def __init__(self, infer, max_batch=4, max_delay=0.05, batch_infer=None, max_in_flight=2):
+        self.infer_one = infer
+        self.batch_infer = batch_infer
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max_delay
+        self.max_in_flight = max(1, max_in_flight)
+        self._cond = threading.Condition()
+        self._waiting = []      # (future, image)
+        self._running = False
+        self._threads = []
+        self._slots = threading.Semaphore(self.max_in_flight)
+        self._batches = queue.Queue()
+        self._images = queue.Queue()    # single images of a burst
+
+        # counters exposed through stats()
+        self.requests = 0
+        self.completed = 0
+        self.batches = 0
+        self.failed = 0
+        self.wait_seconds = 0.0     # time requests spent waiting for their batch
+        self.max_wait = 0.0
+        self.batch_seconds = 0.0    # time from dispatch until the whole batch was answered
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._spawn(self._collect, "inference-batcher")
+        for i in range(self.max_in_flight):
+            self._spawn(self._dispatch_batches, "inference-batch-{}".format(i))
+        if self.batch_infer is None:
+            for i in range(self.max_in_flight * (self.max_batch - 1)):
+                self._spawn(self._run_images, "inference-burst-{}".format(i))
+
+    # Requests still waiting are sent before the workers exit
+    def stop(self, timeout=None):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        collector, workers = self._threads[0], self._threads[1:]
+        collector.join(timeout)
+        for i in range(self.max_in_flight):
+            self._batches.put(_STOP)
+        for thread in workers[:self.max_in_flight]:
+            thread.join(timeout)
+        for thread in workers[self.max_in_flight:]:
+            self._images.put(_STOP)
+        for thread in workers[self.max_in_flight:]:
+            thread.join(timeout)
+        self._threads = []
+
+    def submit(self, image):
+        future = InferenceFuture()
+        with self._cond:
+            if not self._running:
+                raise RuntimeError("InferenceBatcher is not running")
+            self.requests += 1
+            self._waiting.append((future, image))
+            if len(self._waiting) == 1 or len(self._waiting) >= self.max_batch:
+                self._cond.notify()
+        return future
+
+    # Blocking convenience wrapper for a single image
+    def infer(self, image, timeout=None):
+        return self.submit(image).result(timeout)
+
+    def stats(self):
+        with self._cond:
+            completed = self.completed
+            return {
+                'requests': self.requests,
+                'batches': self.batches,
+                'failed': self.failed,
+                'waiting': len(self._waiting),
+                'avg_batch_size': float(completed) / self.batches if self.batches else 0.0,
+                'avg_wait': self.wait_seconds / completed if completed else 0.0,
+                'max_wait': self.max_wait,
+                'avg_batch_seconds': self.batch_seconds / self.batches if self.batches else 0.0,
+            }
+
+    def _spawn(self, target, name):
+        thread = threading.Thread(target=target, name=name)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def _collect(self):
+        while True:
+            # a batch is only closed once it can be sent right away, so
+            # requests keep joining it while all slots are busy
+            self._slots.acquire()
+            with self._cond:
+                while not self._waiting and self._running:
+                    self._cond.wait()
+                if not self._waiting:
+                    self._slots.release()
+                    return
+                # the batch closes when it is full or the oldest request's
+                # deadline has passed
+                deadline = self._waiting[0][0].submitted + self.max_delay
+                while self._running and len(self._waiting) < self.max_batch:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, self._waiting = self._waiting[:self.max_batch], self._waiting[self.max_batch:]
+            self._batches.put(batch)
+
+    def _dispatch_batches(self):
+        while True:
+            batch = self._batches.get()
+            if batch is _STOP:
+                return
+            try:
+                self._dispatch(batch)
+            finally:
+                self._slots.release()
+
+    def _dispatch(self, batch):
+        start = time.time()
+        waited = [start - future.submitted for future, image in batch]
+        for future, image in batch:
+            future.dispatched = start
+        if self.batch_infer is not None:
+            self._run_batch(batch)
+        else:
+            # all but the first go to the burst workers, the first is sent
+            # from this thread
+            for job in batch[1:]:
+                self._images.put(job)
+            self._run_one(*batch[0])
+            for future, image in batch[1:]:
+                future._done.wait()
+        failed = sum(1 for future, image in batch if future._exception is not None)
+        with self._cond:
+            self.batches += 1
+            self.completed += len(batch)
+            self.failed += failed
+            self.wait_seconds += sum(waited)
+            self.max_wait = max(self.max_wait, max(waited))
+            self.batch_seconds += time.time() - start
+
+    def _run_batch(self, batch):
+        try:
+            results = self.batch_infer([image for future, image in batch])
+            if len(results) != len(batch):
+                raise ValueError("Batch inference returned {} results for {} images".format(len(results), len(batch)))
+        except Exception as e:
+            logging.exception("Batch inference of {} images failed".format(len(batch)))
+            for future, image in batch:
+                future.set_exception(e)
+            return
+        for (future, image), result in zip(batch, results):
+            future.set_result(result)
+
+    def _run_one(self, future, image):
+        try:
+            future.set_result(self.infer_one(image))
+        except Exception as e:
+            future.set_exception(e)
+
+    def _run_images(self):
+        while True:
+            job = self._images.get()
+            if job is _STOP:
+                return
+            self._run_one(*job)
@@ -0,0 +1,142 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# phash_index.py
+# Near-duplicate suppression for images selected for upload by
+# beverageclassifier.py.
+#
+# Every candidate gets a 64-bit difference hash (dHash) of its low-resolution
+# luma frame (the one scene_gate.py already grabs): the frame is averaged
+# down to 9x8 and each bit says whether a pixel is brighter than its right
+# neighbour. Small changes in exposure, noise or JPEG artifacts flip only a
+# few bits, so two shots of the same mug are within a small Hamming distance
+# of each other while a different scene is not.
+#
+# The index keeps at most `capacity` hashes and evicts the least recently
+# matched one first. A lookup XORs the query against all stored hashes at
+# once and counts bits with NumPy. A candidate within max_distance of a
+# stored hash is a duplicate and not uploaded; the bytes it would have cost
+# are added up per hour.
+#
+
+import collections
+import logging
+import threading
+import time
+
+import numpy as np
+
+HASH_SIZE = 8           # 8x8 = 64 bits
+MAX_DISTANCE = 6        # bits
+CAPACITY = 1024
+HOURS_KEPT = 24
+
+
+def _block_means(frame, rows, columns):
+    height, width = frame.shape
+    row_edges = np.linspace(0, height, rows + 1).astype(int)
+    column_edges = np.linspace(0, width, columns + 1).astype(int)
+    sums = np.add.reduceat(np.add.reduceat(frame, row_edges[:-1], axis=0), column_edges[:-1], axis=1)
+    return sums / np.outer(np.diff(row_edges), np.diff(column_edges))
+
+
+# 64-bit difference hash of a greyscale frame, as an int
+def dhash(luma):
+    frame = np.asarray(luma, dtype=np.float64)
+    small = _block_means(frame, HASH_SIZE, HASH_SIZE + 1)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class PerceptualHashIndex(object):
+
+    def __init__(self, capacity=CAPACITY, max_distance=MAX_DISTANCE):
+        self.capacity = capacity
+        self.max_distance = max_distance
+        self._lock = threading.Lock()
+        self._hashes = np.zeros(capacity, dtype=np.uint64)
+        self._used = np.zeros(capacity, dtype=bool)
+        self._slots = collections.OrderedDict()     # slot -> hash, least recently matched first
+        self._hours = collections.OrderedDict()     # hour start -> [checked, duplicates, bytes saved]
+
+        # counters exposed through stats()
+        self.checked = 0
+        self.duplicates = 0
+        self.bytes_saved = 0
+        self.evicted = 0
+
+    # Returns True if luma is a near-duplicate of an image already in the
+    # index (and counts size as saved), otherwise adds it and returns False
+    def check(self, luma, size=0, now=None):
+        now = time.time() if now is None else now
+        value = dhash(luma)
+        with self._lock:
+            hour = self._hour_locked(now)
+            self.checked += 1
+            hour[0] += 1
+            slot = self._nearest_locked(value)
+            if slot is not None:
+                self._slots[slot] = self._slots.pop(slot)
+                self.duplicates += 1
+                self.bytes_saved += size
+                hour[1] += 1
+                hour[2] += size
+                return True
+            self._add_locked(value)
+            return False
+
+    # [(hour start, checked, duplicates, bytes saved)], oldest first
+    def savings_per_hour(self):
+        with self._lock:
+            return [(start, checked, duplicates, saved)
+                    for start, (checked, duplicates, saved) in self._hours.items()]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'checked': self.checked,
+                'duplicates': self.duplicates,
+                'bytes_saved': self.bytes_saved,
+                'evicted': self.evicted,
+                'size': len(self._slots),
+            }
+
+    def _nearest_locked(self, value):
+        if not self._slots:
+            return None
+        xor = (self._hashes ^ np.uint64(value)).view(np.uint8).reshape(-1, 8)
+        distances = np.unpackbits(xor, axis=1).sum(axis=1)
+        distances[~self._used] = 65     # further than any two hashes can be
+        slot = int(distances.argmin())
+        return slot if distances[slot] <= self.max_distance else None
+
+    def _add_locked(self, value):
+        if len(self._slots) >= self.capacity:
+            slot = self._slots.popitem(last=False)[0]
+            self.evicted += 1
+        else:
+            slot = int(np.flatnonzero(~self._used)[0])
+        self._hashes[slot] = value
+        self._used[slot] = True
+        self._slots[slot] = value
+
+    # The bucket for the hour now falls into; the summary of the hour that
+    # just ended is logged when a new one starts
+    def _hour_locked(self, now):
+        start = int(now // 3600 * 3600)
+        hour = self._hours.get(start)
+        if hour is None:
+            if self._hours:
+                last_start = next(reversed(self._hours))
+                checked, duplicates, saved = self._hours[last_start]
+                logging.info("Upload dedup for hour starting {}: {} of {} images were near-duplicates, "
+                             "{} bytes saved".format(time.strftime('%Y-%m-%d %H:%M', time.gmtime(last_start)),
+                                                      duplicates, checked, saved))
+            hour = self._hours[start] = [0, 0, 0]
+            while len(self._hours) > HOURS_KEPT:
+                self._hours.popitem(last=False)
+        return hour
@@ -0,0 +1,143 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# pipeline.py
+# A small staged pipeline used by beverageclassifier.py so that capturing,
+# inference and uploading of consecutive frames overlap: while frame N is
+# being classified, frame N+1 can be captured and frame N-1 uploaded.
+#
+# Each stage has its own worker thread(s) and a bounded input queue. A stage
+# that produces faster than the next one consumes blocks on the full queue
+# (backpressure), so memory stays bounded and sustained throughput is set by
+# the slowest stage instead of the sum of all of them. Every stage counts
+# items, busy time, latency and the time it spent blocked downstream.
+#
+
+import logging
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue   # Python 2
+
+_STOP = object()
+
+
+class StageStats(object):
+    __slots__ = ('processed', 'dropped', 'failed', 'busy_seconds', 'max_latency', 'blocked_seconds', 'started')
+
+    def __init__(self):
+        self.processed = 0
+        self.dropped = 0            # items the stage chose not to pass on
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self.max_latency = 0.0
+        self.blocked_seconds = 0.0  # waiting for room in the next stage's queue
+        self.started = time.time()
+
+    def as_dict(self, queue_depth):
+        elapsed = max(time.time() - self.started, 1e-9)
+        return {
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'queue_depth': queue_depth,
+            'throughput_per_second': self.processed / elapsed,
+            'avg_latency': self.busy_seconds / self.processed if self.processed else 0.0,
+            'max_latency': self.max_latency,
+            'utilization': self.busy_seconds / elapsed,
+            'blocked_seconds': self.blocked_seconds,
+        }
+
+
+class Stage(object):
+
+    # work(item) returns the item for the next stage, or None to stop
+    # processing it (e.g. a frame that isn't uploaded)
+    def __init__(self, name, work, queue_size=2, workers=1):
+        self.name = name
+        self.work = work
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.next_stage = None
+        self.stats = StageStats()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name="stage-{}-{}".format(self.name, i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def put(self, item, block=True, timeout=None):
+        self.queue.put(item, block, timeout)
+
+    def join(self, timeout=None):
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                return
+            start = time.time()
+            try:
+                result = self.work(item)
+            except Exception as e:
+                logging.exception('Stage {} failed: {}'.format(self.name, e))
+                with self._lock:
+                    self.stats.failed += 1
+                continue
+            latency = time.time() - start
+            blocked = 0.0
+            if result is not None and self.next_stage is not None:
+                handoff = time.time()
+                self.next_stage.put(result)
+                blocked = time.time() - handoff
+            with self._lock:
+                self.stats.processed += 1
+                if result is None and self.next_stage is not None:
+                    self.stats.dropped += 1
+                self.stats.busy_seconds += latency
+                if latency > self.stats.max_latency:
+                    self.stats.max_latency = latency
+                self.stats.blocked_seconds += blocked
+
+
+class Pipeline(object):
+
+    def __init__(self, stages):
+        self.stages = stages
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next_stage = next_stage
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    # Blocks while the first stage's queue is full, unless block is False,
+    # in which case queue.Full is raised
+    def submit(self, item, block=True, timeout=None):
+        self.stages[0].put(item, block, timeout)
+
+    # Lets every queued item through, then stops all workers. Stages are
+    # stopped front to back, so nothing is left behind in a later queue.
+    def stop(self, timeout=None):
+        for stage in self.stages:
+            for i in range(stage.workers):
+                stage.put(_STOP)
+            stage.join(timeout)
+
+    def stats(self):
+        return dict((stage.name, stage.stats.as_dict(stage.queue.qsize())) for stage in self.stages)
+
+    # Name of the stage with the highest utilization, i.e. the one that
+    # limits sustained throughput
+    def bottleneck(self):
+        stats = self.stats()
+        return max(stats, key=lambda name: stats[name]['utilization'])
@@ -0,0 +1,85 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# prediction_decoding.py
+# Decoding of image-classification connector responses for
+# beverageclassifier.py.
+#
+# The connector answers with a JSON array of one probability per category,
+# e.g. b"[0.01, 0.02, 0.9, 0.05, 0.02]". It is parsed with json.loads into a
+# float64 array in one step, instead of slicing off the brackets and using
+# the deprecated np.fromstring(..., sep=','). Besides the best category a
+# Prediction carries:
+#
+#   top_k     the k most likely (category, confidence) pairs, best first,
+#             found with np.argpartition instead of a full sort
+#   margin    confidence of the best category minus that of the runner-up;
+#             small when the model can't tell two categories apart
+#   entropy   of the distribution, normalized to 0 (certain) .. 1 (uniform)
+#
+# Margin and entropy tell how much a frame could teach the model when it is
+# labeled and used for retraining (see upload_budget.py).
+#
+
+import json
+
+import numpy as np
+
+TOP_K = 3
+
+
+class PredictionDecodeError(ValueError):
+    pass
+
+
+# Returns the probabilities in a response body as a float64 array
+def decode_scores(body, categories):
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    try:
+        scores = np.asarray(json.loads(body), dtype=np.float64)
+    except (ValueError, TypeError) as e:
+        raise PredictionDecodeError("Invalid inference response {!r}: {}".format(body[:100], e))
+    if scores.shape != (len(categories),):
+        raise PredictionDecodeError("Expected {} scores, got shape {}".format(len(categories), scores.shape))
+    return scores
+
+
+class Prediction(object):
+    __slots__ = ('scores', 'top_k', 'category', 'confidence', 'margin', 'entropy')
+
+    def __init__(self, scores, categories, k=TOP_K):
+        self.scores = scores
+        k = min(k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        self.top_k = [(categories[i], float(scores[i])) for i in best]
+        self.category, self.confidence = self.top_k[0]
+        self.margin = self.confidence - self.top_k[1][1] if k > 1 else self.confidence
+        self.entropy = normalized_entropy(scores)
+
+    # How much labeling this frame is expected to help retraining, 0 .. 1:
+    # high for frames the model is unsure about
+    def uncertainty(self):
+        return 1.0 - self.margin
+
+    def as_dict(self):
+        return {
+            'category': self.category,
+            'confidence': self.confidence,
+            'top_k': self.top_k,
+            'margin': self.margin,
+            'entropy': self.entropy,
+        }
+
+
+def normalized_entropy(scores):
+    total = scores.sum()
+    if len(scores) < 2 or total <= 0:
+        return 0.0
+    p = scores[scores > 0] / total
+    return float(-(p * np.log(p)).sum() / np.log(len(scores)))
+
+
+def decode_prediction(body, categories, k=TOP_K):
+    return Prediction(decode_scores(body, categories), categories, k)
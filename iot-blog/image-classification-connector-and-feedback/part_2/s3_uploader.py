@@ -0,0 +1,316 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# s3_uploader.py
+# Spooled, asynchronous S3 uploads for beverageclassifier.py.
+#
+# Images selected for labeling are first written to a spool directory (one
+# .jpg plus a .json sidecar holding its S3 key) and uploaded from there by a
+# small pool of worker threads that share one boto3 client and its
+# connection pool. Nothing is lost while the uplink is down: a failed upload
+# stays in the spool and is retried with exponential backoff (full jitter),
+# and anything left in the spool is picked up again after a restart.
+#
+# When the link is slow, sending many small images costs more in per-request
+# overhead than in bytes. If the measured upload bandwidth drops below
+# BUNDLE_BANDWIDTH and enough small images are waiting, they are sent as one
+# uncompressed tar (JPEGs don't compress further) under BUNDLE_PREFIX, with
+# every member named after the key the image would have had.
+#
+# The spool never grows past max_spool_bytes; beyond that the oldest images
+# are dropped and counted.
+#
+# Set S3_ENDPOINT_URL to point the uploader at a local S3 stand-in (MinIO,
+# moto server, ...) instead of AWS.
+#
+
+import heapq
+import io
+import json
+import logging
+import os
+import random
+import tarfile
+import threading
+import time
+
+SPOOL_MAX_BYTES = 256 * 1024 * 1024   # drop the oldest images beyond this
+UPLOAD_WORKERS = 2
+MAX_BACKOFF = 300.0                   # seconds, upper bound for a retry delay
+BACKOFF_BASE = 1.0                    # seconds, doubled on every failed attempt
+SMALL_IMAGE_BYTES = 256 * 1024        # only images up to this size are bundled
+BUNDLE_BANDWIDTH = 64 * 1024          # bytes/s below which images are bundled
+BUNDLE_MIN_FILES = 4
+BUNDLE_MAX_FILES = 50
+BUNDLE_PREFIX = "image-classification-bundles/"
+
+
+def create_s3_client(max_connections=UPLOAD_WORKERS):
+    import boto3
+    from botocore.config import Config
+    return boto3.client('s3', endpoint_url=os.environ.get('S3_ENDPOINT_URL') or None,
+                        config=Config(max_pool_connections=max_connections, retries={'max_attempts': 2}))
+
+
+def backoff_delay(attempt):
+    return random.uniform(0, min(MAX_BACKOFF, BACKOFF_BASE * (2 ** attempt)))
+
+
+class SpooledS3Uploader(object):
+
+    def __init__(self, s3_client, bucket, spool_dir, max_spool_bytes=SPOOL_MAX_BYTES, workers=UPLOAD_WORKERS):
+        self.s3 = s3_client
+        self.bucket = bucket
+        self.spool_dir = spool_dir
+        self.max_spool_bytes = max_spool_bytes
+        self.workers = workers
+        self._cond = threading.Condition()
+        self._entries = {}      # entry id -> {'key', 'size', 'attempts'}
+        self._due = []          # (due time, entry id)
+        self._spool_bytes = 0
+        self._sequence = 0
+        self._running = False
+        self._threads = []
+        self._bandwidth = None  # bytes per second, moving average of recent uploads
+
+        # counters exposed through stats()
+        self.uploaded = 0
+        self.uploaded_bytes = 0
+        self.bundles = 0
+        self.failures = 0
+        self.dropped = 0
+
+        if not os.path.isdir(spool_dir):
+            os.makedirs(spool_dir)
+        self._recover()
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name="s3-uploader-{}".format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    # Spools image bytes for upload under key. Never touches the network.
+    def enqueue_image(self, image, key):
+        entry_id = self._new_entry_id()
+        path = self._image_path(entry_id)
+        with open(path + ".tmp", 'wb') as image_file:
+            image_file.write(image)
+        self._commit(entry_id, path, key, len(image))
+
+    # Moves an image file that is already on disk into the spool
+    def enqueue_file(self, filename, key):
+        entry_id = self._new_entry_id()
+        path = self._image_path(entry_id)
+        size = os.path.getsize(filename)
+        os.rename(filename, path + ".tmp")
+        self._commit(entry_id, path, key, size)
+
+    def pending(self):
+        with self._cond:
+            return len(self._entries)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'pending': len(self._entries),
+                'spool_bytes': self._spool_bytes,
+                'uploaded': self.uploaded,
+                'uploaded_bytes': self.uploaded_bytes,
+                'bundles': self.bundles,
+                'failures': self.failures,
+                'dropped': self.dropped,
+                'bandwidth': self._bandwidth,
+            }
+
+    # Uploads everything that is due now on the calling thread, e.g. for
+    # tests or before shutting down. Returns the number of images uploaded.
+    def drain(self):
+        uploaded = 0
+        while True:
+            with self._cond:
+                batch = self._take_batch(time.time())
+            if not batch:
+                return uploaded
+            if self._upload(batch):
+                uploaded += len(batch)
+
+    def _new_entry_id(self):
+        with self._cond:
+            self._sequence += 1
+            return "{:d}-{:06d}".format(int(time.time() * 1000), self._sequence)
+
+    def _image_path(self, entry_id):
+        return os.path.join(self.spool_dir, entry_id + ".jpg")
+
+    # The sidecar is written first and the image renamed into place last, so
+    # an entry only exists once both are complete
+    def _commit(self, entry_id, path, key, size):
+        with open(os.path.join(self.spool_dir, entry_id + ".json"), 'w') as meta_file:
+            json.dump({'key': key}, meta_file)
+        os.rename(path + ".tmp", path)
+        with self._cond:
+            self._entries[entry_id] = {'key': key, 'size': size, 'attempts': 0}
+            heapq.heappush(self._due, (0.0, entry_id))
+            self._spool_bytes += size
+            self._enforce_cap()
+            self._cond.notify()
+
+    def _recover(self):
+        for name in sorted(os.listdir(self.spool_dir)):
+            path = os.path.join(self.spool_dir, name)
+            if name.endswith(".tmp"):
+                os.remove(path)
+                continue
+            if not name.endswith(".jpg"):
+                continue
+            entry_id = name[:-4]
+            try:
+                with open(os.path.join(self.spool_dir, entry_id + ".json")) as meta_file:
+                    key = json.load(meta_file)['key']
+            except (IOError, OSError, ValueError, KeyError):
+                logging.warning("Dropping spooled image {} without a valid sidecar".format(name))
+                self._remove_files(entry_id)
+                continue
+            size = os.path.getsize(path)
+            self._entries[entry_id] = {'key': key, 'size': size, 'attempts': 0}
+            heapq.heappush(self._due, (0.0, entry_id))
+            self._spool_bytes += size
+        # sidecars whose image never made it
+        for name in os.listdir(self.spool_dir):
+            if name.endswith(".json") and name[:-5] not in self._entries:
+                os.remove(os.path.join(self.spool_dir, name))
+        self._enforce_cap()
+
+    # Called with the lock held
+    def _enforce_cap(self):
+        while self._spool_bytes > self.max_spool_bytes:
+            waiting = [entry_id for entry_id, entry in self._entries.items() if not entry.get('in_flight')]
+            if not waiting:
+                return
+            oldest = min(waiting)
+            entry = self._entries.pop(oldest)
+            self._spool_bytes -= entry['size']
+            self.dropped += 1
+            self._remove_files(oldest)
+            logging.warning("Upload spool over {} bytes, dropped {}".format(self.max_spool_bytes, entry['key']))
+
+    def _remove_files(self, entry_id):
+        for suffix in (".jpg", ".json"):
+            try:
+                os.remove(os.path.join(self.spool_dir, entry_id + suffix))
+            except OSError:
+                pass
+
+    # Called with the lock held. Returns the entry ids to upload next: one
+    # image, or a bundle of small images when bandwidth is limited.
+    def _take_batch(self, now):
+        while self._due and self._due[0][1] not in self._entries:
+            heapq.heappop(self._due)    # dropped while waiting
+        if not self._due or self._due[0][0] > now:
+            return []
+        due_time, entry_id = heapq.heappop(self._due)
+        batch = [entry_id]
+        if self._bundling() and self._entries[entry_id]['size'] <= SMALL_IMAGE_BYTES:
+            deferred = []
+            while self._due and self._due[0][0] <= now and len(batch) < BUNDLE_MAX_FILES:
+                due_time, other = heapq.heappop(self._due)
+                entry = self._entries.get(other)
+                if entry is None:
+                    continue
+                if entry['size'] <= SMALL_IMAGE_BYTES:
+                    batch.append(other)
+                else:
+                    deferred.append((due_time, other))
+            for item in deferred:
+                heapq.heappush(self._due, item)
+            if len(batch) < BUNDLE_MIN_FILES:
+                # not worth a bundle; send the first, put the rest back
+                for other in batch[1:]:
+                    heapq.heappush(self._due, (now, other))
+                batch = batch[:1]
+        # claimed by this worker until the upload finishes
+        for claimed in batch:
+            self._entries[claimed]['in_flight'] = True
+        return batch
+
+    def _bundling(self):
+        return self._bandwidth is not None and self._bandwidth < BUNDLE_BANDWIDTH
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._running:
+                        return
+                    now = time.time()
+                    batch = self._take_batch(now)
+                    if batch:
+                        break
+                    wait = self._due[0][0] - now if self._due else None
+                    self._cond.wait(wait)
+            self._upload(batch)
+
+    def _upload(self, batch):
+        start = time.time()
+        try:
+            if len(batch) == 1:
+                entry_id = batch[0]
+                with open(self._image_path(entry_id), 'rb') as image_file:
+                    body = image_file.read()
+                self.s3.put_object(Bucket=self.bucket, Key=self._entries[entry_id]['key'], Body=body)
+            else:
+                body = self._bundle(batch)
+                key = "{}{}-{}.tar".format(BUNDLE_PREFIX, int(start * 1000), batch[0])
+                self.s3.put_object(Bucket=self.bucket, Key=key, Body=body)
+        except Exception as e:
+            self._failed(batch, e)
+            return False
+        elapsed = max(time.time() - start, 1e-6)
+        with self._cond:
+            rate = len(body) / elapsed
+            self._bandwidth = rate if self._bandwidth is None else 0.7 * self._bandwidth + 0.3 * rate
+            for entry_id in batch:
+                entry = self._entries.pop(entry_id, None)
+                if entry is not None:
+                    self._spool_bytes -= entry['size']
+                self._remove_files(entry_id)
+            self.uploaded += len(batch)
+            self.uploaded_bytes += len(body)
+            if len(batch) > 1:
+                self.bundles += 1
+        logging.info("Uploaded {} image(s), {} bytes to S3 bucket {}".format(len(batch), len(body), self.bucket))
+        return True
+
+    def _bundle(self, batch):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w') as bundle:
+            for entry_id in batch:
+                bundle.add(self._image_path(entry_id), arcname=self._entries[entry_id]['key'])
+        return buffer.getvalue()
+
+    def _failed(self, batch, error):
+        with self._cond:
+            self.failures += 1
+            for entry_id in batch:
+                entry = self._entries.get(entry_id)
+                if entry is None:
+                    continue
+                entry['in_flight'] = False
+                entry['attempts'] += 1
+                heapq.heappush(self._due, (time.time() + backoff_delay(entry['attempts']), entry_id))
+            self._cond.notify()
+        logging.warning("Upload of {} image(s) to S3 failed, will retry: {}".format(len(batch), error))
@@ -0,0 +1,102 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# scene_gate.py
+# Scene-change gating for beverageclassifier.py.
+#
+# Before a full 400x400 capture and a connector inference, a tiny greyscale
+# (luma) frame is grabbed from the camera's video port and compared with the
+# frames the last few predictions were made on. The comparison is a single
+# vectorized NumPy difference against all of them at once: a scene counts as
+# unchanged if its mean absolute difference stays below mean_threshold and
+# less than changed_fraction of its pixels moved by more than pixel_delta.
+#
+# For an unchanged scene the cached prediction is reused, so full inference
+# only runs when something in front of the camera changed. Every cached
+# prediction expires after max_age seconds, so a slow drift (daylight, a
+# mug pushed a few millimetres at a time) is still classified now and then.
+#
+
+import threading
+import time
+
+import numpy as np
+
+LUMA_SIZE = (32, 32)        # width, height of the gating frame
+MEAN_THRESHOLD = 6.0        # mean absolute luma difference, 0-255
+PIXEL_DELTA = 24            # a pixel "moved" if it changed by more than this
+CHANGED_FRACTION = 0.02     # fraction of moved pixels that counts as a change
+MAX_AGE = 60.0              # seconds a cached prediction may be reused
+CACHE_SIZE = 4
+
+
+# The camera's raw YUV420 output pads width to a multiple of 32 and height to
+# a multiple of 16; the luma plane comes first
+def luma_from_yuv(data, width, height):
+    padded_width = (width + 31) // 32 * 32
+    padded_height = (height + 15) // 16 * 16
+    plane = np.frombuffer(data, dtype=np.uint8, count=padded_width * padded_height)
+    return plane.reshape(padded_height, padded_width)[:height, :width]
+
+
+class SceneGate(object):
+
+    def __init__(self, mean_threshold=MEAN_THRESHOLD, pixel_delta=PIXEL_DELTA,
+                 changed_fraction=CHANGED_FRACTION, max_age=MAX_AGE, cache_size=CACHE_SIZE):
+        self.mean_threshold = mean_threshold
+        self.pixel_delta = pixel_delta
+        self.changed_fraction = changed_fraction
+        self.max_age = max_age
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._frames = None     # (n, height, width) int16, most recent first
+        self._predictions = []  # (prediction, time) for each of _frames
+
+        # counters exposed through stats()
+        self.checked = 0
+        self.reused = 0
+        self.expired = 0
+
+    # Returns the cached prediction for a scene like luma, or None if the
+    # scene changed (or the prediction for it is too old)
+    def lookup(self, luma, now=None):
+        now = time.time() if now is None else now
+        frame = np.asarray(luma, dtype=np.int16)
+        with self._lock:
+            self.checked += 1
+            if self._frames is None or self._frames.shape[1:] != frame.shape:
+                return None
+            diff = np.abs(self._frames - frame)
+            mean = diff.mean(axis=(1, 2))
+            moved = (diff > self.pixel_delta).mean(axis=(1, 2))
+            same = np.flatnonzero((mean < self.mean_threshold) & (moved < self.changed_fraction))
+            if not len(same):
+                return None
+            # the closest match
+            index = same[np.argmin(mean[same])]
+            prediction, predicted_at = self._predictions[index]
+            if now - predicted_at > self.max_age:
+                self.expired += 1
+                return None
+            self.reused += 1
+            return prediction
+
+    # Caches prediction as the result for scenes like luma
+    def remember(self, luma, prediction, now=None):
+        now = time.time() if now is None else now
+        frame = np.asarray(luma, dtype=np.int16)[np.newaxis]
+        with self._lock:
+            if self._frames is None or self._frames.shape[1:] != frame.shape[1:]:
+                self._frames, self._predictions = frame, [(prediction, now)]
+                return
+            self._frames = np.concatenate((frame, self._frames[:self.cache_size - 1]))
+            self._predictions = [(prediction, now)] + self._predictions[:self.cache_size - 1]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'checked': self.checked,
+                'reused': self.reused,
+                'expired': self.expired,
+                'cached': len(self._predictions),
+            }
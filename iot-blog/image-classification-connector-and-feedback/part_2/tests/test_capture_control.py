@@ -0,0 +1,121 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# test_capture_control.py
+# Checks that beverageclassifier.py only reports capture plus inference time
+# to the capture controller, not the time frames wait in the pipeline. The
+# camera, the inference connector, Greengrass and S3 are replaced by
+# stand-ins with fixed delays.
+#
+# Run with: python -m unittest discover tests
+#
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+CAPTURE_SECONDS = 0.01
+INFERENCE_SECONDS = 0.08
+TARGET_MS = 150     # capture plus inference is well below, with queue waits well above
+FRAMES = 30
+
+
+class StandInCamera(object):
+
+    def __init__(self, resolution=None):
+        self.resolution = resolution
+        self.zoom = None
+
+    def capture(self, output, format='jpeg', quality=None, resize=None, use_video_port=False):
+        time.sleep(CAPTURE_SECONDS)
+        output.write(b'\xff\xd8' + b'\x00' * 1000)
+
+
+class StandInInferenceClient(object):
+
+    def invoke_inference_service(self, AlgoType, ServiceName, ContentType, Body):
+        time.sleep(INFERENCE_SECONDS)
+        return {'Body': io.BytesIO(b"[0.05, 0.1, 0.7, 0.1, 0.05]")}
+
+
+class StandInPublisher(object):
+
+    def publish(self, topic, payload):
+        pass
+
+
+class StandInS3(object):
+
+    def put_object(self, Bucket, Key, Body):
+        pass
+
+
+def module(name, **attributes):
+    stand_in = types.ModuleType(name)
+    stand_in.__dict__.update(attributes)
+    return stand_in
+
+
+def install_stand_ins():
+    botocore_config = module('botocore.config', Config=lambda **kwargs: None)
+    sys.modules.update({
+        'picamera': module('picamera', PiCamera=StandInCamera),
+        'greengrasssdk': module('greengrasssdk', client=lambda name: StandInPublisher()),
+        'greengrass_machine_learning_sdk': module(
+            'greengrass_machine_learning_sdk', client=lambda name: StandInInferenceClient(),
+            GreengrassInferenceException=type('GreengrassInferenceException', (Exception,), {}),
+            GreengrassDependencyException=type('GreengrassDependencyException', (Exception,), {})),
+        'boto3': module('boto3', client=lambda name, **kwargs: StandInS3()),
+        'botocore': module('botocore', config=botocore_config),
+        'botocore.config': botocore_config,
+    })
+
+
+class CaptureControlTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.spool_dir = tempfile.mkdtemp()
+        os.environ.update({
+            'UPLOAD_SPOOL_DIR': cls.spool_dir,
+            'CAPTURE_TARGET_MS': str(TARGET_MS),
+            'SCENE_GATE': 'false',
+            'UPLOAD_DEDUP': 'false',
+            'PIPELINE_STATS_INTERVAL': '0',
+        })
+        install_stand_ins()
+        import beverageclassifier
+        cls.classifier = beverageclassifier
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.classifier.frame_pipeline.stop()
+        shutil.rmtree(cls.spool_dir, ignore_errors=True)
+
+    def test_slow_inference_behind_full_queue_does_not_step_down(self):
+        classifier = self.classifier
+        for i in range(FRAMES):
+            classifier.function_handler({}, None)
+        classifier.frame_pipeline.stop()
+
+        # the frames really did queue up in front of inference
+        waits = classifier.frame_wait_stats()
+        self.assertEqual(waits['frames'], FRAMES)
+        self.assertGreater(waits['avg_inference_wait'], TARGET_MS / 1000.0)
+
+        stats = classifier.capture_controller.stats()
+        self.assertGreaterEqual(stats['observed'], classifier.capture_controller.window)
+        self.assertEqual(stats['step_downs'], 0)
+        self.assertEqual(stats['level'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# upload_budget.py
+# Picks which frames beverageclassifier.py uploads for labeling.
+#
+# Instead of uploading every frame outside a fixed confidence band, at most
+# per_hour frames are uploaded each hour, and they are the most informative
+# frames of that hour (e.g. the smallest margin between the two best
+# categories, see prediction_decoding.py). Candidates are kept in a min-heap
+# keyed by score: while the heap has room every candidate goes in, after
+# that a candidate only goes in if it beats the least informative one, which
+# is dropped. When the hour is over everything in the heap is handed to
+# `upload` and the next hour starts empty.
+#
+# Dropped candidates are handed to `discard` (e.g. to delete a file that was
+# saved for them).
+#
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+PER_HOUR = 60
+PERIOD = 3600.0
+
+
+class UploadBudget(object):
+
+    def __init__(self, upload, per_hour=PER_HOUR, discard=None, period=PERIOD):
+        self.upload = upload
+        self.discard = discard
+        self.per_hour = per_hour
+        self.period = period
+        self._lock = threading.Lock()
+        self._heap = []         # (score, sequence, item), least informative first
+        self._sequence = itertools.count()
+        self._period_start = None
+
+        # counters exposed through stats()
+        self.offered = 0
+        self.replaced = 0
+        self.rejected = 0
+        self.flushed = 0
+
+    # Offers item with the given score for this hour's uploads. Returns True
+    # if it is (for now) one of the selected ones.
+    def offer(self, score, item, now=None):
+        self.poll(now)
+        dropped = None
+        with self._lock:
+            self.offered += 1
+            entry = (score, next(self._sequence), item)
+            if len(self._heap) < self.per_hour:
+                heapq.heappush(self._heap, entry)
+                return True
+            if not self._heap or score <= self._heap[0][0]:
+                self.rejected += 1
+                dropped = item
+            else:
+                self.replaced += 1
+                dropped = heapq.heapreplace(self._heap, entry)[2]
+        if dropped is not None and self.discard is not None:
+            self.discard(dropped)
+        return dropped is not item
+
+    # Uploads the selection once its hour is over. Called on every offer and
+    # should also be called periodically, so an hour without candidates at
+    # its end is still flushed.
+    def poll(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            start = now // self.period * self.period
+            if self._period_start is None:
+                self._period_start = start
+            if start == self._period_start:
+                return 0
+            self._period_start = start
+            selected, self._heap = self._heap, []
+        return self._upload(selected)
+
+    # Uploads the current selection right away, e.g. before shutting down
+    def flush(self):
+        with self._lock:
+            selected, self._heap = self._heap, []
+        return self._upload(selected)
+
+    def pending(self):
+        with self._lock:
+            return len(self._heap)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'offered': self.offered,
+                'selected': len(self._heap),
+                'replaced': self.replaced,
+                'rejected': self.rejected,
+                'flushed': self.flushed,
+                'min_score': self._heap[0][0] if self._heap else None,
+            }
+
+    def _upload(self, selected):
+        # most informative first, in case the uploader falls behind
+        selected.sort(reverse=True)
+        for score, sequence, item in selected:
+            try:
+                self.upload(item)
+            except Exception:
+                logging.exception("Upload of a selected frame failed")
+        with self._lock:
+            self.flushed += len(selected)
+        if selected:
+            logging.info("Upload budget: flushed {} frames, scores {:.3f} .. {:.3f}".format(
+                len(selected), selected[-1][0], selected[0][0]))
+        return len(selected)
@@ -0,0 +1,85 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+
+# codecBenchmark.py
+# Micro-benchmark of shadowCodec.py against the code it replaced: building
+# update documents by string concatenation and reading deltas and update
+# responses with json.loads. Needs nothing but the standard library.
+#
+# Usage:
+#   python benchmarks/codecBenchmark.py
+#   python benchmarks/codecBenchmark.py --number 1000000 --json results.json
+
+import argparse
+import json
+import os
+import sys
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import shadowCodec
+
+# As delivered by the SDK to a delta callback
+DELTA = json.dumps({"version": 1042, "timestamp": 1500000000,
+                    "state": {"property": "Y"},
+                    "metadata": {"property": {"timestamp": 1500000000}}})
+# As delivered to an update callback with responseStatus "accepted"
+ACCEPTED = json.dumps({"state": {"reported": {"property": "R"}},
+                       "metadata": {"reported": {"property": {"timestamp": 1500000000}}},
+                       "version": 1043, "timestamp": 1500000000,
+                       "clientToken": "trafficLight-0-0"})
+
+
+def concatDesired(item):
+    return '{"state":{"desired":{"property":' + '"' + item + '"}}}'
+
+
+def jsonDelta(payload):
+    payloadDict = json.loads(payload)
+    return payloadDict["version"], payloadDict["state"]["property"]
+
+
+def jsonAccepted(payload):
+    return json.loads(payload)["state"]["reported"]["property"]
+
+
+CASES = [
+    ("build desired", lambda: concatDesired('G'), lambda: shadowCodec.desiredPayload('G')),
+    ("parse delta", lambda: jsonDelta(DELTA), lambda: shadowCodec.parseDelta(DELTA)),
+    ("parse accepted", lambda: jsonAccepted(ACCEPTED), lambda: shadowCodec.parseUpdate(ACCEPTED, 'reported')),
+]
+
+
+def run(number, repeat):
+    results = []
+    for name, current, codec in CASES:
+        assert current() == codec(), name
+        currentNs = min(timeit.repeat(current, number=number, repeat=repeat)) / number * 1e9
+        codecNs = min(timeit.repeat(codec, number=number, repeat=repeat)) / number * 1e9
+        results.append({'case': name, 'currentNs': currentNs, 'codecNs': codecNs,
+                        'speedup': currentNs / codecNs if codecNs else 0.0})
+    return results
+
+
+def report(results):
+    print("{:<16} {:>12} {:>12} {:>8}".format("case", "current ns", "codec ns", "speedup"))
+    for result in results:
+        print("{:<16} {:>12.1f} {:>12.1f} {:>7.1f}x".format(
+            result['case'], result['currentNs'], result['codecNs'], result['speedup']))
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--number", type=int, default=200000, help="Calls per timing run")
+parser.add_argument("--repeat", type=int, default=5, help="Timing runs per case, the fastest is reported")
+parser.add_argument("--json", help="Write the results to this file")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    results = run(args.number, args.repeat)
+    report(results)
+    if args.json:
+        with open(args.json, "w") as resultsFile:
+            json.dump(results, resultsFile, indent=2)
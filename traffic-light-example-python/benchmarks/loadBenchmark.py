@@ -0,0 +1,229 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+
+# loadBenchmark.py
+# Load benchmark for the traffic light pipeline. Generates shadow documents
+# at a configurable rate (1 to 100k events/s) for a number of simulated
+# lights and feeds them, in-process, to
+#
+#   aggregator  carAggregator.function_handler (shadow documents, plus
+#               optional vehicle detection events)
+#   light       trafficLight.customShadowCallback_Delta (shadow deltas; the
+#               latency is the MQTT callback's, applying is asynchronous)
+#
+# DynamoDB and MQTT are replaced by the stand-ins in localStandins.py. The
+# benchmark reports achieved throughput, p50/p99/max handler latency and
+# memory growth, and can write the results as JSON so regressions can be
+# caught by comparing runs.
+#
+# Usage:
+#   python benchmarks/loadBenchmark.py --target aggregator --rate 10000 --duration 10 --things 1000
+#   python benchmarks/loadBenchmark.py --target light --rate 1000 --json results.json
+#
+# Use --rate 0 to run as fast as possible.
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+from localStandins import LocalDynamoDB, LocalShadowHandler, installDynamoStandin
+
+CYCLE = ('G', 'Y', 'R')
+
+
+class _ClientContext(object):
+    def __init__(self, topic):
+        self.custom = {'subject': topic}
+
+
+# Greengrass passes the topic the event arrived on in the lambda context
+class FakeContext(object):
+    def __init__(self, thingName):
+        self.client_context = _ClientContext("$aws/things/" + thingName + "/shadow/update/documents")
+
+
+# Yields (thing index, event) forever, cycling every light through G, Y, R.
+# Every green is followed by detectionsPerGreen vehicle detections if > 0.
+def aggregatorEvents(things, detectionsPerGreen):
+    contexts = [FakeContext("light-" + str(i)) for i in range(things)]
+    documents = dict((light, {"current": {"state": {"reported": {"property": light}}}}) for light in CYCLE)
+    detections = {"detections": {"t": [time.time()] * detectionsPerGreen,
+                                 "lane": [1] * detectionsPerGreen,
+                                 "speed": [12.5] * detectionsPerGreen}}
+    while True:
+        for light in CYCLE:
+            for i in range(things):
+                yield contexts[i], documents[light]
+                if light == 'G' and detectionsPerGreen:
+                    yield contexts[i], detections
+
+
+# Yields shadow delta payloads, as the MQTT client would deliver them
+def lightDeltas():
+    version = 0
+    while True:
+        for light in CYCLE:
+            version += 1
+            yield json.dumps({"version": version, "timestamp": int(time.time()),
+                              "state": {"property": light},
+                              "metadata": {"property": {"timestamp": int(time.time())}}})
+
+
+def percentile(sortedValues, q):
+    if not sortedValues:
+        return 0.0
+    return sortedValues[min(len(sortedValues) - 1, int(q * len(sortedValues)))]
+
+
+def maxRssKb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# Calls handler(item) for every generated item, paced to `rate` per second,
+# and returns the per-call latencies in seconds
+def drive(handler, items, rate, duration):
+    latencies = []
+    start = time.time()
+    deadline = start + duration
+    interval = 1.0 / rate if rate else 0.0
+    count = 0
+    for item in items:
+        now = time.time()
+        if now >= deadline:
+            break
+        if interval:
+            due = start + count * interval
+            if due - now > 0.001:
+                time.sleep(due - now)
+        callStart = time.perf_counter()
+        handler(item)
+        latencies.append(time.perf_counter() - callStart)
+        count += 1
+    return latencies, time.time() - start
+
+
+def setUpAggregator(workDir, writeLatency):
+    os.environ['SPOOL_DIR'] = os.path.join(workDir, 'spool')
+    os.environ['TABLE_CACHE_DIR'] = workDir
+    installDynamoStandin(LocalDynamoDB(writeLatency=writeLatency))
+    import carAggregator
+    carAggregator.provisioner.waitReady()
+    # the lambda logs every event at INFO; keep it off stdout while measuring
+    logging.getLogger().handlers = [logging.NullHandler()]
+
+    def handle(item):
+        context, event = item
+        carAggregator.function_handler(event, context)
+    return handle, carAggregator
+
+
+def setUpLight():
+    import trafficLight
+    trafficLight.deviceShadowHandlers = {"Bot": LocalShadowHandler(ack=True)}
+
+    def handle(payload):
+        trafficLight.customShadowCallback_Delta(payload, "delta", None)
+    return handle, trafficLight
+
+
+def run(args):
+    workDir = tempfile.mkdtemp()
+    tracing = args.tracemalloc
+    module = None
+    try:
+        if args.target == 'aggregator':
+            handler, module = setUpAggregator(workDir, args.writeLatency)
+            items = aggregatorEvents(args.things, args.detections)
+        else:
+            handler, module = setUpLight()
+            items = lightDeltas()
+
+        # warm up so imports and first-time allocations are not measured
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            drive(handler, items, 0, 0.5)
+
+            if tracing:
+                tracemalloc.start()
+            rssBefore = maxRssKb()
+            tracedBefore = tracemalloc.get_traced_memory()[0] if tracing else 0
+            latencies, elapsed = drive(handler, items, args.rate, args.duration)
+            tracedAfter = tracemalloc.get_traced_memory()[0] if tracing else 0
+            rssAfter = maxRssKb()
+            if tracing:
+                tracemalloc.stop()
+
+        latencies.sort()
+        results = {
+            'target': args.target,
+            'requestedRate': args.rate,
+            'events': len(latencies),
+            'seconds': elapsed,
+            'throughput': len(latencies) / elapsed if elapsed else 0.0,
+            'p50Us': percentile(latencies, 0.50) * 1e6,
+            'p99Us': percentile(latencies, 0.99) * 1e6,
+            'maxUs': (latencies[-1] if latencies else 0.0) * 1e6,
+            'maxRssGrowthKb': rssAfter - rssBefore,
+        }
+        if tracing:
+            results['tracedGrowthBytes'] = tracedAfter - tracedBefore
+        if args.target == 'aggregator':
+            results['intersections'] = len(module.intersections)
+            results['writer'] = module.statsWriter.stats()
+        else:
+            module.deltaDispatcher.drain()
+            results['dispatcher'] = module.deltaDispatcher.stats()
+        return results
+    finally:
+        if args.target == 'aggregator' and module is not None:
+            module.statsWriter.stop()
+        shutil.rmtree(workDir, ignore_errors=True)
+
+
+def report(results):
+    print("target:          " + results['target'])
+    print("events:          " + str(results['events']) + " in " + str(round(results['seconds'], 2)) + "s")
+    print("throughput:      " + str(round(results['throughput'], 1)) + " events/s (requested " + str(results['requestedRate']) + ")")
+    print("latency p50:     " + str(round(results['p50Us'], 1)) + " us")
+    print("latency p99:     " + str(round(results['p99Us'], 1)) + " us")
+    print("latency max:     " + str(round(results['maxUs'], 1)) + " us")
+    print("max RSS growth:  " + str(results['maxRssGrowthKb']) + " KB")
+    if 'tracedGrowthBytes' in results:
+        print("traced growth:   " + str(results['tracedGrowthBytes']) + " bytes")
+    if 'writer' in results:
+        print("writer:          " + str(results['writer']))
+    if 'dispatcher' in results:
+        print("dispatcher:      " + str(results['dispatcher']))
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--target", choices=("aggregator", "light"), default="aggregator")
+parser.add_argument("--rate", type=float, default=1000, help="Events per second, 0 for unpaced")
+parser.add_argument("--duration", type=float, default=10, help="Seconds to run")
+parser.add_argument("--things", type=int, default=100, help="Simulated traffic lights (aggregator)")
+parser.add_argument("--detections", type=int, default=0,
+                    help="Vehicle detections sent per green light (aggregator)")
+parser.add_argument("--write-latency", type=float, default=0.02, dest="writeLatency",
+                    help="Seconds each stand-in BatchWriteItem call takes")
+parser.add_argument("--tracemalloc", action="store_true", help="Also trace Python allocations (slower)")
+parser.add_argument("--json", help="Write the results to this file")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    results = run(args)
+    report(results)
+    if args.json:
+        with open(args.json, "w") as resultsFile:
+            json.dump(results, resultsFile, indent=2)
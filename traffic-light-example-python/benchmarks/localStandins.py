@@ -0,0 +1,147 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+
+# localStandins.py
+# In-process stand-ins for the AWS services used by the traffic light example,
+# so the benchmarks in this folder can run without an AWS account or a
+# Greengrass core. Latencies are configurable so that slow networks and slow
+# table creation can be simulated.
+#
+# boto3 and botocore still have to be installed; only boto3.resource is
+# replaced, via installDynamoStandin(). The MQTT side is covered by
+# LocalShadowHandler, which takes the place of an AWSIoTPythonSDK
+# deviceShadow handler.
+
+import threading
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+
+
+def clientError(code, operation):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+class _Waiter(object):
+
+    def __init__(self, dynamodb):
+        self._dynamodb = dynamodb
+
+    def wait(self, TableName):
+        table = self._dynamodb._tables.get(TableName)
+        if table is None:
+            raise clientError('ResourceNotFoundException', 'DescribeTable')
+        delay = table.readyAt - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class _Meta(object):
+
+    def __init__(self, client):
+        self.client = client
+
+
+class LocalTable(object):
+
+    def __init__(self, dynamodb, name, createDelay):
+        self.name = name
+        self.items = []
+        self.readyAt = time.time() + createDelay
+        self.meta = _Meta(dynamodb)
+
+
+# Mimics the parts of a boto3 DynamoDB service resource (and its client)
+# used by carAggregator.py
+class LocalDynamoDB(object):
+
+    # createDelay: seconds until a newly created table becomes ACTIVE
+    # writeLatency: seconds each batch_write_item call takes
+    def __init__(self, createDelay=0.0, writeLatency=0.0, existingTables=()):
+        self.createDelay = createDelay
+        self.writeLatency = writeLatency
+        self.batchCalls = 0
+        self._lock = threading.Lock()
+        self._tables = {}
+        for name in existingTables:
+            self._tables[name] = LocalTable(self, name, 0.0)
+        self.meta = _Meta(self)
+
+    def create_table(self, TableName, **kwargs):
+        with self._lock:
+            if TableName in self._tables:
+                raise clientError('ResourceInUseException', 'CreateTable')
+            table = LocalTable(self, TableName, self.createDelay)
+            self._tables[TableName] = table
+            return table
+
+    def Table(self, name):
+        with self._lock:
+            table = self._tables.get(name)
+        if table is None:
+            table = LocalTable(self, name, 0.0)
+        return table
+
+    def get_waiter(self, name):
+        return _Waiter(self)
+
+    def batch_write_item(self, RequestItems):
+        if self.writeLatency:
+            time.sleep(self.writeLatency)
+        with self._lock:
+            self.batchCalls += 1
+            for name, requests in RequestItems.items():
+                table = self._tables.get(name)
+                if table is None or table.readyAt > time.time():
+                    raise clientError('ResourceNotFoundException', 'BatchWriteItem')
+                table.items.extend(request['PutRequest']['Item'] for request in requests)
+        return {'UnprocessedItems': {}}
+
+    def itemCount(self, name):
+        with self._lock:
+            table = self._tables.get(name)
+            return len(table.items) if table is not None else 0
+
+
+# Route boto3.resource('dynamodb', ...) to the given stand-in
+def installDynamoStandin(dynamodb):
+    realResource = boto3.resource
+
+    def resource(serviceName, *args, **kwargs):
+        if serviceName == 'dynamodb':
+            return dynamodb
+        return realResource(serviceName, *args, **kwargs)
+    boto3.resource = resource
+    return dynamodb
+
+
+# Mimics the deviceShadow handler returned by
+# AWSIoTMQTTShadowClient.createShadowHandlerWithName. Updates are counted
+# and, if ack is set, acknowledged synchronously as "accepted".
+class LocalShadowHandler(object):
+
+    def __init__(self, thingName="Bot", ack=False):
+        self.thingName = thingName
+        self.ack = ack
+        self.updates = 0
+        self.lastPayload = None
+        self._deltaCallback = None
+        self._token = 0
+
+    def shadowUpdate(self, payload, callback, timeout):
+        self.updates += 1
+        self.lastPayload = payload
+        self._token += 1
+        token = self.thingName + "-" + str(self._token)
+        if self.ack and callback is not None:
+            callback(payload, "accepted", token)
+        return token
+
+    def shadowRegisterDeltaCallback(self, callback):
+        self._deltaCallback = callback
+
+    # Deliver a delta as the MQTT client thread would
+    def deliverDelta(self, payload):
+        self._deltaCallback(payload, "delta/" + self.thingName, None)
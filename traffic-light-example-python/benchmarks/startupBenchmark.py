@@ -0,0 +1,104 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+
+# startupBenchmark.py
+# Measures how long carAggregator.py takes from the start of its import until
+# it has handled its first shadow event. Every run happens in a fresh Python
+# process against a local DynamoDB stand-in whose table creation takes
+# --create-delay seconds. Three cold starts are compared:
+#
+#   blocking          the old behaviour: create the table and wait during import
+#   background        table created on a background thread, no cached state
+#   background-cached a second background start that finds the ready marker
+#
+# Usage: python benchmarks/startupBenchmark.py [--create-delay 10] [--runs 3]
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+GREEN_EVENT = {"current": {"state": {"reported": {"property": "G"}}}, "thingName": "Bot"}
+
+
+# Runs in the child process: import the lambda and feed it one event
+# With waitReady the child also waits for provisioning to finish, so that
+# the ready marker gets written before it exits.
+def runChild(mode, createDelay, cacheDir, waitReady=False):
+    from localStandins import LocalDynamoDB, installDynamoStandin
+
+    os.environ['TABLE_PROVISIONING'] = 'blocking' if mode == 'blocking' else 'background'
+    os.environ['TABLE_CACHE_DIR'] = cacheDir
+    os.environ['SPOOL_DIR'] = os.path.join(cacheDir, 'spool')
+    # a cached start means an earlier start already created the table
+    existing = ('CarStats',) if mode == 'background-cached' and not waitReady else ()
+    installDynamoStandin(LocalDynamoDB(createDelay=createDelay, existingTables=existing))
+
+    start = time.time()
+    import carAggregator
+    imported = time.time()
+    carAggregator.function_handler(GREEN_EVENT, None)
+    handled = time.time()
+    if waitReady:
+        carAggregator.provisioner.waitReady()
+
+    print(json.dumps({
+        'mode': mode,
+        'importSeconds': imported - start,
+        'firstEventSeconds': handled - start,
+        'queuedRecords': carAggregator.statsWriter.queueDepth(),
+    }))
+
+
+def runParent(createDelay, runs):
+    print("create delay: " + str(createDelay) + "s, " + str(runs) + " runs per mode\n")
+    print("{:<20}{:>18}{:>22}".format("mode", "import (ms)", "first event (ms)"))
+    for mode in ('blocking', 'background', 'background-cached'):
+        importTimes = []
+        eventTimes = []
+        for _ in range(runs):
+            cacheDir = tempfile.mkdtemp()
+            try:
+                if mode == 'background-cached':
+                    # first start provisions the table and writes the marker
+                    childResult(mode, createDelay, cacheDir, warmup=True)
+                result = childResult(mode, createDelay, cacheDir)
+            finally:
+                shutil.rmtree(cacheDir)
+            importTimes.append(result['importSeconds'] * 1000)
+            eventTimes.append(result['firstEventSeconds'] * 1000)
+        print("{:<20}{:>18.1f}{:>22.1f}".format(mode, sum(importTimes) / runs, sum(eventTimes) / runs))
+
+
+def childResult(mode, createDelay, cacheDir, warmup=False):
+    command = [sys.executable, os.path.abspath(__file__), '--child', mode,
+               '--create-delay', str(createDelay), '--cache-dir', cacheDir]
+    if warmup:
+        command.append('--wait-ready')
+    output = subprocess.check_output(command)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--create-delay", type=float, default=10.0, dest="createDelay",
+                    help="Seconds the local stand-in takes to create the table")
+parser.add_argument("--runs", type=int, default=3, help="Cold starts per mode")
+parser.add_argument("--child", help=argparse.SUPPRESS)
+parser.add_argument("--cache-dir", dest="cacheDir", help=argparse.SUPPRESS)
+parser.add_argument("--wait-ready", action="store_true", dest="waitReady", help=argparse.SUPPRESS)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.child:
+        runChild(args.child, args.createDelay, args.cacheDir, args.waitReady)
+    else:
+        runParent(args.createDelay, args.runs)
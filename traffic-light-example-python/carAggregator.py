@@ -21,12 +21,46 @@
 # This function stores statistics on these numbers and uploads them to DynamoDB 
 # on every fourth green light. Since this function is long-lived it 
 # will run forever when deployed to a Greengrass core.
+#
+# Writes to DynamoDB are handed to a BufferedTableWriter (dynamoWriter.py)
+# which batches them on a background thread, so the shadow callback never
+# waits on a network round trip. Records are spooled to disk first
+# (recordSpool.py) so none are lost while DynamoDB is unreachable.
+# The CarStats table is created on a background thread by a TableProvisioner
+# (tableProvisioner.py) so that a cold start does not wait on DynamoDB.
+# Deploy the helper modules imported below alongside this file.
+#
+# Besides the lifetime totals, cars per green light are tracked in a tumbling
+# and a sliding window (windowStats.py) so questions like "p95 cars per green
+# in the last 15 minutes" can be answered. Each closed window is written to
+# CarStats with its count, sum, min, max and p50/p95/p99.
+#
+# A single core usually serves many traffic lights, so all of this state is
+# kept per thing name in an IntersectionStore (intersectionStore.py).
+# Closed windows are also merged into corridor and district rollups
+# (rollups.py), which are written to CarStats with a Level attribute.
+#
+# Real deployments can also send per-vehicle detection events. These are
+# appended to NumPy ring buffers and counted per light phase with vectorized
+# reductions (vehicleEvents.py); the random car count is then replaced by
+# the number of vehicles actually detected during each green light.
 
+import atexit
 import logging
+import os
+import time
 import boto3
 from datetime import datetime
 from random import *
-from botocore.exceptions import ClientError
+from dynamoWriter import BufferedTableWriter, MemoryBuffer
+from recordSpool import RecordSpool, SPOOL_DIR
+from tableProvisioner import TableProvisioner
+from windowStats import TumblingWindow, SlidingWindow
+from intersectionStore import IntersectionStore, thingNameFromEvent
+from vehicleEvents import VehicleEventIngestor
+from shadowCodec import ShadowSchemaError, validateDocument
+from latencyTrace import LatencyMetrics, serveMetrics, elapsed, REPORT_TO_AGGREGATOR, END_TO_END
+from rollups import RollupIndex, loadHierarchy
 
 # Initialized DynamoDB client
 # Note this creates a dynamodb table in region us-east-1 (N. Virginia)
@@ -34,103 +68,230 @@ from botocore.exceptions import ClientError
 # Note endpoint and aws credentials are not specified. By default this 
 # uses the credentials configured for the session. See Boto 3 docs
 # for more details.
+# Set DYNAMODB_ENDPOINT (e.g. http://localhost:8000) to use DynamoDB Local instead.
 
-dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+dynamodb = boto3.resource('dynamodb', region_name='us-east-1',
+                          endpoint_url=os.environ.get('DYNAMODB_ENDPOINT'))
 tableName = "CarStats"
 
-# Create the dynamo db table if needed
-try:
-    table = dynamodb.create_table(
-        TableName=tableName,
-        KeySchema=[
-            {
-                'AttributeName': 'Time', 
-                'KeyType': 'HASH'  #Partition key
-            }
-        ],
-        AttributeDefinitions=[
-            {
-                'AttributeName': 'Time',
-                'AttributeType': 'S'
-            }
-        ],
-        ProvisionedThroughput={
-            'ReadCapacityUnits': 5,
-            'WriteCapacityUnits': 5
+# Table definition used if the table needs to be created
+tableDefinition = {
+    'KeySchema': [
+        {
+            'AttributeName': 'Time', 
+            'KeyType': 'HASH'  #Partition key
         }
-    )
+    ],
+    'AttributeDefinitions': [
+        {
+            'AttributeName': 'Time',
+            'AttributeType': 'S'
+        }
+    ],
+    'ProvisionedThroughput': {
+        'ReadCapacityUnits': 5,
+        'WriteCapacityUnits': 5
+    }
+}
+
+# Create the dynamo db table if needed.
+# By default this happens on a background thread so the lambda can take
+# shadow events right away; stats are buffered until the table is ready.
+# Set TABLE_PROVISIONING=blocking to wait for the table during import instead.
+provisioner = TableProvisioner(dynamodb, tableName, tableDefinition)
+if os.environ.get('TABLE_PROVISIONING', 'background') == 'blocking':
+    provisioner.provision()
+else:
+    provisioner.start()
 
-    # Wait until the table exists.
-    table.meta.client.get_waiter('table_exists').wait(TableName=tableName)
-except ClientError as e:
-    if e.response['Error']['Code'] == 'ResourceInUseException':
-        print("Table already created")
-    else:
-        raise e
+# Stats records are written to an on-disk spool first, so they survive
+# DynamoDB outages and restarts, and a background thread drains the spool in
+# batches. Point SPOOL_DIR at a Greengrass local resource so the spool also
+# outlives redeployments; set it to an empty string to buffer in memory only.
+if SPOOL_DIR:
+    statsBuffer = RecordSpool(SPOOL_DIR)
+else:
+    statsBuffer = MemoryBuffer()
+statsWriter = BufferedTableWriter(dynamodb, tableName, buffer=statsBuffer, gate=provisioner)
+statsWriter.start()
+atexit.register(statsWriter.stop)
 
 # initialize the logger
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# This is a long lived lambda so we can keep state as below
-totalTraffic = 0
-totalGreenlights = 0
-minCars = -1
-maxCars = -1
+# Window sizes in seconds, all configurable from the lambda environment
+TUMBLING_WINDOW_SECONDS = int(os.environ.get('TUMBLING_WINDOW_SECONDS', 300))
+SLIDING_WINDOW_SECONDS = int(os.environ.get('SLIDING_WINDOW_SECONDS', 900))
+SLIDING_WINDOW_STEP_SECONDS = int(os.environ.get('SLIDING_WINDOW_STEP_SECONDS', 60))
+
+# Returns the callback the windows of one intersection call when they close.
+# The window end, kind and thing name together make the hash key unique.
+def closedWindowWriter(thingName):
+    def writeClosedWindow(kind, start, end, summary):
+        item = summary.toItem()
+        item['Time'] = str(datetime.utcfromtimestamp(end)) + "#" + kind + "#" + thingName
+        item['Intersection'] = thingName
+        item['WindowType'] = kind
+        item['WindowStart'] = str(datetime.utcfromtimestamp(start))
+        item['WindowEnd'] = str(datetime.utcfromtimestamp(end))
+        logger.info("Closed " + kind + " window: " + str(item))
+        statsWriter.put(item)
+        rollupIndex.addWindow(thingName, kind, start, end, summary)
+    return writeClosedWindow
+
+# Called when a corridor or district window closes
+def writeRollup(level, name, kind, start, end, summary):
+    item = summary.toItem()
+    item['Time'] = str(datetime.utcfromtimestamp(end)) + "#" + kind + "#" + level + ":" + name
+    item['Level'] = level
+    item['Node'] = name
+    item['WindowType'] = kind
+    item['WindowStart'] = str(datetime.utcfromtimestamp(start))
+    item['WindowEnd'] = str(datetime.utcfromtimestamp(end))
+    logger.info("Closed " + level + " rollup: " + str(item))
+    statsWriter.put(item)
+
+# Closed intersection windows are merged into corridor and district
+# aggregates (rollups.py). ROLLUP_HIERARCHY names a JSON file mapping
+# intersections to corridors and corridors to districts.
+rollupIndex = RollupIndex(loadHierarchy(os.environ.get('ROLLUP_HIERARCHY')), writeRollup)
+
+# Latency traces carried in reported states (latencyTrace.py) are recorded
+# per hop. Set METRICS_PORT to serve the histograms over HTTP, or
+# METRICS_FILE to write them for a node_exporter textfile collector on every
+# sweep below.
+traceMetrics = LatencyMetrics("carAggregator")
+METRICS_FILE = os.environ.get('METRICS_FILE')
+if os.environ.get('METRICS_PORT'):
+    serveMetrics(traceMetrics, int(os.environ['METRICS_PORT']))
+
+# Records the last hops of the trace in a reported document. The shadow
+# merges updates, so a report without a trace leaves the previous one in
+# place; a trace is only counted when its id differs from the previous document's.
+def recordTrace(event, now):
+    try:
+        trace = event["current"]["state"]["reported"]["trace"]
+        traceId = trace["id"]
+    except (KeyError, TypeError):
+        return
+    try:
+        previousId = event["previous"]["state"]["reported"]["trace"]["id"]
+    except (KeyError, TypeError):
+        previousId = None
+    if traceId == previousId:
+        return
+    trace = dict(trace, aggregated=now)
+    traceMetrics.observe(REPORT_TO_AGGREGATOR, elapsed(trace, "reported", "aggregated"))
+    traceMetrics.observe(END_TO_END, elapsed(trace, "issued", "aggregated"))
+
+# Intersections that stop reporting still need their windows closed, so
+# every SWEEP_INTERVAL seconds all of them are advanced. This is kept below
+# the rollup grace period so quiet intersections still make their rollups.
+SWEEP_INTERVAL = 15
+lastSweep = time.time()
+
+def sweepWindows(now):
+    global lastSweep
+    if now - lastSweep < SWEEP_INTERVAL:
+        return
+    lastSweep = now
+    for state in intersections:
+        state.tumblingWindow.advance(now)
+        state.slidingWindow.advance(now)
+    if METRICS_FILE:
+        traceMetrics.writeTextfile(METRICS_FILE)
+
+# Attaches the windows to an intersection the first time it is seen
+def initIntersection(state):
+    onClose = closedWindowWriter(state.thingName)
+    state.tumblingWindow = TumblingWindow(TUMBLING_WINDOW_SECONDS, onClose)
+    state.slidingWindow = SlidingWindow(SLIDING_WINDOW_SECONDS, SLIDING_WINDOW_STEP_SECONDS, onClose)
+
+# This is a long lived lambda so we can keep state as below.
+# Stats are kept per traffic light, keyed by the shadow's thing name.
+intersections = IntersectionStore(initIntersection)
+
+# Detection events from every intersection go into one set of NumPy ring
+# buffers and are reduced in micro-batches (vehicleEvents.py)
+vehicleEvents = VehicleEventIngestor()
+
+# Updates the stats of one traffic light after a green light has ended
+#    the minimum and maximum cars passing during a green light are tracked
+#    the total number of cars passing during all green lights are tracked
+#    the count is added to the tumbling and sliding windows
+# On every 3rd Green light these stats are queued for the CarStats dynamodb table
+# using a timestamp and the thing name as the hash key
+def recordGreenlight(state, cars, now):
+    state.recordGreenlight(cars)
+    state.tumblingWindow.add(cars, now)
+    state.slidingWindow.add(cars, now)
+
+    logger.info("Cars passed during green light: " + str(cars))
+    logger.info("Total Traffic: " + str(state.totalTraffic))
+    logger.info("Total Greenlights: " + str(state.totalGreenlights))
+    logger.info("Minimum Cars passing: " + str(state.minCars))
+    logger.info("Maximum Cars passing: " + str(state.maxCars))
+    logger.info("p95 cars per green (last " + str(SLIDING_WINDOW_SECONDS) + "s): " + str(state.slidingWindow.summary().quantile(0.95)))
+
+    # queue car stats for dynamodb every 3 green lights
+    if state.totalGreenlights % 3 == 0:
+        statsWriter.put({
+            'Time':str(datetime.utcnow()) + "#" + state.thingName,
+            'Intersection':state.thingName,
+            'TotalTraffic':state.totalTraffic,
+            'TotalGreenlights':state.totalGreenlights,
+            'MinCarsPassing':state.minCars,
+            'MaxCarsPassing':state.maxCars,
+        })
+        logger.info("Stats writer: " + str(statsWriter.stats()))
 
 # This handler is called when an event is sent via MQTT
 # Event targets are set in subscriptions settings
-# This should be set up to listen to shadow document updates
+# This should be set up to listen to shadow document updates and, optionally,
+# to a topic carrying vehicle detection events (see vehicleEvents.py)
 # This function gets traffic light updates from the shadow MQTT event
-# On every Green light it does the following:
-#    passing cars are simulated by a random number 1 <= n <= 20
-#    the minimum and maximum cars passing during a green light are tracked
-#    the total number of cars passing during all green lights are tracked
-# On every 3rd Green light these stats are sent to CarStats dynamodb table
-# using a timestamp as the hash key
+# The thing name is taken from the shadow topic the event arrived on
+# If the traffic light has a detection feed, the cars counted while it was
+# green are recorded when the light leaves green.
+# Otherwise, on every Green light passing cars are simulated by a random
+# number 1 <= n <= 20.
 def function_handler(event, context):
-    global totalTraffic
-    global totalGreenlights
-    global minCars
-    global maxCars
-    
+    now = time.time()
+    thingName = thingNameFromEvent(event, context)
+    state = intersections.get(thingName)
+
+    # vehicle detections are only buffered here; they are counted in batches
+    if "detections" in event:
+        vehicleEvents.ingest(state.index, event["detections"])
+        return
+
     # grab the light status from the event
     # Shadow JSON schema:
     # { "state": { "desired": { "property":<R,G,Y> } } }
     logger.info(event)
-    lightValue = event["current"]["state"]["reported"]["property"]
-    logger.info("reported light state: " + lightValue)
-    if lightValue == 'G':
+    state.tumblingWindow.advance(now)
+    state.slidingWindow.advance(now)
+    sweepWindows(now)
+    rollupIndex.advance(now)
+    try:
+        lightValue = validateDocument(event.get("current"), 'reported')
+    except ShadowSchemaError as e:
+        logger.error(thingName + " sent an invalid shadow document: " + str(e))
+        return
+    logger.info(thingName + " reported light state: " + lightValue)
+    recordTrace(event, now)
+    previousValue = vehicleEvents.setPhase(state.index, lightValue, now)
+
+    if vehicleEvents.detectionsEnabled(state.index):
+        if previousValue == 'G' and lightValue != 'G':
+            cars, meanSpeed = vehicleEvents.takePhaseCount(state.index, 'G')
+            logger.info("Green light ended, mean speed: " + str(round(meanSpeed, 1)))
+            recordGreenlight(state, cars, now)
+    elif lightValue == 'G':
         logger.info("Green light")
 
         # generate a random number of cars passing during this green light
         cars = randint(1, 20)
-
-        # update stats
-        totalTraffic += cars
-        totalGreenlights+=1
-        if cars < minCars or minCars == -1:
-            minCars = cars
-        if cars > maxCars:
-            maxCars = cars
-
-        logger.info("Cars passed during green light: " + str(cars))
-        logger.info("Total Traffic: " + str(totalTraffic))
-        logger.info("Total Greenlights: " + str(totalGreenlights))
-        logger.info("Minimum Cars passing: " + str(minCars))
-        logger.info("Maximum Cars passing: " + str(maxCars))
-
-        # update car stats to dynamodb every 3 green lights
-        if totalGreenlights % 3 == 0:
-            global tableName
-            table = dynamodb.Table(tableName)
-            table.put_item(
-                Item={
-                    'Time':str(datetime.utcnow()),
-                    'TotalTraffic':totalTraffic,
-                    'TotalGreenlights':totalGreenlights,
-                    'MinCarsPassing':minCars,
-                    'MaxCarsPassing':maxCars,
-                }
-            )
-    return
\ No newline at end of file
+        recordGreenlight(state, cars, now)
+    return
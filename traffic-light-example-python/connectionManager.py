@@ -0,0 +1,218 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+
+# connectionManager.py
+# One MQTT connection shared by the shadow handlers of many things, for
+# gateways that front many lights (lightController.py, trafficLight.py).
+#
+# Instead of subscribing to accepted/rejected/delta topics per thing, the
+# manager subscribes once to the wildcard topics
+#
+#   $aws/things/+/shadow/+/accepted
+#   $aws/things/+/shadow/+/rejected
+#   $aws/things/+/shadow/update/delta
+#
+# and fans incoming messages out locally: deltas by the thing name in the
+# topic, responses by the clientToken of the request they answer. The
+# Greengrass group subscriptions (or the IoT policy) must allow these
+# wildcard topics.
+#
+# createShadowHandlerWithName() returns a SharedShadowHandler with the same
+# shadowUpdate/shadowGet/shadowRegisterDeltaCallback interface and callback
+# signatures as the SDK's deviceShadow, so it can be used in its place.
+# A request whose response has not arrived after its timeout gets a
+# "timeout" callback, as from the SDK; a late response to it is ignored.
+
+import binascii
+import heapq
+import logging
+import os
+import re
+import threading
+import time
+
+SHADOW_TOPIC = "$aws/things/{0}/shadow/{1}"
+SUBSCRIPTIONS = (
+    "$aws/things/+/shadow/+/accepted",
+    "$aws/things/+/shadow/+/rejected",
+    "$aws/things/+/shadow/update/delta",
+)
+
+_CLIENT_TOKEN_RE = re.compile(r'"clientToken"\s*:\s*"([^"\\]*)"')
+
+logger = logging.getLogger(__name__)
+
+
+# Adds "clientToken" to a JSON object without parsing it
+def withClientToken(payload, token):
+    body = payload.rstrip() if payload else "{}"
+    if not body.endswith("}"):
+        raise ValueError("Shadow payload is not a JSON object")
+    head = body[:-1].rstrip()
+    separator = "" if head.endswith("{") else ","
+    return head + separator + '"clientToken":"' + token + '"}'
+
+
+class _Request(object):
+    __slots__ = ('thingName', 'action', 'callback', 'deadline')
+
+    def __init__(self, thingName, action, callback, deadline):
+        self.thingName = thingName
+        self.action = action
+        self.callback = callback
+        self.deadline = deadline
+
+
+class SharedShadowHandler(object):
+
+    def __init__(self, manager, thingName):
+        self._manager = manager
+        self.thingName = thingName
+        self.deltaCallback = None
+
+    def shadowUpdate(self, srcJSONPayload, srcCallback, srcTimeout):
+        return self._manager.request(self.thingName, "update", srcJSONPayload, srcCallback, srcTimeout)
+
+    def shadowGet(self, srcCallback, srcTimeout):
+        return self._manager.request(self.thingName, "get", "{}", srcCallback, srcTimeout)
+
+    def shadowRegisterDeltaCallback(self, srcCallback):
+        self.deltaCallback = srcCallback
+
+    def shadowUnregisterDeltaCallback(self):
+        self.deltaCallback = None
+
+
+class ShadowConnectionManager(object):
+
+    # mqttClient is a connected AWSIoTMQTTClient (or the MQTT client of an
+    # AWSIoTMQTTShadowClient, getMQTTConnection())
+    def __init__(self, mqttClient, tokenPrefix=None, qos=0):
+        self._client = mqttClient
+        self._qos = qos
+        if tokenPrefix is None:
+            tokenPrefix = binascii.hexlify(os.urandom(4)).decode("ascii")
+        self._tokenPrefix = tokenPrefix
+        self._tokenCount = 0
+        self._handlers = {}
+        self._pending = {}          # clientToken -> _Request
+        self._deadlines = []        # (deadline, clientToken)
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+
+        # counters exposed through stats()
+        self.requests = 0
+        self.responses = 0
+        self.deltas = 0
+        self.timeouts = 0
+        self.unmatched = 0
+
+    # Subscribes to the wildcard topics and starts the timeout thread
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        for topic in SUBSCRIPTIONS:
+            self._client.subscribe(topic, 1, self._onMessage)
+        self._thread = threading.Thread(target=self._expire, name="ShadowConnectionManager")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        for topic in SUBSCRIPTIONS:
+            self._client.unsubscribe(topic)
+
+    # isPersistentSubscribe is accepted for compatibility; the wildcard
+    # subscriptions are always persistent
+    def createShadowHandlerWithName(self, shadowName, isPersistentSubscribe=True):
+        with self._cond:
+            handler = self._handlers.get(shadowName)
+            if handler is None:
+                handler = SharedShadowHandler(self, shadowName)
+                self._handlers[shadowName] = handler
+            return handler
+
+    # Publishes a shadow request and returns its clientToken
+    def request(self, thingName, action, payload, callback, timeout):
+        with self._cond:
+            self._tokenCount += 1
+            token = self._tokenPrefix + "-" + str(self._tokenCount)
+            deadline = time.time() + timeout
+            self._pending[token] = _Request(thingName, action, callback, deadline)
+            heapq.heappush(self._deadlines, (deadline, token))
+            self.requests += 1
+            self._cond.notify()
+        self._client.publish(SHADOW_TOPIC.format(thingName, action), withClientToken(payload, token), self._qos)
+        return token
+
+    def stats(self):
+        with self._cond:
+            return {
+                'handlers': len(self._handlers),
+                'requests': self.requests,
+                'responses': self.responses,
+                'deltas': self.deltas,
+                'timeouts': self.timeouts,
+                'unmatched': self.unmatched,
+                'pending': len(self._pending),
+            }
+
+    # Called on the MQTT client thread for every message on a wildcard topic
+    def _onMessage(self, client, userdata, message):
+        # $aws/things/<thingName>/shadow/<action>/<status>
+        parts = message.topic.split("/")
+        if len(parts) != 6:
+            return
+        thingName, status = parts[2], parts[5]
+        payload = message.payload
+        if isinstance(payload, bytes):
+            payload = payload.decode("utf-8")
+
+        if status == "delta":
+            with self._cond:
+                handler = self._handlers.get(thingName)
+                self.deltas += 1
+            if handler is not None and handler.deltaCallback is not None:
+                handler.deltaCallback(payload, "delta/" + thingName, None)
+            return
+
+        match = _CLIENT_TOKEN_RE.search(payload)
+        with self._cond:
+            request = self._pending.pop(match.group(1), None) if match else None
+            if request is None:
+                # another client's request, or one that already timed out
+                self.unmatched += 1
+                return
+            self.responses += 1
+        if request.callback is not None:
+            request.callback(payload, status, match.group(1))
+
+    def _expire(self):
+        while True:
+            expired = []
+            with self._cond:
+                while self._running:
+                    now = time.time()
+                    while self._deadlines and self._deadlines[0][0] <= now:
+                        deadline, token = heapq.heappop(self._deadlines)
+                        request = self._pending.pop(token, None)
+                        if request is not None:
+                            self.timeouts += 1
+                            expired.append((token, request))
+                    if expired:
+                        break
+                    self._cond.wait(self._deadlines[0][0] - now if self._deadlines else None)
+                if not self._running:
+                    return
+            for token, request in expired:
+                if request.callback is not None:
+                    try:
+                        request.callback("REQUEST TIME OUT", "timeout", token)
+                    except Exception:
+                        logger.exception("Timeout callback for " + token + " failed")
@@ -0,0 +1,179 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+
+# deltaDispatcher.py
+# Shadow delta dispatch used by trafficLight.py. The SDK calls the delta
+# callback on its MQTT client thread; if that callback publishes the reported
+# state itself, the thread stalls whenever updates are acknowledged slower
+# than deltas arrive, and further deltas pile up inside the SDK.
+#
+# Instead the callback hands the delta to submit(), which only extracts its
+# version and property (shadowCodec.parseDelta) and files it under its thing
+# name. A worker thread applies the pending deltas.
+# Per thing, only the delta with the highest version is kept: a delta that
+# arrives while an older one is still pending replaces it (coalesced), and a
+# delta whose version is not newer than the last one applied is dropped
+# (stale). The light ends up in the newest desired state without replaying
+# every state it was asked to pass through on the way.
+#
+# A delta that carries a latency trace (latencyTrace.py) gets the time it was
+# received added to the trace as "delta", and the trace is passed on to apply.
+
+import logging
+import threading
+import time
+from collections import deque
+
+from shadowCodec import ShadowSchemaError, parseDelta, parseTrace
+
+logger = logging.getLogger(__name__)
+
+
+# Thing name from the status the SDK passes to a delta callback ("delta/<thingName>")
+def thingNameFromStatus(responseStatus, default="Bot"):
+    if responseStatus and "/" in responseStatus:
+        return responseStatus.split("/", 1)[1]
+    return default
+
+
+class DeltaDispatcher(object):
+
+    # apply(thingName, version, property, trace) is called on the worker
+    # thread with the light state of the newest delta and its trace (or None)
+    def __init__(self, apply):
+        self._apply = apply
+        self._cond = threading.Condition()
+        self._pending = {}          # thingName -> (version, property, trace), not yet applied
+        self._ready = deque()       # thing names with a pending delta, oldest first
+        self._applied = {}          # thingName -> last version applied
+        self._thread = None
+        self._running = False
+
+        # counters exposed through stats()
+        self.received = 0
+        self.coalesced = 0
+        self.stale = 0
+        self.applied = 0
+        self.failed = 0
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name="DeltaDispatcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    # Seed the last applied version of a thing, e.g. from a state cache, so
+    # deltas that are not newer than it are dropped
+    def setVersion(self, thingName, version):
+        with self._cond:
+            if version > self._applied.get(thingName, -1):
+                self._applied[thingName] = version
+
+    # Forget the last applied version, e.g. after the shadow was deleted and
+    # its version numbers started over
+    def forgetVersion(self, thingName):
+        with self._cond:
+            self._applied.pop(thingName, None)
+
+    def lastVersion(self, thingName):
+        with self._cond:
+            return self._applied.get(thingName)
+
+    # Called on the MQTT client thread. Never blocks on the network.
+    def submit(self, thingName, payload):
+        if isinstance(payload, bytes):
+            payload = payload.decode("utf-8")
+        try:
+            version, state = parseDelta(payload)
+        except ShadowSchemaError as e:
+            logger.error("Ignoring delta for " + thingName + ": " + str(e))
+            return
+        trace = None
+        if '"trace"' in payload:
+            trace = parseTrace(payload)
+            if trace is not None:
+                trace["delta"] = round(time.time(), 3)
+        self.offer(thingName, version, state, trace)
+
+    # Queues an already parsed delta, e.g. one found when reconciling with
+    # the shadow document
+    def offer(self, thingName, version, state, trace=None):
+        with self._cond:
+            self.received += 1
+            if version <= self._applied.get(thingName, -1):
+                self.stale += 1
+                return
+            pending = self._pending.get(thingName)
+            if pending is not None:
+                if version <= pending[0]:
+                    self.stale += 1
+                    return
+                self.coalesced += 1
+            else:
+                self._ready.append(thingName)
+            self._pending[thingName] = (version, state, trace)
+            self._cond.notify()
+
+    # Callback with the SDK's delta callback signature
+    def onDelta(self, payload, responseStatus, token):
+        self.submit(thingNameFromStatus(responseStatus), payload)
+
+    def pendingCount(self):
+        with self._cond:
+            return len(self._pending)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'received': self.received,
+                'coalesced': self.coalesced,
+                'stale': self.stale,
+                'applied': self.applied,
+                'failed': self.failed,
+                'pending': len(self._pending),
+            }
+
+    # Applies everything that is pending right now, on the calling thread
+    def drain(self):
+        while self._applyNext():
+            pass
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._ready:
+                    self._cond.wait()
+                if not self._running:
+                    return
+            self._applyNext()
+
+    def _applyNext(self):
+        with self._cond:
+            if not self._ready:
+                return False
+            thingName = self._ready.popleft()
+            version, state, trace = self._pending.pop(thingName)
+            # recorded up front so older deltas arriving meanwhile are dropped
+            self._applied[thingName] = version
+        try:
+            self._apply(thingName, version, state, trace)
+        except Exception:
+            logger.exception("Applying delta version " + str(version) + " for " + thingName + " failed")
+            with self._cond:
+                self.failed += 1
+            return True
+        with self._cond:
+            self.applied += 1
+        return True
@@ -0,0 +1,166 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+
+# desiredPublisher.py
+# Desired-state publishing for lightController.py.
+#
+# request(thingName, state) only records what a thing should be set to;
+# flush() sends everything requested since the last flush in one burst,
+# so all things that change in the same scheduler tick go out back to back.
+# Per thing the publisher remembers the last state the shadow accepted and
+# the update that is still in flight:
+#
+#   - a state equal to the last accepted one is not sent at all (unchanged)
+#   - while an update is in flight no second one is sent for the same thing;
+#     the newest request waits and is sent once the first is answered, and
+#     any request it replaced is counted as coalesced
+#   - a rejected or timed out update forgets the accepted state, so the next
+#     request is always sent
+#
+# A slow core therefore never has more than one update per thing waiting on it.
+#
+# Given a latencyTrace.LatencyMetrics, every update carries a new trace and
+# the time until it is accepted is recorded as the desired_accepted hop.
+
+import logging
+import threading
+import time
+
+from latencyTrace import DESIRED_ACCEPTED, newTrace
+from shadowCodec import desiredPayload
+
+logger = logging.getLogger(__name__)
+
+
+class _InFlight(object):
+    __slots__ = ('state', 'token', 'trace')
+
+    def __init__(self, state, trace):
+        self.state = state
+        self.token = None   # unknown until shadowUpdate returns
+        self.trace = trace
+
+
+class DesiredStatePublisher(object):
+
+    # handlers maps thing names to deviceShadow handlers. callback, if given,
+    # is called like a shadowUpdate callback after every response.
+    def __init__(self, handlers, timeout=5, callback=None, metrics=None):
+        self._handlers = handlers
+        self._metrics = metrics
+        self.timeout = timeout
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._requested = {}    # thingName -> state, waiting for the next flush
+        self._accepted = {}     # thingName -> last state the shadow accepted
+        self._inFlight = {}     # thingName -> _InFlight
+        self._next = {}         # thingName -> state to send once the in-flight update is answered
+
+        # counters exposed through stats()
+        self.requests = 0
+        self.sent = 0
+        self.unchanged = 0
+        self.coalesced = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.timedOut = 0
+        self.bursts = 0
+
+    def request(self, thingName, state):
+        with self._lock:
+            self.requests += 1
+            if thingName in self._requested:
+                self.coalesced += 1
+            self._requested[thingName] = state
+
+    # Sends everything requested since the last flush. Returns the number of
+    # updates sent.
+    def flush(self):
+        with self._lock:
+            requested, self._requested = self._requested, {}
+            burst = []
+            for thingName, state in requested.items():
+                if thingName in self._inFlight:
+                    if thingName in self._next:
+                        self.coalesced += 1
+                    self._next[thingName] = state
+                elif self._accepted.get(thingName) == state:
+                    self.unchanged += 1
+                else:
+                    burst.append(self._startLocked(thingName, state))
+            if burst:
+                self.bursts += 1
+        for thingName, inFlight in burst:
+            self._send(thingName, inFlight)
+        return len(burst)
+
+    def acceptedState(self, thingName):
+        with self._lock:
+            return self._accepted.get(thingName)
+
+    def inFlightCount(self):
+        with self._lock:
+            return len(self._inFlight)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'sent': self.sent,
+                'unchanged': self.unchanged,
+                'coalesced': self.coalesced,
+                'accepted': self.accepted,
+                'rejected': self.rejected,
+                'timedOut': self.timedOut,
+                'bursts': self.bursts,
+                'inFlight': len(self._inFlight),
+            }
+
+    def _startLocked(self, thingName, state):
+        inFlight = _InFlight(state, newTrace() if self._metrics is not None else None)
+        self._inFlight[thingName] = inFlight
+        self.sent += 1
+        return thingName, inFlight
+
+    def _send(self, thingName, inFlight):
+        def callback(payload, responseStatus, token):
+            self._answered(thingName, inFlight, payload, responseStatus, token)
+        try:
+            token = self._handlers[thingName].shadowUpdate(desiredPayload(inFlight.state, inFlight.trace),
+                                                             callback, self.timeout)
+        except Exception:
+            logger.exception("Desired state update for " + thingName + " failed")
+            self._answered(thingName, inFlight, None, "rejected", None)
+            return
+        # the response may already have arrived (and cleared inFlight)
+        with self._lock:
+            inFlight.token = token
+
+    def _answered(self, thingName, inFlight, payload, responseStatus, token):
+        resend = None
+        with self._lock:
+            if self._inFlight.get(thingName) is not inFlight:
+                return      # an answer to an update that was already given up on
+            del self._inFlight[thingName]
+            if responseStatus == "accepted":
+                self.accepted += 1
+                if inFlight.trace is not None:
+                    self._metrics.observe(DESIRED_ACCEPTED, time.time() - inFlight.trace["issued"])
+                self._accepted[thingName] = inFlight.state
+            else:
+                if responseStatus == "timeout":
+                    self.timedOut += 1
+                else:
+                    self.rejected += 1
+                self._accepted.pop(thingName, None)
+            nextState = self._next.pop(thingName, None)
+            if nextState is not None:
+                if self._accepted.get(thingName) == nextState:
+                    self.unchanged += 1
+                else:
+                    resend = self._startLocked(thingName, nextState)
+        if self._callback is not None and payload is not None:
+            self._callback(payload, responseStatus, token)
+        if resend is not None:
+            self._send(*resend)
@@ -0,0 +1,277 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+
+# dynamoWriter.py
+# Background DynamoDB writer used by carAggregator.py. Instead of calling
+# put_item from inside the shadow callback, the aggregator hands records to
+# this writer, which queues them in memory and flushes them with BatchWriteItem
+# from a worker thread. A flush happens when MAX_BATCH_SIZE records are queued
+# or when the oldest queued record has waited MAX_BATCH_AGE seconds.
+# Items that DynamoDB returns as unprocessed (throttling, partial failures)
+# are retried with exponential backoff.
+#
+# An optional gate (see tableProvisioner.py) holds flushes back until the
+# table exists. Records keep queueing in the meantime, so callers never block
+# while the table is being created.
+#
+# Records are held in a buffer. By default that is a MemoryBuffer; pass a
+# RecordSpool (recordSpool.py) instead and records survive restarts and
+# cloud outages. A durable buffer never drops a batch after MAX_RETRIES: it
+# keeps the records on disk and retries until DynamoDB is reachable again.
+#
+# The writer only needs an object with a batch_write_item method, so it works
+# with a boto3 DynamoDB resource pointed at DynamoDB Local, e.g.
+#   boto3.resource('dynamodb', endpoint_url='http://localhost:8000')
+
+import itertools
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+from botocore.exceptions import ClientError
+
+MAX_BATCH_SIZE = 25       # BatchWriteItem accepts at most 25 put requests
+MAX_BATCH_AGE = 5.0       # seconds a record may wait before a flush is forced
+MAX_QUEUE_SIZE = 10000    # records held in memory before the oldest are dropped
+MAX_RETRIES = 8           # attempts per batch before giving up on it
+BACKOFF_BASE = 0.05       # seconds, doubled on every retry
+BACKOFF_MAX = 5.0         # upper bound for a single backoff sleep
+OUTAGE_RETRY_DELAY = 30   # seconds before a durable buffer retries a failed batch
+
+# _writeBatch results
+WRITTEN = "written"
+FAILED = "failed"
+TABLE_MISSING = "tableMissing"
+
+logger = logging.getLogger(__name__)
+
+
+# Full-jitter exponential backoff, as recommended for DynamoDB retries
+def backoffDelay(attempt):
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+
+# In-memory record buffer. Once maxSize records are waiting, the oldest ones
+# are dropped. Same peek/commit interface as recordSpool.RecordSpool.
+class MemoryBuffer(object):
+    durable = False
+
+    def __init__(self, maxSize=MAX_QUEUE_SIZE):
+        self.maxSize = maxSize
+        self.droppedRecords = 0
+        self._queue = deque()    # entries are (enqueue time, item)
+        self._head = 0           # number of records ever removed from the front
+        self._lock = threading.Lock()
+
+    def append(self, item):
+        with self._lock:
+            if len(self._queue) >= self.maxSize:
+                self._queue.popleft()
+                self._head += 1
+                self.droppedRecords += 1
+            self._queue.append((time.time(), item))
+
+    def peek(self, n):
+        with self._lock:
+            items = [entry[1] for entry in itertools.islice(self._queue, n)]
+            return items, (self._head, len(items))
+
+    def commit(self, token):
+        head, count = token
+        with self._lock:
+            # skip anything dropped from the front since peek()
+            for _ in range(max(0, head + count - self._head)):
+                self._queue.popleft()
+                self._head += 1
+
+    def oldestTime(self):
+        with self._lock:
+            return self._queue[0][0] if self._queue else None
+
+    def maybeSync(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __len__(self):
+        return len(self._queue)
+
+
+class BufferedTableWriter(object):
+
+    # gate needs isReady(), waitReady(timeout) and invalidate()
+    def __init__(self, dynamodb, tableName, maxBatchSize=MAX_BATCH_SIZE,
+                 maxBatchAge=MAX_BATCH_AGE, buffer=None, gate=None):
+        self._dynamodb = dynamodb
+        self._gate = gate
+        self._buffer = buffer if buffer is not None else MemoryBuffer()
+        self.tableName = tableName
+        self.maxBatchSize = maxBatchSize
+        self.maxBatchAge = maxBatchAge
+
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        self._stopped = False
+        self._retryAfter = 0.0   # set while DynamoDB is unreachable
+
+        # counters exposed through stats()
+        self.flushCount = 0
+        self.itemsWritten = 0
+        self.itemsDropped = 0
+        self.retryCount = 0
+        self.lastFlushLatency = 0.0
+        self.maxFlushLatency = 0.0
+        self._totalFlushLatency = 0.0
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name="BufferedTableWriter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Stops the worker thread. Anything still buffered gets one more attempt;
+    # a durable buffer keeps whatever could not be written.
+    def stop(self, timeout=None):
+        with self._cond:
+            if self._stopped:
+                return
+            self._stopped = True
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+        self._buffer.close()
+
+    # Buffer a single item for writing. Never blocks on the network.
+    def put(self, item):
+        self._buffer.append(item)
+        if len(self._buffer) >= self.maxBatchSize:
+            with self._cond:
+                self._cond.notify()
+
+    # Synchronously write everything that is currently buffered. Nothing is
+    # written while the gate is closed.
+    def flush(self):
+        if self._gate is not None and not self._gate.isReady():
+            return
+        while len(self._buffer):
+            if not self._writeNext():
+                return
+
+    def queueDepth(self):
+        return len(self._buffer)
+
+    def stats(self):
+        avgLatency = 0.0
+        if self.flushCount:
+            avgLatency = self._totalFlushLatency / self.flushCount
+        return {
+            'queueDepth': len(self._buffer),
+            'flushCount': self.flushCount,
+            'itemsWritten': self.itemsWritten,
+            'itemsDropped': self.itemsDropped + self._buffer.droppedRecords,
+            'retryCount': self.retryCount,
+            'lastFlushLatency': self.lastFlushLatency,
+            'avgFlushLatency': avgLatency,
+            'maxFlushLatency': self.maxFlushLatency,
+        }
+
+    # Seconds until the next batch is due, 0 if it is due now, None if the
+    # buffer is empty
+    def _timeUntilDue(self):
+        if not len(self._buffer):
+            return None
+        if time.time() < self._retryAfter:
+            return max(0.0, self._retryAfter - time.time())
+        if len(self._buffer) >= self.maxBatchSize:
+            return 0
+        oldest = self._buffer.oldestTime()
+        if oldest is None:
+            return None
+        return max(0.0, self.maxBatchAge - (time.time() - oldest))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+                wait = self._timeUntilDue()
+                if wait != 0:
+                    # wake up at least once a second so the buffer gets synced
+                    self._cond.wait(1.0 if wait is None else min(wait, 1.0))
+            # outside the condition, so put() never waits for an fsync
+            self._buffer.maybeSync()
+            if wait != 0:
+                continue
+            if self._gate is not None and not self._gate.waitReady(self.maxBatchAge):
+                continue
+            if not self._writeNext():
+                # DynamoDB is unreachable; the durable buffer keeps the records
+                self._retryAfter = time.time() + OUTAGE_RETRY_DELAY
+
+    # Writes the batch at the head of the buffer. Returns False if the batch
+    # is still in the buffer and should be retried later.
+    def _writeNext(self):
+        items, token = self._buffer.peek(self.maxBatchSize)
+        if not items:
+            return False
+        result = self._writeBatch(items)
+        if result == TABLE_MISSING:
+            self._gate.invalidate()
+            return False
+        if result == FAILED:
+            if self._buffer.durable:
+                return False
+            logger.error("Dropping " + str(len(items)) + " items after " + str(MAX_RETRIES) + " retries")
+            self.itemsDropped += len(items)
+        self._buffer.commit(token)
+        return True
+
+    # Writes one batch, retrying unprocessed items and errors with backoff.
+    def _writeBatch(self, items):
+        requests = [{'PutRequest': {'Item': item}} for item in items]
+        start = time.time()
+        attempt = 0
+        result = WRITTEN
+        while True:
+            try:
+                response = self._dynamodb.batch_write_item(RequestItems={self.tableName: requests})
+                unprocessed = response.get('UnprocessedItems', {}).get(self.tableName, [])
+            except ClientError as e:
+                logger.warning("Batch write to " + self.tableName + " failed: " + str(e))
+                if e.response['Error']['Code'] == 'ResourceNotFoundException' and self._gate is not None:
+                    # the table vanished; keep the batch until it is recreated
+                    result = TABLE_MISSING
+                    break
+                unprocessed = requests
+            except Exception as e:
+                logger.warning("Batch write to " + self.tableName + " failed: " + str(e))
+                unprocessed = requests
+            self.itemsWritten += len(requests) - len(unprocessed)
+            requests = unprocessed
+            if not requests:
+                break
+            attempt += 1
+            if attempt > MAX_RETRIES:
+                result = FAILED
+                break
+            self.retryCount += 1
+            time.sleep(backoffDelay(attempt))
+
+        latency = time.time() - start
+        self.flushCount += 1
+        self.lastFlushLatency = latency
+        self._totalFlushLatency += latency
+        if latency > self.maxFlushLatency:
+            self.maxFlushLatency = latency
+        return result
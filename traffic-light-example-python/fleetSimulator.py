@@ -0,0 +1,218 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# This Greengrass example runs a whole fleet of simulated traffic lights in one process, for load testing a core
+# (or a local MQTT broker) without starting one trafficLight.py process per device.
+#
+# This file is meant to be used in conjunction with lightController.py and needs Python 3.
+# It needs the shared helper modules (ggDiscovery.py, ...) from this directory.
+
+# Each virtual light is an asyncio task in a single event loop. All of them share one MQTT connection, which
+# subscribes once to the delta topic of every shadow ($aws/things/+/shadow/update/delta). Incoming deltas are
+# routed to the owning light's queue by thing name. A light handles a delta the same way trafficLight.py does:
+# it reports the new property back to its shadow.
+#
+# With --cycle the simulator also acts as the controller and sets a new desired state on every light every
+# --cycle seconds, so the whole loop can be load tested with no other processes.
+# Per-device and aggregate message rates are printed every --report seconds.
+#
+# Example, 2000 lights against a local broker:
+#   python fleetSimulator.py -e localhost -p 8883 -r root-ca.crt -c cert.pem -k key.pem --lights 2000 --cycle 20
+# Or discover the core instead of naming it:
+#   python fleetSimulator.py -e <iot endpoint> -r AmazonRootCA1.pem -c cert.pem -k key.pem --discover --lights 2000
+
+import argparse
+import asyncio
+import logging
+import time
+from itertools import cycle
+
+from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
+
+from ggDiscovery import connectShadowClient, DISCOVERY_TTL
+from shadowCodec import STATES, ShadowSchemaError, desiredPayload, parseDelta, reportedPayload
+
+DELTA_TOPIC = "$aws/things/+/shadow/update/delta"
+
+
+class DeviceCounters(object):
+    __slots__ = ('deltas', 'reports', 'acks', 'desired')
+
+    def __init__(self):
+        self.deltas = 0     # deltas received
+        self.reports = 0    # reported-state updates published
+        self.acks = 0       # publishes acknowledged by the broker
+        self.desired = 0    # desired-state updates published (--cycle)
+
+    def snapshot(self):
+        return {'deltas': self.deltas, 'reports': self.reports, 'acks': self.acks, 'desired': self.desired}
+
+
+class VirtualLight(object):
+
+    def __init__(self, fleet, thingName):
+        self.fleet = fleet
+        self.thingName = thingName
+        self.updateTopic = "$aws/things/" + thingName + "/shadow/update"
+        self.queue = asyncio.Queue()
+        self.counters = DeviceCounters()
+        self.light = None
+
+    # Same behaviour as customShadowCallback_Delta in trafficLight.py
+    async def run(self):
+        while True:
+            payload = await self.queue.get()
+            self.counters.deltas += 1
+            try:
+                version, self.light = parseDelta(payload)
+            except ShadowSchemaError:
+                continue
+            self.fleet.publish(self.updateTopic, reportedPayload(self.light), self)
+            self.counters.reports += 1
+
+
+class Fleet(object):
+
+    def __init__(self, loop, client, thingNames):
+        self.loop = loop
+        self.client = client
+        self.lights = dict((name, VirtualLight(self, name)) for name in thingNames)
+        self.unknownDeltas = 0
+        self.started = time.time()
+
+    # Called on the MQTT client's thread; hand the message over to the loop
+    def onDelta(self, client, userdata, message):
+        self.loop.call_soon_threadsafe(self._route, message.topic, message.payload)
+
+    def _route(self, topic, payload):
+        # $aws/things/<thingName>/shadow/update/delta
+        light = self.lights.get(topic.split("/")[2])
+        if light is None:
+            self.unknownDeltas += 1
+            return
+        light.queue.put_nowait(payload)
+
+    # QoS 1 publish that never blocks the loop; the ack is counted on the loop
+    def publish(self, topic, payload, light):
+        def acked(mid):
+            self.loop.call_soon_threadsafe(self._acked, light)
+        self.client.publishAsync(topic, payload, 1, ackCallback=acked)
+
+    def _acked(self, light):
+        light.counters.acks += 1
+
+    # Controller mode: set every light's desired state every `period` seconds.
+    # Deadlines are absolute so the cycle doesn't drift.
+    async def drive(self, period):
+        deadline = self.loop.time()
+        for item in cycle(STATES):
+            payload = desiredPayload(item)
+            for light in self.lights.values():
+                self.publish(light.updateTopic, payload, light)
+                light.counters.desired += 1
+            deadline += period
+            await asyncio.sleep(max(0.0, deadline - self.loop.time()))
+
+    # Prints fleet and per-light rates over the last period. A light's
+    # updates/s counts the reported-state updates it published.
+    async def report(self, period, perDevice):
+        previous = self.snapshots()
+        previousTime = time.time()
+        while True:
+            await asyncio.sleep(period)
+            now = time.time()
+            snapshots = self.snapshots()
+            elapsed = now - previousTime
+            lightRates = dict((name, rates(previous.get(name), snapshot, elapsed))
+                              for name, snapshot in snapshots.items())
+            fleetRates = rates(totals(previous.values()), totals(snapshots.values()), elapsed)
+            print("[{:.0f}s] lights={} deltas/s={:.1f} reports/s={:.1f} acks/s={:.1f} desired/s={:.1f} unknown={}".format(
+                now - self.started, len(self.lights), fleetRates['deltas'], fleetRates['reports'], fleetRates['acks'],
+                fleetRates['desired'], self.unknownDeltas))
+            for key, label in (('deltas', 'deltas/s'), ('reports', 'updates/s')):
+                perLight = sorted((lightRate[key], name) for name, lightRate in lightRates.items())
+                if perLight:
+                    print("    per light {}: min={:.3f} ({}) max={:.3f} ({})".format(
+                        label, perLight[0][0], perLight[0][1], perLight[-1][0], perLight[-1][1]))
+            if perDevice:
+                for name, lightRate in sorted(lightRates.items()):
+                    print("    {} light={} deltas/s={:.3f} updates/s={:.3f} acks/s={:.3f}".format(
+                        name, self.lights[name].light, lightRate['deltas'], lightRate['reports'], lightRate['acks']))
+            previous, previousTime = snapshots, now
+
+    def snapshots(self):
+        return dict((name, light.counters.snapshot()) for name, light in self.lights.items())
+
+
+def totals(snapshots):
+    summed = {'deltas': 0, 'reports': 0, 'acks': 0, 'desired': 0}
+    for snapshot in snapshots:
+        for key in summed:
+            summed[key] += snapshot[key]
+    return summed
+
+
+# Per second rates between two counter snapshots (previous may be None)
+def rates(previous, current, elapsed):
+    return dict((key, (current[key] - (previous[key] if previous else 0)) / elapsed) for key in current)
+
+
+async def main(args):
+    loop = asyncio.get_running_loop()
+    thingNames = [args.prefix + "-" + str(i).zfill(4) for i in range(args.lights)]
+
+    client = AWSIoTMQTTClient(args.clientId)
+    client.configureAutoReconnectBackoffTime(1, 32, 20)
+    client.configureOfflinePublishQueueing(-1)  # never drop while reconnecting
+    client.configureConnectDisconnectTimeout(10)  # 10 sec
+    client.configureMQTTOperationTimeout(5)  # 5 sec
+    if args.discover:
+        connectShadowClient(client, args.host, args.rootCAPath, args.certificatePath, args.privateKeyPath,
+                            args.clientId, DISCOVERY_TTL)
+    else:
+        client.configureEndpoint(args.host, args.port)
+        client.configureCredentials(args.rootCAPath, args.privateKeyPath, args.certificatePath)
+        client.connect()
+
+    fleet = Fleet(loop, client, thingNames)
+    client.subscribe(DELTA_TOPIC, 1, fleet.onDelta)
+    print("Simulating " + str(len(thingNames)) + " traffic lights over one connection")
+
+    tasks = [loop.create_task(light.run()) for light in fleet.lights.values()]
+    tasks.append(loop.create_task(fleet.report(args.reportSeconds, args.perDevice)))
+    if args.cycleSeconds:
+        tasks.append(loop.create_task(fleet.drive(args.cycleSeconds)))
+    await asyncio.gather(*tasks)
+
+
+# Read in command-line parameters
+parser = argparse.ArgumentParser()
+parser.add_argument("-e", "--endpoint", action="store", required=True, dest="host",
+                    help="Broker/core host, or your AWS IoT custom endpoint with --discover")
+parser.add_argument("-p", "--port", action="store", dest="port", type=int, default=8883, help="Broker port")
+parser.add_argument("-r", "--rootCA", action="store", required=True, dest="rootCAPath", help="Root CA file path")
+parser.add_argument("-c", "--cert", action="store", dest="certificatePath", help="Certificate file path")
+parser.add_argument("-k", "--key", action="store", dest="privateKeyPath", help="Private key file path")
+parser.add_argument("-id", "--clientId", action="store", dest="clientId", default="fleetSimulator",
+                    help="Client id of the shared connection")
+parser.add_argument("--discover", action="store_true", help="Find the core with Greengrass discovery")
+parser.add_argument("--lights", action="store", dest="lights", type=int, default=100, help="Number of virtual lights")
+parser.add_argument("--prefix", action="store", dest="prefix", default="light", help="Thing name prefix")
+parser.add_argument("--cycle", action="store", dest="cycleSeconds", type=float, default=0,
+                    help="Also drive the lights' desired state every N seconds")
+parser.add_argument("--report", action="store", dest="reportSeconds", type=float, default=10,
+                    help="Seconds between rate reports")
+parser.add_argument("--perDevice", action="store_true", help="Print rates for every light")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    # Configure logging
+    logger = logging.getLogger("AWSIoTPythonSDK.core")
+    logger.setLevel(logging.WARNING)   # set to logging.DEBUG for additional logging
+    streamHandler = logging.StreamHandler()
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    streamHandler.setFormatter(formatter)
+    logger.addHandler(streamHandler)
+
+    asyncio.run(main(args))
@@ -0,0 +1,231 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+
+# ggDiscovery.py
+# Greengrass discovery shared by lightController.py and trafficLight.py.
+#
+# Discovery results are persisted in GROUP_PATH together with the time they
+# were fetched and a fingerprint of the group CA and core endpoints. A cached
+# result is reused until it is older than the TTL. Instead of trusting the
+# first address that looks like an IP, every advertised host/port pair is
+# probed concurrently and the reachable one with the lowest connect latency
+# is used.
+#
+# When the core's address has changed since the last discovery,
+# connectShadowClient() notices that the cached endpoint can't be reached,
+# runs discovery once and connects to the new address instead of sitting
+# through reconnect backoff cycles against a stale IP. This only covers
+# connecting: if the address changes while a client is connected, the SDK's
+# auto-reconnect keeps retrying the old endpoint, and only a restart of the
+# program discovers the new one.
+
+import hashlib
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+from AWSIoTPythonSDK.core.greengrass.discovery.providers import DiscoveryInfoProvider
+from AWSIoTPythonSDK.core.protocol.connection.cores import ProgressiveBackOffCore
+from AWSIoTPythonSDK.exception.AWSIoTExceptions import DiscoveryInvalidRequestException
+
+MAX_DISCOVERY_RETRIES = 10    # MAX tries at discovery before giving up
+GROUP_PATH = "./groupCA/"     # directory storing discovery info
+CA_NAME = "root-ca.crt"       # stores GGC CA cert
+GGC_ADDR_NAME = "ggc-host"    # stores GGC host address (kept for older tools)
+CACHE_NAME = "discovery.json" # stores endpoints, fingerprint and fetch time
+DISCOVERY_TTL = 24 * 3600     # seconds a discovery result is trusted
+PROBE_TIMEOUT = 2.0           # seconds allowed per TCP connect probe
+
+
+# Fingerprint of everything a client connects with, to tell whether a new
+# discovery result actually changed anything
+def fingerprint(ca, endpoints):
+    digest = hashlib.sha256(ca.encode("utf-8"))
+    for host, port in sorted(endpoints):
+        digest.update(("|" + host + ":" + str(port)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+# Opens a TCP connection to every endpoint at the same time and returns the
+# reachable ones as (latency, host, port), fastest first
+def probeEndpoints(endpoints, timeout=PROBE_TIMEOUT):
+    results = []
+    lock = threading.Lock()
+
+    def probe(host, port):
+        start = time.time()
+        try:
+            sock = socket.create_connection((host, port), timeout)
+            sock.close()
+        except (socket.error, socket.timeout):
+            return
+        with lock:
+            results.append((time.time() - start, host, port))
+
+    threads = [threading.Thread(target=probe, args=(host, port)) for host, port in endpoints]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join(timeout + 1)
+    with lock:
+        return sorted(results)
+
+
+def loadCache():
+    try:
+        with open(GROUP_PATH + CACHE_NAME, "r") as cacheFile:
+            cache = json.load(cacheFile)
+        if os.path.isfile(GROUP_PATH + CA_NAME):
+            return cache
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def saveCache(cache):
+    path = GROUP_PATH + CACHE_NAME
+    with open(path + ".tmp", "w") as cacheFile:
+        json.dump(cache, cacheFile)
+    os.rename(path + ".tmp", path)
+
+
+# Used to discover GGC group CA and end points. Returns the cache entry that
+# was persisted in GROUP_PATH.
+def discoverGGC(host, iotCAPath, certificatePath, privateKeyPath, clientId):
+    # Progressive back off core
+    backOffCore = ProgressiveBackOffCore()
+
+    # Discover GGCs
+    discoveryInfoProvider = DiscoveryInfoProvider()
+    discoveryInfoProvider.configureEndpoint(host)
+    discoveryInfoProvider.configureCredentials(iotCAPath, certificatePath, privateKeyPath)
+    discoveryInfoProvider.configureTimeout(10)  # 10 sec
+    print("Iot end point: " + host)
+    print("Iot CA Path: " + iotCAPath)
+    print("GGAD cert path: " + certificatePath)
+    print("GGAD private key path: " + privateKeyPath)
+    print("GGAD thing name : " + clientId)
+    retryCount = MAX_DISCOVERY_RETRIES
+    while retryCount != 0:
+        try:
+            discoveryInfo = discoveryInfoProvider.discover(clientId)
+            caList = discoveryInfo.getAllCas()
+            coreList = discoveryInfo.getAllCores()
+
+            # In this example we only have one core
+            # So we pick the first ca and core info
+            groupId, ca = caList[0]
+            coreInfo = coreList[0]
+            print("Discovered GGC: " + coreInfo.coreThingArn + " from Group: " + groupId)
+
+            # The connectivity information could be outdated or contain
+            # addresses this device can't reach, so all of it is kept and
+            # probed when connecting.
+            endpoints = [[addr.host, int(addr.port)] for addr in coreInfo.connectivityInfoList]
+            print("Discovered GGC endpoints: " + str(endpoints))
+
+            print("Now we persist the connectivity/identity information...")
+            if not os.path.exists(GROUP_PATH):
+                os.makedirs(GROUP_PATH)
+            newFingerprint = fingerprint(ca, endpoints)
+            cache = loadCache()
+            if cache is None or cache.get("fingerprint") != newFingerprint:
+                groupCAFile = open(GROUP_PATH + CA_NAME, "w")
+                groupCAFile.write(ca)
+                groupCAFile.close()
+            else:
+                print("Discovery result unchanged")
+            cache = {
+                "groupId": groupId,
+                "coreThingArn": coreInfo.coreThingArn,
+                "endpoints": endpoints,
+                "fingerprint": newFingerprint,
+                "discoveredAt": time.time(),
+            }
+            saveCache(cache)
+            print("Now proceed to the connecting flow...")
+            return cache
+        except DiscoveryInvalidRequestException as e:
+            print("Invalid discovery request detected!")
+            print("Type: " + str(type(e)))
+            print("Error message: " + str(e))
+            print("Stopping...")
+            break
+        except BaseException as e:
+            print("Error in discovery!")
+            print("Type: " + str(type(e)))
+            print("Error message: " + str(e))
+            retryCount -= 1
+            print("\n"+str(retryCount) + "/" + str(MAX_DISCOVERY_RETRIES) + " retries left\n")
+            print("Backing off...\n")
+            backOffCore.backOff()
+
+    print("Discovery failed after " + str(MAX_DISCOVERY_RETRIES) + " retries. Exiting...\n")
+    sys.exit(-1)
+
+
+# Returns (group CA path, host, port) of the fastest reachable core endpoint.
+# Discovery only runs if there is no cached result (or it lists no
+# endpoints), the cached one is older than ttl, none of its endpoints answer,
+# or refresh is set.
+def getCoreEndpoint(host, iotCAPath, certificatePath, privateKeyPath, clientId,
+                    ttl=DISCOVERY_TTL, refresh=False):
+    cache = loadCache()
+    if cache is None or refresh or not cache.get("endpoints") or \
+            time.time() - cache.get("discoveredAt", 0) > ttl:
+        cache = discoverGGC(host, iotCAPath, certificatePath, privateKeyPath, clientId)
+        rediscovered = True
+    else:
+        print("Greengrass core has already been discovered.")
+        rediscovered = False
+
+    reachable = probeEndpoints(cache["endpoints"])
+    if not reachable and not rediscovered:
+        print("No cached GGC endpoint is reachable, discovering again...")
+        cache = discoverGGC(host, iotCAPath, certificatePath, privateKeyPath, clientId)
+        reachable = probeEndpoints(cache["endpoints"])
+
+    if reachable:
+        latency, ggcHost, ggcPort = reachable[0]
+        print("Fastest GGC endpoint: " + ggcHost + ":" + str(ggcPort) + " (" + str(round(latency * 1000, 1)) + " ms)")
+    elif not cache["endpoints"]:
+        print("Discovery returned no GGC endpoints. Exiting...\n")
+        sys.exit(-1)
+    else:
+        # nothing answered; fall back to the first advertised endpoint and
+        # let the MQTT client's own retries take over
+        ggcHost, ggcPort = cache["endpoints"][0]
+        print("No GGC endpoint answered a probe, trying " + ggcHost + ":" + str(ggcPort))
+
+    groupHostFile = open(GROUP_PATH + GGC_ADDR_NAME, "w")
+    groupHostFile.write(ggcHost)
+    groupHostFile.close()
+    return GROUP_PATH + CA_NAME, ggcHost, ggcPort
+
+
+# Configures and connects an AWSIoTMQTTShadowClient (or AWSIoTMQTTClient) to
+# the core. If the first connect fails, discovery runs once more and the
+# client connects to whatever endpoint it reports.
+def connectShadowClient(shadowClient, host, iotCAPath, certificatePath, privateKeyPath, clientId,
+                        ttl=DISCOVERY_TTL):
+    refresh = False
+    while True:
+        rootCAPath, ggcHost, ggcPort = getCoreEndpoint(host, iotCAPath, certificatePath, privateKeyPath,
+                                                       clientId, ttl, refresh)
+        print("GGC Host Address: " + ggcHost + ":" + str(ggcPort))
+        print("GGC Group CA Path: " + rootCAPath)
+        shadowClient.configureEndpoint(ggcHost, ggcPort)
+        shadowClient.configureCredentials(rootCAPath, privateKeyPath, certificatePath)
+        try:
+            shadowClient.connect()
+            return ggcHost, ggcPort
+        except Exception as e:
+            if refresh:
+                raise
+            print("Connecting to " + ggcHost + " failed (" + str(e) + "), discovering again...")
+            refresh = True
@@ -0,0 +1,92 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+
+# intersectionStore.py
+# Per-intersection aggregation state for carAggregator.py.
+#
+# One Greengrass core can serve thousands of traffic light shadows, so the
+# aggregator keeps one IntersectionState per thing name instead of a single
+# set of module globals. IntersectionState uses __slots__, so each light
+# costs a fixed, small amount of memory, and the store is a plain dict,
+# so finding the state for an incoming event is O(1).
+
+import re
+
+DEFAULT_THING_NAME = "Bot"   # used when an event cannot be tied to a thing
+
+# $aws/things/<thingName>/shadow/update/documents (or accepted, delta, ...)
+SHADOW_TOPIC = re.compile(r'^\$aws/things/([^/]+)/shadow/')
+
+
+class IntersectionState(object):
+    __slots__ = ('thingName', 'index', 'totalTraffic', 'totalGreenlights', 'minCars', 'maxCars',
+                 'tumblingWindow', 'slidingWindow')
+
+    # index is a dense 0-based number, usable as a row in per-intersection arrays
+    def __init__(self, thingName, index=0):
+        self.thingName = thingName
+        self.index = index
+        self.totalTraffic = 0
+        self.totalGreenlights = 0
+        self.minCars = -1
+        self.maxCars = -1
+        self.tumblingWindow = None
+        self.slidingWindow = None
+
+    def recordGreenlight(self, cars):
+        self.totalTraffic += cars
+        self.totalGreenlights += 1
+        if cars < self.minCars or self.minCars == -1:
+            self.minCars = cars
+        if cars > self.maxCars:
+            self.maxCars = cars
+
+
+class IntersectionStore(object):
+
+    # initializer(state) is called once for every newly seen intersection,
+    # e.g. to attach its windows
+    def __init__(self, initializer=None):
+        self._states = {}
+        self._initializer = initializer
+
+    def get(self, thingName):
+        state = self._states.get(thingName)
+        if state is None:
+            state = IntersectionState(thingName, len(self._states))
+            if self._initializer is not None:
+                self._initializer(state)
+            self._states[thingName] = state
+        return state
+
+    def __len__(self):
+        return len(self._states)
+
+    def __iter__(self):
+        return iter(self._states.values())
+
+
+# function extracts the thing name from a shadow topic
+def thingNameFromTopic(topic):
+    if not topic:
+        return None
+    match = SHADOW_TOPIC.match(topic)
+    if match:
+        return match.group(1)
+    return None
+
+
+# Greengrass passes the topic a message arrived on in
+# context.client_context.custom['subject']. Events built by hand (or by a
+# benchmark) can carry a "thingName" key instead.
+def thingNameFromEvent(event, context):
+    try:
+        thingName = thingNameFromTopic(context.client_context.custom['subject'])
+        if thingName:
+            return thingName
+    except (AttributeError, KeyError, TypeError):
+        pass
+    if isinstance(event, dict) and event.get("thingName"):
+        return event["thingName"]
+    return DEFAULT_THING_NAME
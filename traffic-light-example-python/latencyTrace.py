@@ -0,0 +1,146 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+
+# latencyTrace.py
+# End-to-end latency tracing for lightController.py, trafficLight.py and
+# carAggregator.py.
+#
+# Every desired state the controller publishes carries a trace next to its
+# property:
+#
+#   {"state": {"desired": {"property": "G", "trace": {"id": "3f9c...", "issued": 1500000000.123}}}}
+#
+# The light adds the time it received the delta and the time it reported
+# the new state, and reports the trace back with the property. The shadow
+# only computes deltas from desired keys, so the extra timestamps in the
+# reported trace never cause a delta. carAggregator finally sees the whole
+# trace in the reported document. Each process records the hops it can see:
+#
+#   desired_accepted      issued -> the controller's update was accepted
+#   desired_to_delta      issued -> the light received the delta
+#   delta_to_report       delta received -> new state reported (incl. queueing)
+#   report_to_aggregator  reported -> carAggregator processed the document
+#   end_to_end            issued -> carAggregator processed the document
+#
+# Hops between processes compare clocks of different hosts, so they are only
+# as accurate as the hosts' clock sync (NTP on the core and the devices).
+#
+# Latencies go into fixed-bucket histograms that render in the Prometheus
+# text exposition format, either served over HTTP (serveMetrics) or written
+# to a file for a node_exporter textfile collector (writeTextfile).
+
+import binascii
+import os
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer   # Python 2
+
+METRIC_NAME = "traffic_light_hop_latency_seconds"
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+DESIRED_ACCEPTED = "desired_accepted"
+DESIRED_TO_DELTA = "desired_to_delta"
+DELTA_TO_REPORT = "delta_to_report"
+REPORT_TO_AGGREGATOR = "report_to_aggregator"
+END_TO_END = "end_to_end"
+
+
+# A new trace for a desired state issued now
+def newTrace():
+    return {"id": binascii.hexlify(os.urandom(8)).decode("ascii"), "issued": round(time.time(), 3)}
+
+
+# Seconds between two trace timestamps, or None if either is missing
+def elapsed(trace, start, end):
+    try:
+        return float(trace[end]) - float(trace[start])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class LatencyHistogram(object):
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)     # last one is +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        index = 0
+        while index < len(BUCKETS) and seconds > BUCKETS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.total += seconds
+        self.count += 1
+
+
+class LatencyMetrics(object):
+
+    def __init__(self, process):
+        self.process = process
+        self._lock = threading.Lock()
+        self._histograms = {}   # hop -> LatencyHistogram
+
+    # Negative latencies (clock skew) are recorded as 0
+    def observe(self, hop, seconds):
+        if seconds is None:
+            return
+        with self._lock:
+            histogram = self._histograms.get(hop)
+            if histogram is None:
+                histogram = self._histograms[hop] = LatencyHistogram()
+            histogram.observe(max(0.0, seconds))
+
+    # Prometheus text exposition format
+    def render(self):
+        lines = ["# HELP " + METRIC_NAME + " Latency of each hop from desired state to aggregation",
+                 "# TYPE " + METRIC_NAME + " histogram"]
+        with self._lock:
+            for hop in sorted(self._histograms):
+                histogram = self._histograms[hop]
+                labels = 'process="' + self.process + '",hop="' + hop + '"'
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    cumulative += count
+                    lines.append(METRIC_NAME + "_bucket{" + labels + ',le="' + repr(bound) + '"} ' + str(cumulative))
+                lines.append(METRIC_NAME + "_bucket{" + labels + ',le="+Inf"} ' + str(histogram.count))
+                lines.append(METRIC_NAME + "_sum{" + labels + "} " + repr(histogram.total))
+                lines.append(METRIC_NAME + "_count{" + labels + "} " + str(histogram.count))
+        return "\n".join(lines) + "\n"
+
+    # For a node_exporter textfile collector; written via rename so a scrape
+    # never sees half a file
+    def writeTextfile(self, path):
+        with open(path + ".tmp", "w") as metricsFile:
+            metricsFile.write(self.render())
+        os.rename(path + ".tmp", path)
+
+
+# Serves metrics.render() on http://<host>:<port>/metrics from a daemon thread
+def serveMetrics(metrics, port, host=""):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="MetricsServer")
+    thread.daemon = True
+    thread.start()
+    return server
@@ -5,25 +5,19 @@
 # Please refer to the AWS Greengrass Getting Started Guide, Module 5 for more information.
 #
 # This file is meant to be used in conjunction with trafficLight.py
+# It needs the shared helper modules (ggDiscovery.py, ...) from this directory.
 
 from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTShadowClient
-import sys
 import logging
 import time
-import json
 import argparse
-import os
-import re
-from itertools import cycle
 
-from AWSIoTPythonSDK.core.greengrass.discovery.providers import DiscoveryInfoProvider
-from AWSIoTPythonSDK.core.protocol.connection.cores import ProgressiveBackOffCore
-from AWSIoTPythonSDK.exception.AWSIoTExceptions import DiscoveryInvalidRequestException
-
-MAX_DISCOVERY_RETRIES = 10    # MAX tries at discovery before giving up
-GROUP_PATH = "./groupCA/"     # directory storing discovery info
-CA_NAME = "root-ca.crt"       # stores GGC CA cert
-GGC_ADDR_NAME = "ggc-host"    # stores GGC host address
+from connectionManager import ShadowConnectionManager
+from desiredPublisher import DesiredStatePublisher
+from ggDiscovery import connectShadowClient, DISCOVERY_TTL
+from latencyTrace import LatencyMetrics, serveMetrics
+from phaseScheduler import PhasePlan, PhaseScheduler, loadPlans, EPOCH
+from shadowCodec import ShadowSchemaError, parseUpdate
 
 # Shadow JSON schema:
 #
@@ -43,107 +37,16 @@ def customShadowCallback_Update(payload, responseStatus, token):
     if responseStatus == "timeout":
         print("Update request " + token + " time out!")
     if responseStatus == "accepted":
-        payloadDict = json.loads(payload)
         print("~~~~~~~~~~Shadow Update Accepted~~~~~~~~~~~~~")
         print("Update request with token: " + token + " accepted!")
-        print("property: " + str(payloadDict["state"]["desired"]["property"]))
+        try:
+            print("property: " + parseUpdate(payload, "desired"))
+        except ShadowSchemaError as e:
+            print("Unexpected update response: " + str(e))
         print("~~~~~~~~~~~~~~~~~~~~~~~\n\n")
     if responseStatus == "rejected":
         print("Update request " + token + " rejected!")
 
-# function does basic regex check to see if value might be an ip address
-def isIpAddress(value):
-    match = re.match(r'^\d{1,3}\.\d{1,3}\.\d{1,3}', value)
-    if match:
-        return True
-    return False
-    
-# function reads host GGC ip address from filePath
-def getGGCAddr(filePath):
-    f = open(filePath, "r")
-    return f.readline()
-
-# Used to discover GGC group CA and end point. After discovering it persists in GROUP_PATH
-def discoverGGC(host, iotCAPath, certificatePath, privateKeyPath, clientId):
-    # Progressive back off core
-    backOffCore = ProgressiveBackOffCore()
-
-    # Discover GGCs
-    discoveryInfoProvider = DiscoveryInfoProvider()
-    discoveryInfoProvider.configureEndpoint(host)
-    discoveryInfoProvider.configureCredentials(iotCAPath, certificatePath, privateKeyPath)
-    discoveryInfoProvider.configureTimeout(10)  # 10 sec
-    print("Iot end point: " + host)
-    print("Iot CA Path: " + iotCAPath)
-    print("GGAD cert path: " + certificatePath)
-    print("GGAD private key path: " + privateKeyPath)
-    print("GGAD thing name : " + clientId)
-    retryCount = MAX_DISCOVERY_RETRIES
-    discovered = False
-    groupCA = None
-    coreInfo = None
-    while retryCount != 0:
-        try:
-            discoveryInfo = discoveryInfoProvider.discover(clientId)
-            caList = discoveryInfo.getAllCas()
-            coreList = discoveryInfo.getAllCores()
-
-            # In this example we have one core
-            # So we only pick the first ca and core info
-            groupId, ca = caList[0]
-            coreInfo = coreList[0]
-            print("Discovered GGC: " + coreInfo.coreThingArn + " from Group: " + groupId)
-            hostAddr = ""
-
-            # In this example Ip detector lambda is turned on which reports 
-            # the GGC hostAddr to the CIS (Connectivity Information Service) that stores the
-            # connectivity information for the AWS Greengrass core associated with your group.
-            # This is the information used by discovery and the list of host addresses
-            # could be outdated or wrong and you would normally want to 
-            # validate it in a better way.
-            # For simplicity, we will assume the first host address that looks like an ip
-            # is the right one to connect to GGC. 
-            # Note: this can also be set manually via the update-connectivity-info CLI 
-            for addr in coreInfo.connectivityInfoList:
-                hostAddr = addr.host
-                if isIpAddress(hostAddr):
-                    break
-            
-            print("Discovered GGC Host Address: " + hostAddr)
-            print("Now we persist the connectivity/identity information...")
-            groupCA = GROUP_PATH + CA_NAME
-            ggcHostPath = GROUP_PATH + GGC_ADDR_NAME
-            if not os.path.exists(GROUP_PATH):
-                os.makedirs(GROUP_PATH)
-            groupCAFile = open(groupCA, "w")
-            groupCAFile.write(ca)
-            groupCAFile.close()
-            groupHostFile = open(ggcHostPath, "w")
-            groupHostFile.write(hostAddr)
-            groupHostFile.close()
-
-            discovered = True
-            print("Now proceed to the connecting flow...")
-            break
-        except DiscoveryInvalidRequestException as e:
-            print("Invalid discovery request detected!")
-            print("Type: " + str(type(e)))
-            print("Error message: " + e.message)
-            print("Stopping...")
-            break
-        except BaseException as e:
-            print("Error in discovery!")
-            print("Type: " + str(type(e)))
-            print("Error message: " + e.message)
-            retryCount -= 1
-            print("\n"+str(retryCount) + "/" + str(MAX_DISCOVERY_RETRIES) + " retries left\n")
-            print("Backing off...\n")
-            backOffCore.backOff()
-
-    if not discovered:
-        print("Discovery failed after " + str(MAX_DISCOVERY_RETRIES) + " retries. Exiting...\n")
-        sys.exit(-1)
-
 # Read in command-line parameters
 parser = argparse.ArgumentParser()
 parser.add_argument("-e", "--endpoint", action="store", required=True, dest="host", help="Your AWS IoT custom endpoint")
@@ -153,6 +56,14 @@ parser.add_argument("-k", "--key", action="store", dest="privateKeyPath", help="
 parser.add_argument("-n", "--thingName", action="store", dest="thingName", default="Bot", help="Targeted thing name")
 parser.add_argument("-id", "--clientId", action="store", dest="clientId", default="lightController",
                     help="Targeted client id")
+parser.add_argument("--plans", action="store", dest="plansPath",
+                    help="JSON phase plans for many intersections (see phaseScheduler.py); default: cycle --thingName")
+parser.add_argument("--statsInterval", action="store", dest="statsInterval", type=int, default=60,
+                    help="Seconds between scheduler statistics, 0 to disable")
+parser.add_argument("--metricsPort", action="store", dest="metricsPort", type=int, default=0,
+                    help="Serve hop latency histograms on http://<host>:<port>/metrics, 0 to disable")
+parser.add_argument("--discoveryTTL", action="store", dest="discoveryTTL", type=int, default=DISCOVERY_TTL,
+                    help="Seconds a cached discovery result is reused")
 
 args = parser.parse_args()
 host = args.host
@@ -170,20 +81,6 @@ formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(messag
 streamHandler.setFormatter(formatter)
 logger.addHandler(streamHandler)
 
-# Run Discovery service to check which GGC to connect to, if it hasn't been run already
-# Discovery talks with the IoT cloud to get the GGC CA cert and ip address
-
-if not os.path.isfile('./groupCA/root-ca.crt'):
-    discoverGGC(host, iotCAPath, certificatePath, privateKeyPath, clientId)
-else:
-    print("Greengrass core has already been discovered.")
-
-# read GGC Host Address from file
-ggcAddrPath = GROUP_PATH + GGC_ADDR_NAME
-rootCAPath = GROUP_PATH + CA_NAME
-ggcAddr = getGGCAddr(ggcAddrPath)
-print("GGC Host Address: " + ggcAddr)
-print("GGC Group CA Path: " + rootCAPath)
 print("Private Key of lightController thing Path: " + privateKeyPath)
 print("Certificate of lightController thing Path: " + certificatePath)
 print("Client ID(thing name for lightController): " + clientId)
@@ -191,29 +88,66 @@ print("Target shadow thing ID(thing name for trafficLight): " + thingName)
 
 # Init AWSIoTMQTTShadowClient
 myAWSIoTMQTTShadowClient = AWSIoTMQTTShadowClient(clientId)
-myAWSIoTMQTTShadowClient.configureEndpoint(ggcAddr, 8883)
-myAWSIoTMQTTShadowClient.configureCredentials(rootCAPath, privateKeyPath, certificatePath)
 
 # AWSIoTMQTTShadowClient configuration
 myAWSIoTMQTTShadowClient.configureAutoReconnectBackoffTime(1, 32, 20)
 myAWSIoTMQTTShadowClient.configureConnectDisconnectTimeout(10)  # 10 sec
 myAWSIoTMQTTShadowClient.configureMQTTOperationTimeout(5)  # 5 sec
 
-# Connect to AWS IoT
-myAWSIoTMQTTShadowClient.connect()
+# Run Discovery service to check which GGC to connect to, unless a recent result is cached
+# Discovery talks with the IoT cloud to get the GGC CA cert and endpoints
+# All endpoints are probed and the fastest reachable one is used; if connecting
+# fails, discovery runs once more before giving up
+connectShadowClient(myAWSIoTMQTTShadowClient, host, iotCAPath, certificatePath, privateKeyPath,
+                    clientId, args.discoveryTTL)
 
-# Create a deviceShadow with persistent subscription
-deviceShadowHandler = myAWSIoTMQTTShadowClient.createShadowHandlerWithName(thingName, True)
+# Intersections to drive, each with its own phase plan
+if args.plansPath:
+    plans, epoch = loadPlans(args.plansPath)
+else:
+    plans, epoch = [(thingName, PhasePlan())], EPOCH
+
+# Create a deviceShadow with persistent subscription for every intersection
+# With more than one, they share the connection through a ShadowConnectionManager: one set of wildcard
+# subscriptions, with responses fanned out to the handlers locally
+if len(plans) > 1:
+    shadowSource = ShadowConnectionManager(myAWSIoTMQTTShadowClient.getMQTTConnection())
+    shadowSource.start()
+else:
+    shadowSource = myAWSIoTMQTTShadowClient
+deviceShadowHandlers = {}
+for planThingName, plan in plans:
+    deviceShadowHandlers[planThingName] = shadowSource.createShadowHandlerWithName(planThingName, True)
 
-# This loop simulates a traffic light cycling between G, Y, R by updating the desired property in the shadow
+# The scheduler simulates traffic lights cycling between G, Y, R by updating the desired property in the shadow
 # This uses the desired property because the light GGAD will get the request for changing and update the reported property
 # The idea is the desired property is a request to update the light while the reported property is the actual value of the light
-loopCount = 0
-states = ['G','Y','R']
-pool = cycle(states) 
-for item in pool: 
-    JSONPayload = '{"state":{"desired":{"property":' + '"' + item + '"}}}'
-    print(JSONPayload)
-    deviceShadowHandler.shadowUpdate(JSONPayload, customShadowCallback_Update, 5)
-    loopCount += 1
-    time.sleep(20)
\ No newline at end of file
+# Phase changes are scheduled on absolute deadlines, so the time shadowUpdate takes doesn't add up over the cycles
+# The publisher sends all changes of a tick as one burst, skips states the shadow already accepted and keeps
+# at most one update per thing in flight
+# Every desired state carries a trace, so the time to the light and on to carAggregator can be measured
+traceMetrics = LatencyMetrics("lightController")
+if args.metricsPort:
+    serveMetrics(traceMetrics, args.metricsPort)
+publisher = DesiredStatePublisher(deviceShadowHandlers, 5, customShadowCallback_Update, traceMetrics)
+
+def publishPhase(planThingName, item):
+    print(planThingName + ": " + item)
+    publisher.request(planThingName, item)
+
+scheduler = PhaseScheduler(publishPhase, epoch, publisher.flush)
+for planThingName, plan in plans:
+    scheduler.add(planThingName, plan)
+publisher.flush()
+scheduler.start()
+
+# Loop forever
+lastStats = time.time()
+while True:
+    time.sleep(1)
+    if args.statsInterval and time.time() - lastStats >= args.statsInterval:
+        lastStats = time.time()
+        print("Phase scheduler: " + str(scheduler.stats()))
+        print("Desired state publisher: " + str(publisher.stats()))
+        if shadowSource is not myAWSIoTMQTTShadowClient:
+            print("Shared connection: " + str(shadowSource.stats()))
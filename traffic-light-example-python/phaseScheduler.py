@@ -0,0 +1,219 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+
+# phaseScheduler.py
+# Drives the phases of many intersections from lightController.py.
+#
+# Every intersection has a phase plan: a list of (state, seconds) pairs and
+# an offset. All plans are anchored to the same epoch (EPOCH, the Unix epoch
+# by default), so the phase an intersection is in at time t is a pure
+# function of t:
+#
+#   position = (t - epoch - offset) mod cycleLength
+#
+# Two controllers with the same plans therefore agree on every phase change,
+# and a corridor can be coordinated ("green wave") just by choosing offsets.
+#
+# Pending phase changes are kept in a heap ordered by their deadline. The next
+# deadline is always computed from the previous deadline, never from the time
+# the change was actually made, so a slow shadowUpdate delays one change but
+# does not shift the ones after it. How late each change was made (jitter) is
+# recorded in a windowStats.QuantileSketch. If the scheduler falls behind by
+# a whole phase, it skips to the phase that should be active now instead of
+# replaying the missed ones.
+#
+# Plans are read from a JSON document, for example
+#   {"epoch": 0,
+#    "intersections": [
+#      {"thingName": "main-1", "offset": 0, "phases": [["G", 20], ["Y", 5], ["R", 25]]},
+#      {"thingName": "main-2", "offset": 8, "phases": [["G", 20], ["Y", 5], ["R", 25]]}]}
+
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+
+from shadowCodec import checkState
+from windowStats import QuantileSketch
+
+EPOCH = 0.0
+DEFAULT_PHASES = (('G', 20), ('Y', 20), ('R', 20))
+
+logger = logging.getLogger(__name__)
+
+
+class PhasePlan(object):
+    __slots__ = ('phases', 'offset', 'cycleLength', '_boundaries')
+
+    # phases is a sequence of (state, seconds)
+    def __init__(self, phases=DEFAULT_PHASES, offset=0.0):
+        if not phases:
+            raise ValueError("A phase plan needs at least one phase")
+        self.phases = tuple((checkState(state), float(seconds)) for state, seconds in phases)
+        if any(seconds <= 0 for state, seconds in self.phases):
+            raise ValueError("Phase durations must be positive")
+        self.offset = float(offset)
+        # start of every phase, relative to the start of the cycle
+        self._boundaries = []
+        position = 0.0
+        for state, seconds in self.phases:
+            self._boundaries.append(position)
+            position += seconds
+        self.cycleLength = position
+
+    # Returns (phase index, absolute start of that phase) of the phase that
+    # is active at time now
+    def phaseAt(self, now, epoch=EPOCH):
+        elapsed = now - epoch - self.offset
+        cycles = elapsed // self.cycleLength
+        position = elapsed - cycles * self.cycleLength
+        index = 0
+        for i, boundary in enumerate(self._boundaries):
+            if boundary <= position:
+                index = i
+        return index, epoch + self.offset + cycles * self.cycleLength + self._boundaries[index]
+
+
+class Intersection(object):
+    __slots__ = ('thingName', 'plan', 'phaseIndex', 'deadline', 'changes', 'skipped')
+
+    def __init__(self, thingName, plan):
+        self.thingName = thingName
+        self.plan = plan
+        self.phaseIndex = 0
+        self.deadline = 0.0     # absolute time the current phase ends
+        self.changes = 0
+        self.skipped = 0
+
+    @property
+    def state(self):
+        return self.plan.phases[self.phaseIndex][0]
+
+
+def loadPlans(path):
+    with open(path, "r") as plansFile:
+        document = json.load(plansFile)
+    plans = []
+    for entry in document.get("intersections", []):
+        plans.append((entry["thingName"], PhasePlan(entry.get("phases", DEFAULT_PHASES), entry.get("offset", 0))))
+    return plans, float(document.get("epoch", EPOCH))
+
+
+class PhaseScheduler(object):
+
+    # publish(thingName, state) is called on the scheduler thread for every
+    # phase change. flush(), if given, is called once after all changes due
+    # in the same tick have been published, so they can be sent as a burst.
+    def __init__(self, publish, epoch=EPOCH, flush=None):
+        self._publish = publish
+        self._flush = flush
+        self.epoch = epoch
+        self.intersections = {}
+        self._heap = []                     # (deadline, sequence, intersection)
+        self._sequence = itertools.count()  # breaks deadline ties in insertion order
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._jitter = QuantileSketch()     # milliseconds
+        self.maxJitter = 0.0
+
+    # Adds an intersection and publishes the phase it should be in right now
+    def add(self, thingName, plan):
+        intersection = Intersection(thingName, plan)
+        now = time.time()
+        index, start = plan.phaseAt(now, self.epoch)
+        intersection.phaseIndex = index
+        intersection.deadline = start + plan.phases[index][1]
+        with self._lock:
+            self.intersections[thingName] = intersection
+            heapq.heappush(self._heap, (intersection.deadline, next(self._sequence), intersection))
+        self._publishPhase(intersection)
+        self._wakeup.set()
+        return intersection
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self.run, name="PhaseScheduler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def run(self):
+        while not self._stopped.is_set():
+            wait = self.tick(time.time())
+            self._wakeup.clear()
+            if wait is None:
+                self._wakeup.wait(1.0)
+            elif wait > 0:
+                self._wakeup.wait(wait)
+
+    # Makes every phase change that is due at time now. Returns the seconds
+    # until the next one, or None if there are no intersections.
+    def tick(self, now):
+        changed = False
+        try:
+            while True:
+                with self._lock:
+                    if not self._heap:
+                        return None
+                    deadline, sequence, intersection = self._heap[0]
+                    if deadline > now:
+                        return deadline - now
+                    heapq.heappop(self._heap)
+                self._advance(intersection, now)
+                changed = True
+                with self._lock:
+                    heapq.heappush(self._heap, (intersection.deadline, next(self._sequence), intersection))
+                now = time.time()
+        finally:
+            if changed and self._flush is not None:
+                self._flush()
+
+    def _advance(self, intersection, now):
+        plan = intersection.plan
+        phaseStart = intersection.deadline
+        intersection.phaseIndex = (intersection.phaseIndex + 1) % len(plan.phases)
+        intersection.deadline = phaseStart + plan.phases[intersection.phaseIndex][1]
+        if intersection.deadline <= now:
+            # more than a whole phase behind: go straight to the current phase
+            index, phaseStart = plan.phaseAt(now, self.epoch)
+            intersection.phaseIndex = index
+            intersection.deadline = phaseStart + plan.phases[index][1]
+            intersection.skipped += 1
+        jitter = (now - phaseStart) * 1000.0
+        self._jitter.add(jitter)
+        if jitter > self.maxJitter:
+            self.maxJitter = jitter
+        intersection.changes += 1
+        self._publishPhase(intersection)
+
+    def _publishPhase(self, intersection):
+        try:
+            self._publish(intersection.thingName, intersection.state)
+        except Exception:
+            logger.exception("Publishing phase " + intersection.state + " for " + intersection.thingName + " failed")
+
+    # Jitter is how late a phase change was made, in milliseconds
+    def stats(self):
+        with self._lock:
+            changes = sum(intersection.changes for intersection in self.intersections.values())
+            skipped = sum(intersection.skipped for intersection in self.intersections.values())
+            return {
+                'intersections': len(self.intersections),
+                'changes': changes,
+                'skipped': skipped,
+                'jitterP50Ms': self._jitter.quantile(0.50),
+                'jitterP99Ms': self._jitter.quantile(0.99),
+                'jitterMaxMs': self.maxJitter,
+            }
@@ -0,0 +1,284 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+
+# recordSpool.py
+# Durable on-disk spool for carAggregator.py. Stats records are written here
+# first, and the BufferedTableWriter (dynamoWriter.py) drains them to DynamoDB
+# in order. If DynamoDB can't be reached, records stay on disk until it can,
+# including across lambda restarts.
+#
+# Layout: SPOOL_DIR holds numbered segment files of JSON lines plus a
+# checkpoint file recording how far the drain has got. Appends go to the
+# newest segment and are only flushed to the OS, never fsynced, so the hot
+# path doesn't pay for a disk sync. sync() fsyncs the active segment (and any
+# segment rolled over since the last sync) and is called by the writer thread
+# every SYNC_INTERVAL seconds. The fsync itself runs outside the lock, on a
+# duplicate of the file descriptor, so appends never wait for the disk.
+#
+# Compaction: once every record in a segment has been drained, the segment
+# file is deleted. If the spool grows past maxBytes during a long outage,
+# the oldest segments are dropped (and counted) so the disk never fills up.
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from decimal import Decimal
+
+SPOOL_DIR = os.environ.get('SPOOL_DIR', '/tmp/carStatsSpool')
+SEGMENT_BYTES = 1024 * 1024           # roll to a new segment after 1 MB
+MAX_SPOOL_BYTES = 64 * 1024 * 1024    # drop the oldest segments beyond 64 MB
+SYNC_INTERVAL = 1.0                   # seconds between fsyncs of the active segment
+CHECKPOINT_NAME = "checkpoint"
+
+logger = logging.getLogger(__name__)
+
+
+# DynamoDB numbers arrive as Decimal; keep them exact on disk
+def encodeValue(value):
+    if isinstance(value, Decimal):
+        return {"__decimal__": str(value)}
+    raise TypeError(repr(value) + " is not JSON serializable")
+
+
+def decodeObject(obj):
+    if "__decimal__" in obj and len(obj) == 1:
+        return Decimal(obj["__decimal__"])
+    return obj
+
+
+class RecordSpool(object):
+    durable = True
+
+    def __init__(self, directory=SPOOL_DIR, segmentBytes=SEGMENT_BYTES, maxBytes=MAX_SPOOL_BYTES):
+        self.directory = directory
+        self.segmentBytes = segmentBytes
+        self.maxBytes = maxBytes
+        self._lock = threading.Lock()
+        self.droppedRecords = 0
+        self._lastSync = time.time()
+        self._rolled = []       # full segments still to be fsynced and closed
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # read position: (segment number, byte offset)
+        self._bytes = 0
+        self._readSegment, self._readOffset = self._loadCheckpoint()
+        segments = self._segments()
+        for segment in segments:
+            if segment < self._readSegment:
+                self._removeSegment(segment)
+        segments = [s for s in segments if s >= self._readSegment]
+        if not segments:
+            segments = [self._readSegment]
+            self._readOffset = 0
+
+        self._pending = self._countPending(segments)
+        # Records found on disk at startup have no enqueue time and drain
+        # right away; later ones keep theirs so batches can wait for
+        # maxBatchAge (dynamoWriter.py). Both are in spool order.
+        self._backlog = self._pending
+        self._appendTimes = deque()
+        self._writeSegment = segments[-1]
+        if self._endsTorn(self._writeSegment):
+            # never append after a partial line left by a crash
+            self._writeSegment += 1
+        self._file = open(self._segmentPath(self._writeSegment), "ab")
+        self._bytes = sum(self._segmentSize(s) for s in segments)
+
+    # Hot path: one buffered write, no fsync
+    def append(self, item):
+        line = (json.dumps(item, default=encodeValue, separators=(',', ':')) + "\n").encode("utf-8")
+        with self._lock:
+            if self._file.tell() + len(line) > self.segmentBytes and self._file.tell() > 0:
+                self._roll()
+            self._file.write(line)
+            self._file.flush()
+            self._bytes += len(line)
+            self._pending += 1
+            self._appendTimes.append(time.time())
+            if self._bytes > self.maxBytes:
+                self._dropOldestSegment()
+
+    # Returns up to n records from the head of the spool, plus a token that
+    # commit() takes once they have been written
+    def peek(self, n):
+        with self._lock:
+            items = []
+            skipped = 0
+            segment, offset = self._readSegment, self._readOffset
+            while len(items) < n and segment <= self._writeSegment:
+                try:
+                    with open(self._segmentPath(segment), "rb") as segmentFile:
+                        segmentFile.seek(offset)
+                        while len(items) < n:
+                            line = segmentFile.readline()
+                            if not line.endswith(b"\n"):
+                                break   # end of segment, or a torn write
+                            offset += len(line)
+                            try:
+                                items.append(json.loads(line.decode("utf-8"), object_hook=decodeObject))
+                            except ValueError:
+                                skipped += 1
+                                logger.error("Skipping corrupt spool record in segment " + str(segment))
+                except (IOError, OSError):
+                    pass
+                if len(items) < n and segment < self._writeSegment:
+                    segment, offset = segment + 1, 0
+                else:
+                    break
+            # corrupt lines count as drained along with the records around
+            # them; if there is nothing else, they are drained right away
+            token = (segment, offset, len(items) + skipped)
+            if skipped and not items:
+                self._commitLocked(token)
+                token = (segment, offset, 0)
+            return items, token
+
+    # Advance the read position past records returned by peek() and delete
+    # any segment that has been fully drained
+    def commit(self, token):
+        with self._lock:
+            self._commitLocked(token)
+
+    def sync(self):
+        with self._lock:
+            self._file.flush()
+            fd = os.dup(self._file.fileno())
+            rolled, self._rolled = self._rolled, []
+            self._lastSync = time.time()
+        try:
+            for rolledFile in rolled:
+                os.fsync(rolledFile.fileno())
+                rolledFile.close()
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    # fsync if SYNC_INTERVAL has passed since the last one
+    def maybeSync(self):
+        if time.time() - self._lastSync >= SYNC_INTERVAL:
+            self.sync()
+
+    def close(self):
+        self.sync()
+        with self._lock:
+            self._file.close()
+
+    def __len__(self):
+        return self._pending
+
+    # Enqueue time of the oldest pending record (0 for a recovered backlog)
+    def oldestTime(self):
+        with self._lock:
+            if self._backlog:
+                return 0.0
+            return self._appendTimes[0] if self._appendTimes else None
+
+    def diskBytes(self):
+        return self._bytes
+
+    def _commitLocked(self, token):
+        segment, offset, count = token
+        if (segment, offset) < (self._readSegment, self._readOffset):
+            return  # those records were dropped while being written
+        for drained in range(self._readSegment, segment):
+            self._removeSegment(drained)
+        self._readSegment, self._readOffset = segment, offset
+        self._pending = max(0, self._pending - count)
+        self._forgetOldestLocked(count)
+        self._saveCheckpoint()
+
+    # Drops the enqueue times of the count oldest records, backlog first
+    def _forgetOldestLocked(self, count):
+        fromBacklog = min(count, self._backlog)
+        self._backlog -= fromBacklog
+        for _ in range(min(count - fromBacklog, len(self._appendTimes))):
+            self._appendTimes.popleft()
+
+    # The full segment is fsynced and closed by the next sync(), off the
+    # hot path
+    def _roll(self):
+        self._file.flush()
+        self._rolled.append(self._file)
+        self._writeSegment += 1
+        self._file = open(self._segmentPath(self._writeSegment), "ab")
+
+    def _dropOldestSegment(self):
+        if self._readSegment == self._writeSegment:
+            return
+        dropped = self._countPending([self._readSegment])
+        self._removeSegment(self._readSegment)
+        self._readSegment, self._readOffset = self._readSegment + 1, 0
+        self._pending -= dropped
+        self._forgetOldestLocked(dropped)
+        self.droppedRecords += dropped
+        self._saveCheckpoint()
+        logger.warning("Spool over " + str(self.maxBytes) + " bytes, dropped " + str(dropped) + " records")
+
+    def _countPending(self, segments):
+        count = 0
+        for segment in segments:
+            try:
+                with open(self._segmentPath(segment), "rb") as segmentFile:
+                    if segment == self._readSegment:
+                        segmentFile.seek(self._readOffset)
+                    for line in segmentFile:
+                        if line.endswith(b"\n"):
+                            count += 1
+            except (IOError, OSError):
+                pass
+        return count
+
+    def _endsTorn(self, segment):
+        try:
+            with open(self._segmentPath(segment), "rb") as segmentFile:
+                segmentFile.seek(0, os.SEEK_END)
+                if segmentFile.tell() == 0:
+                    return False
+                segmentFile.seek(-1, os.SEEK_END)
+                return segmentFile.read(1) != b"\n"
+        except (IOError, OSError):
+            return False
+
+    def _segments(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith("seg-") and name.endswith(".log"):
+                segments.append(int(name[4:-4]))
+        return sorted(segments)
+
+    def _segmentPath(self, segment):
+        return os.path.join(self.directory, "seg-%012d.log" % segment)
+
+    def _segmentSize(self, segment):
+        try:
+            return os.path.getsize(self._segmentPath(segment))
+        except OSError:
+            return 0
+
+    def _removeSegment(self, segment):
+        self._bytes = max(0, self._bytes - self._segmentSize(segment))
+        try:
+            os.remove(self._segmentPath(segment))
+        except OSError:
+            pass
+
+    def _loadCheckpoint(self):
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_NAME), "r") as checkpointFile:
+                checkpoint = json.load(checkpointFile)
+            return checkpoint["segment"], checkpoint["offset"]
+        except (IOError, OSError, ValueError, KeyError):
+            segments = self._segments()
+            return (segments[0] if segments else 0), 0
+
+    # Written to a temp file and renamed so it is never half-written
+    def _saveCheckpoint(self):
+        path = os.path.join(self.directory, CHECKPOINT_NAME)
+        with open(path + ".tmp", "w") as checkpointFile:
+            json.dump({"segment": self._readSegment, "offset": self._readOffset}, checkpointFile)
+        os.rename(path + ".tmp", path)
@@ -0,0 +1,101 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+
+# rollups.py
+# Rolls closed per-intersection windows up into corridor and district
+# aggregates for carAggregator.py.
+#
+# Window summaries (windowStats.WindowSummary) are mergeable, so a corridor
+# window is just the merge of its intersections' windows for the same time
+# range, and a district window the merge of its corridors'. When an
+# intersection window closes, RollupIndex merges it into one open bucket per
+# ancestor, which is O(depth) work. Raw data is never rescanned.
+#
+# A rollup bucket stays open for GRACE_SECONDS after its window ends so that
+# intersections reporting a little late are still counted, and is then
+# handed to onClose(level, name, kind, start, end, summary). Windows that
+# arrive after their bucket has closed are counted in lateWindows and
+# dropped, so a closed rollup is never rewritten. The index also
+# keeps the latest closed summary per node, so dashboards can read a
+# corridor or district view from latest() without scanning CarStats.
+#
+# The hierarchy is a JSON document, for example
+#   {"intersections": {"Bot": "main-street"}, "corridors": {"main-street": "downtown"}}
+# Intersections that are not listed roll up to DEFAULT_CORRIDOR.
+
+import heapq
+import json
+
+from windowStats import WindowSummary
+
+GRACE_SECONDS = 30
+DEFAULT_CORRIDOR = "unassigned"
+LEVELS = ("corridor", "district")
+
+
+def loadHierarchy(path):
+    if not path:
+        return {}
+    with open(path, "r") as hierarchyFile:
+        return json.load(hierarchyFile)
+
+
+class RollupIndex(object):
+
+    def __init__(self, hierarchy, onClose, graceSeconds=GRACE_SECONDS):
+        self._corridorOf = hierarchy.get("intersections", {})
+        self._districtOf = hierarchy.get("corridors", {})
+        self.onClose = onClose
+        self.graceSeconds = graceSeconds
+        self._open = {}         # (level, name, kind, start, end) -> WindowSummary
+        self._deadlines = []    # heap of (close time, key)
+        self._latest = {}       # (level, name, kind) -> (start, end, WindowSummary)
+        self._ancestors = {}    # thing name -> [(level, name), ...], cached
+        self._closedThrough = None
+        self.lateWindows = 0
+
+    # Ancestors of an intersection, nearest first
+    def ancestors(self, thingName):
+        chain = self._ancestors.get(thingName)
+        if chain is None:
+            corridor = self._corridorOf.get(thingName, DEFAULT_CORRIDOR)
+            chain = [("corridor", corridor)]
+            district = self._districtOf.get(corridor)
+            if district:
+                chain.append(("district", district))
+            self._ancestors[thingName] = chain
+        return chain
+
+    # Merge one closed intersection window into every ancestor: O(depth)
+    def addWindow(self, thingName, kind, start, end, summary):
+        if self._closedThrough is not None and end + self.graceSeconds <= self._closedThrough:
+            self.lateWindows += 1
+            return
+        for level, name in self.ancestors(thingName):
+            key = (level, name, kind, start, end)
+            bucket = self._open.get(key)
+            if bucket is None:
+                bucket = WindowSummary()
+                self._open[key] = bucket
+                heapq.heappush(self._deadlines, (end + self.graceSeconds, key))
+            bucket.merge(summary)
+
+    # Close every rollup bucket whose grace period has passed
+    def advance(self, now):
+        self._closedThrough = now
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, key = heapq.heappop(self._deadlines)
+            summary = self._open.pop(key)
+            level, name, kind, start, end = key
+            latest = self._latest.get((level, name, kind))
+            if latest is None or end >= latest[1]:
+                self._latest[(level, name, kind)] = (start, end, summary)
+            self.onClose(level, name, kind, start, end, summary)
+
+    # Latest closed (start, end, summary) for a corridor or district
+    def latest(self, level, name, kind):
+        return self._latest.get((level, name, kind))
+
+    def openBuckets(self):
+        return len(self._open)
@@ -0,0 +1,124 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+
+# shadowStateCache.py
+# Last-known light state for trafficLight.py, kept on local disk so that a
+# restarted light can report its state again right away instead of waiting
+# for the next delta from the controller.
+#
+# The cache is an append-only log of JSON lines, one per applied delta:
+#
+#   {"thingName": "Bot", "property": "G", "version": 42}
+#
+# plus a {"thingName": "Bot", "forget": true} line when a thing's shadow was
+# recreated and its versions started over.
+#
+# Appends are only flushed to the OS; losing the last few lines in a power
+# cut only costs a slightly older resume state. A torn or corrupt line is
+# skipped when the log is read back. When the log holds more than
+# COMPACT_FACTOR lines per thing, it is rewritten with one line per thing
+# into a temp file that is fsynced and renamed over the log, so the cache is
+# never half-written.
+
+import json
+import logging
+import os
+import threading
+
+STATE_CACHE_PATH = os.environ.get('STATE_CACHE_PATH', './stateCache.log')
+COMPACT_FACTOR = 64     # log lines per thing before the log is compacted
+MIN_COMPACT_LINES = 1024
+
+logger = logging.getLogger(__name__)
+
+
+class ShadowStateCache(object):
+
+    def __init__(self, path=STATE_CACHE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._states = {}       # thingName -> (property, version)
+        self._lines = 0
+        self.corruptLines = 0
+        self._file = None
+        self._load()
+        self._file = open(self.path, "a")
+
+    # Returns (property, version) of the last applied delta, or None
+    def get(self, thingName):
+        with self._lock:
+            return self._states.get(thingName)
+
+    def items(self):
+        with self._lock:
+            return list(self._states.items())
+
+    # Records an applied state; ignored if version is not newer than the
+    # cached one
+    def record(self, thingName, state, version):
+        with self._lock:
+            cached = self._states.get(thingName)
+            if cached is not None and cached[1] >= version:
+                return
+            self._states[thingName] = (state, version)
+            self._file.write(json.dumps({"thingName": thingName, "property": state, "version": version}) + "\n")
+            self._file.flush()
+            self._lines += 1
+            if self._lines > max(MIN_COMPACT_LINES, COMPACT_FACTOR * len(self._states)):
+                self._compact()
+
+    # Drops the cached state of a thing whose shadow was recreated, so the
+    # restarted (lower) versions are recorded again
+    def forget(self, thingName):
+        with self._lock:
+            if self._states.pop(thingName, None) is None:
+                return
+            self._file.write(json.dumps({"thingName": thingName, "forget": True}) + "\n")
+            self._file.flush()
+            self._lines += 1
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as logFile:
+                for line in logFile:
+                    try:
+                        entry = json.loads(line)
+                        if entry.get("forget"):
+                            self._states.pop(entry["thingName"], None)
+                            self._lines += 1
+                            continue
+                        thingName, state, version = entry["thingName"], entry["property"], entry["version"]
+                    except (ValueError, KeyError, TypeError, AttributeError):
+                        self.corruptLines += 1
+                        continue
+                    cached = self._states.get(thingName)
+                    if cached is None or cached[1] < version:
+                        self._states[thingName] = (state, version)
+                    self._lines += 1
+        except (IOError, OSError):
+            return
+        if self.corruptLines:
+            logger.warning("Skipped " + str(self.corruptLines) + " corrupt lines in " + self.path)
+            # rewrite so a torn last line doesn't end up glued to the next append
+            self._compact()
+
+    # Rewrites the log with one line per thing, via a temp file and rename
+    def _compact(self):
+        tmpPath = self.path + ".tmp"
+        with open(tmpPath, "w") as tmpFile:
+            for thingName, (state, version) in self._states.items():
+                tmpFile.write(json.dumps({"thingName": thingName, "property": state, "version": version}) + "\n")
+            tmpFile.flush()
+            os.fsync(tmpFile.fileno())
+        os.rename(tmpPath, self.path)
+        if self._file is not None:
+            self._file.close()
+            self._file = open(self.path, "a")
+        self._lines = len(self._states)
@@ -0,0 +1,130 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+
+# tableProvisioner.py
+# Makes sure the CarStats table exists without holding up carAggregator.py's
+# import. Creating the table and waiting on the table_exists waiter can take
+# tens of seconds after a redeploy, so it runs on a background thread while
+# the lambda already accepts shadow events. The BufferedTableWriter
+# (dynamoWriter.py) keeps records queued until isReady() is True.
+#
+# Once the table is known to exist, a small marker file is written to
+# CACHE_DIR. On the next cold start the marker is read and the table counts
+# as ready straight away, with no DynamoDB call. If a write later fails
+# because the table is gone, the writer calls invalidate(), which removes
+# the marker and runs provisioning again.
+
+import json
+import logging
+import os
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+CACHE_DIR = os.environ.get('TABLE_CACHE_DIR', '/tmp')
+RETRY_DELAY = 5     # seconds between provisioning attempts after an error
+
+logger = logging.getLogger(__name__)
+
+
+class TableProvisioner(object):
+
+    # createArgs are passed straight to dynamodb.create_table
+    def __init__(self, dynamodb, tableName, createArgs, cacheDir=CACHE_DIR):
+        self._dynamodb = dynamodb
+        self.tableName = tableName
+        self._createArgs = createArgs
+        self._cachePath = os.path.join(cacheDir, tableName + ".ready")
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.readySource = None     # "cache" or "dynamodb" once ready
+
+    # Starts provisioning in the background and returns immediately
+    def start(self):
+        if self._readCache():
+            self._markReady("cache")
+            return
+        self._startThread()
+
+    # Provisions on the calling thread; the old, blocking behaviour
+    def provision(self):
+        if self._readCache():
+            self._markReady("cache")
+            return
+        self._ensureTable()
+        self._markReady("dynamodb")
+
+    def isReady(self):
+        return self._ready.is_set()
+
+    def waitReady(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    # Forget the cached result and check the table again
+    def invalidate(self):
+        logger.warning("Table " + self.tableName + " not found, provisioning again")
+        self._ready.clear()
+        self.readySource = None
+        try:
+            os.remove(self._cachePath)
+        except OSError:
+            pass
+        self._startThread()
+
+    def _startThread(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="TableProvisioner")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self._ensureTable()
+                self._markReady("dynamodb")
+                return
+            except Exception as e:
+                logger.error("Provisioning " + self.tableName + " failed: " + str(e))
+                time.sleep(RETRY_DELAY)
+
+    # Create the table if needed and wait until it exists
+    def _ensureTable(self):
+        start = time.time()
+        try:
+            table = self._dynamodb.create_table(TableName=self.tableName, **self._createArgs)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ResourceInUseException':
+                raise
+            table = self._dynamodb.Table(self.tableName)
+            logger.info("Table already created")
+        table.meta.client.get_waiter('table_exists').wait(TableName=self.tableName)
+        logger.info("Table " + self.tableName + " ready after " + str(round(time.time() - start, 3)) + "s")
+
+    def _markReady(self, source):
+        self.readySource = source
+        self._ready.set()
+        if source != "cache":
+            self._writeCache()
+
+    def _readCache(self):
+        try:
+            with open(self._cachePath, "r") as cacheFile:
+                return json.load(cacheFile).get("tableName") == self.tableName
+        except (IOError, OSError, ValueError):
+            return False
+
+    # Write the marker to a temp file and rename it so a crash never leaves
+    # a half-written marker behind
+    def _writeCache(self):
+        tmpPath = self._cachePath + ".tmp"
+        try:
+            with open(tmpPath, "w") as cacheFile:
+                json.dump({"tableName": self.tableName, "readyAt": time.time()}, cacheFile)
+            os.rename(tmpPath, self._cachePath)
+        except (IOError, OSError) as e:
+            logger.warning("Could not cache table state: " + str(e))
@@ -0,0 +1,49 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+
+# test_windowStats.py
+# Run with: python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from windowStats import SlidingWindow
+
+
+def closedWindows(advances, size=900, step=60):
+    closed = []
+    window = SlidingWindow(size, step,
+                           lambda kind, start, end, summary: closed.append((start, end, summary.count, summary.total)))
+    for timestamp, value in ((1000, 3), (1030, 5), (1100, 7)):
+        window.add(value, timestamp)
+    for now in advances:
+        window.advance(now)
+    return closed
+
+
+class SlidingWindowTest(unittest.TestCase):
+
+    def testLongGapEmitsEveryWindowWithData(self):
+        stepwise = closedWindows(range(1100, 5001, 60))
+        self.assertEqual(closedWindows([5000]), stepwise)
+        self.assertEqual(len(stepwise), 17)
+
+    def testGapShorterThanWindow(self):
+        self.assertEqual(closedWindows([1500]), closedWindows(list(range(1100, 1500, 7)) + [1500]))
+
+    def testAddAfterLongGapStartsEmpty(self):
+        closed = []
+        window = SlidingWindow(900, 60, lambda kind, start, end, summary: closed.append(summary.count))
+        window.add(3, 1000)
+        window.add(4, 9000)
+        self.assertEqual(window.summary().count, 1)
+        self.assertEqual(closed, [1] * 15)
+
+
+if __name__ == '__main__':
+    unittest.main()
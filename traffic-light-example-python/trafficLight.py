@@ -5,25 +5,22 @@
 # Please refer to the AWS Greengrass Getting Started Guide, Module 5 for more information.
 #
 # This file is meant to be used in conjunction with lightController.py
+# It needs the shared helper modules (ggDiscovery.py, ...) from this directory.
 
 
 from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTShadowClient
-import sys
 import logging
 import time
 import json
 import argparse
-import os
-import re
+import threading
 
-from AWSIoTPythonSDK.core.greengrass.discovery.providers import DiscoveryInfoProvider
-from AWSIoTPythonSDK.core.protocol.connection.cores import ProgressiveBackOffCore
-from AWSIoTPythonSDK.exception.AWSIoTExceptions import DiscoveryInvalidRequestException
-
-MAX_DISCOVERY_RETRIES = 10    # MAX tries at discovery before giving up
-GROUP_PATH = "./groupCA/"     # directory storing discovery info
-CA_NAME = "root-ca.crt"       # stores GGC CA cert
-GGC_ADDR_NAME = "ggc-host"    # stores GGC host address
+from connectionManager import ShadowConnectionManager
+from deltaDispatcher import DeltaDispatcher
+from latencyTrace import LatencyMetrics, serveMetrics, elapsed, DESIRED_TO_DELTA, DELTA_TO_REPORT
+from shadowCodec import ShadowSchemaError, checkState, parseUpdate, reportedPayload
+from shadowStateCache import ShadowStateCache, STATE_CACHE_PATH
+from ggDiscovery import connectShadowClient, DISCOVERY_TTL
 
 # Shadow JSON schema:
 #
@@ -43,194 +40,193 @@ def customShadowCallback_Update(payload, responseStatus, token):
     if responseStatus == "timeout":
         print("Update request " + token + " time out!")
     if responseStatus == "accepted":
-        payloadDict = json.loads(payload)
         print("~~~~~~~~~~ Shadow Update Accepted ~~~~~~~~~~~~~")
         print("Update request with token: " + token + " accepted!")
-        print("property: " + str(payloadDict["state"]["reported"]["property"]))
+        try:
+            print("property: " + parseUpdate(payload, "reported"))
+        except ShadowSchemaError as e:
+            print("Unexpected update response: " + str(e))
         print("~~~~~~~~~~~~~~~~~~~~~~~\n\n")
     if responseStatus == "rejected":
         print("Update request " + token + " rejected!")
 
 
+# Per-hop latencies of the traces carried by desired states (see latencyTrace.py)
+traceMetrics = LatencyMetrics("trafficLight")
+
+# Applies a delta: changes the light and updates the reported state in the shadow.
+# Runs on the dispatcher's worker thread, only for the newest version of the delta.
+# A trace that came with the delta is reported back with the new state.
+def applyDelta(thingName, version, light, trace):
+	print("++++++++ Applying Shadow Delta ++++++++++")
+	print("property: " + light)
+	print("version: " + str(version))
+	print("+++++++++++++++++++++++\n\n")
+	
+	print("Light changed to: " + light)
+	if trace is not None:
+		trace["reported"] = round(time.time(), 3)
+		traceMetrics.observe(DESIRED_TO_DELTA, elapsed(trace, "issued", "delta"))
+		traceMetrics.observe(DELTA_TO_REPORT, elapsed(trace, "delta", "reported"))
+	JSONPayload = reportedPayload(light, trace)
+	print(JSONPayload)
+	deviceShadowHandlers[thingName].shadowUpdate(JSONPayload, customShadowCallback_Update, 5)
+	if stateCache is not None:
+		stateCache.record(thingName, light, version)
+
+# Last applied state of every light, kept on disk (set up in the connection flow below)
+stateCache = None
+
+# Deltas are applied by a worker thread, so the MQTT client thread is never held up
+# by shadowUpdate. Deltas superseded by a newer version before they are applied are dropped.
+deltaDispatcher = DeltaDispatcher(applyDelta)
+deltaDispatcher.start()
+
 # Custom Shadow callback for retrieving the delta from the shadow
 # A delta message is triggered by the switch GGAD updating the desired state
-# This function then updates the reported state in the shadow - after changing the light
+# This function hands it to deltaDispatcher, which then updates the reported state in the shadow - after changing the light
 def customShadowCallback_Delta(payload, responseStatus, token):
 	# payload is a JSON string ready to be parsed using json.loads(...)
 	# in both Py2.x and Py3.x
-	payloadDict = json.loads(payload)
-	print("++++++++ Received Shadow Delta ++++++++++")
-	print(payloadDict)
-	print("property: " + str(payloadDict["state"]["property"]))
-	print("version: " + str(payloadDict["version"]))
-	print("+++++++++++++++++++++++\n\n")
-	
-	light = payloadDict["state"]["property"]
-	
-	print("Light changed to: " + light)
-	JSONPayload = '{"state":{"reported":{"property":' + '"' + light + '"}}}'
-	print(JSONPayload)
-	deviceShadowHandler.shadowUpdate(JSONPayload, customShadowCallback_Update, 5)
-
-# function does basic regex check to see if value might be an ip address
-def isIpAddress(value):
-    match = re.match(r'^\d{1,3}\.\d{1,3}\.\d{1,3}', value)
-    if match:
-        return True
-    return False
-
-# function reads host GGC ip address from filePath
-def getGGCAddr(filePath):
-    f = open(filePath, "r")
-    return f.readline()
-
-# Used to discover GGC group CA and end point. After discovering it persists in GROUP_PATH
-def discoverGGC(host, iotCAPath, certificatePath, privateKeyPath, clientId):
-    # Progressive back off core
-    backOffCore = ProgressiveBackOffCore()
-
-    # Discover GGCs
-    discoveryInfoProvider = DiscoveryInfoProvider()
-    discoveryInfoProvider.configureEndpoint(host)
-    discoveryInfoProvider.configureCredentials(iotCAPath, certificatePath, privateKeyPath)
-    discoveryInfoProvider.configureTimeout(10)  # 10 sec
-    print("Iot end point: " + host)
-    print("Iot CA Path: " + iotCAPath)
-    print("GGAD cert path: " + certificatePath)
-    print("GGAD private key path: " + privateKeyPath)
-    print("GGAD thing name : " + clientId)
-    retryCount = MAX_DISCOVERY_RETRIES
-    discovered = False
-    groupCA = None
-    coreInfo = None
-    while retryCount != 0:
+	deltaDispatcher.onDelta(payload, responseStatus, token)
+
+# Custom Shadow callback for the shadow document requested by resumeFromCache
+# Any desired state the light missed while it was away arrives here as the "delta" section
+def shadowGetCallback(thingName):
+    def customShadowCallback_Get(payload, responseStatus, token):
+        if responseStatus != "accepted":
+            print("Get request " + token + " for " + thingName + " " + responseStatus + "!")
+            return
         try:
-            discoveryInfo = discoveryInfoProvider.discover(clientId)
-            caList = discoveryInfo.getAllCas()
-            coreList = discoveryInfo.getAllCores()
-
-            # In this example we only have one core
-            # So we pick the first ca and core info
-            groupId, ca = caList[0]
-            coreInfo = coreList[0]
-            print("Discovered GGC: " + coreInfo.coreThingArn + " from Group: " + groupId)
-            hostAddr = ""
-
-            # In this example Ip detector lambda is turned on which reports
-            # the GGC hostAddr to the CIS (Connectivity Information Service) that stores the
-            # connectivity information for the AWS Greengrass core associated with your group.
-            # This is the information used by discovery and the list of host addresses
-            # could be outdated or wrong and you would normally want to
-            # validate it in a better way.
-            # For simplicity, we will assume the first host address that looks like an ip
-            # is the right one to connect to GGC.
-            # Note: this can also be set manually via the update-connectivity-info CLI
-            for addr in coreInfo.connectivityInfoList:
-                hostAddr = addr.host
-                if isIpAddress(hostAddr):
-                    break
-
-            print("Discovered GGC Host Address: " + hostAddr)
-
-            print("Now we persist the connectivity/identity information...")
-            groupCA = GROUP_PATH + CA_NAME
-            ggcHostPath = GROUP_PATH + GGC_ADDR_NAME
-            if not os.path.exists(GROUP_PATH):
-                os.makedirs(GROUP_PATH)
-            groupCAFile = open(groupCA, "w")
-            groupCAFile.write(ca)
-            groupCAFile.close()
-            groupHostFile = open(ggcHostPath, "w")
-            groupHostFile.write(hostAddr)
-            groupHostFile.close()
-
-            discovered = True
-            print("Now proceed to the connecting flow...")
-            break
-        except DiscoveryInvalidRequestException as e:
-            print("Invalid discovery request detected!")
-            print("Type: " + str(type(e)))
-            print("Error message: " + e.message)
-            print("Stopping...")
-            break
-        except BaseException as e:
-            print("Error in discovery!")
-            print("Type: " + str(type(e)))
-            print("Error message: " + e.message)
-            retryCount -= 1
-            print("\n"+str(retryCount) + "/" + str(MAX_DISCOVERY_RETRIES) + " retries left\n")
-            print("Backing off...\n")
-            backOffCore.backOff()
-
-    if not discovered:
-        print("Discovery failed after " + str(MAX_DISCOVERY_RETRIES) + " retries. Exiting...\n")
-        sys.exit(-1)
-
-
-# Read in command-line parameters
-parser = argparse.ArgumentParser()
-parser.add_argument("-e", "--endpoint", action="store", required=True, dest="host", help="Your AWS IoT custom endpoint")
-parser.add_argument("-r", "--rootCA", action="store", required=True, dest="rootCAPath", help="Root CA file path")
-parser.add_argument("-c", "--cert", action="store", dest="certificatePath", help="Certificate file path")
-parser.add_argument("-k", "--key", action="store", dest="privateKeyPath", help="Private key file path")
-parser.add_argument("-n", "--thingName", action="store", dest="thingName", default="Bot", help="Targeted thing name")
-parser.add_argument("-id", "--clientId", action="store", dest="clientId", default="trafficLight",
-                    help="Targeted client id")
-
-args = parser.parse_args()
-host = args.host
-iotCAPath = args.rootCAPath
-certificatePath = args.certificatePath
-privateKeyPath = args.privateKeyPath
-thingName = args.thingName
-clientId = args.clientId
-
-# Configure logging
-logger = logging.getLogger("AWSIoTPythonSDK.core")
-logger.setLevel(logging.INFO) # set to logging.DEBUG for additional logging
-streamHandler = logging.StreamHandler()
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-streamHandler.setFormatter(formatter)
-logger.addHandler(streamHandler)
-
-# Run Discovery service to check which GGC to connect to, if it hasn't been run already
-# Discovery talks with the IoT cloud to get the GGC CA cert and ip address
-
-if not os.path.isfile('./groupCA/root-ca.crt'):
-    discoverGGC(host, iotCAPath, certificatePath, privateKeyPath, clientId)
-else:
-    print("Greengrass core has already been discovered.")
-
-# read GGC Host Address from file
-ggcAddrPath = GROUP_PATH + GGC_ADDR_NAME
-rootCAPath = GROUP_PATH + CA_NAME
-ggcAddr = getGGCAddr(ggcAddrPath)
-print("GGC Host Address: " + ggcAddr)
-print("GGC Group CA Path: " + rootCAPath)
-print("Private Key of trafficLight thing Path: " + privateKeyPath)
-print("Certificate of trafficLight thing Path: " + certificatePath)
-print("Client ID(thing name for trafficLight): " + clientId)
-print("Target shadow thing ID(thing name for trafficLight): " + thingName)
-
-# Init AWSIoTMQTTShadowClient
-myAWSIoTMQTTShadowClient = AWSIoTMQTTShadowClient(clientId)
-myAWSIoTMQTTShadowClient.configureEndpoint(ggcAddr, 8883)
-myAWSIoTMQTTShadowClient.configureCredentials(rootCAPath, privateKeyPath, certificatePath)
-
-# AWSIoTMQTTShadowClient configuration
-myAWSIoTMQTTShadowClient.configureAutoReconnectBackoffTime(1, 32, 20)
-myAWSIoTMQTTShadowClient.configureConnectDisconnectTimeout(10)  # 10 sec
-myAWSIoTMQTTShadowClient.configureMQTTOperationTimeout(5)  # 5 sec
-
-# Connect to AWS IoT
-myAWSIoTMQTTShadowClient.connect()
-
-# Create a deviceShadow with persistent subscription
-deviceShadowHandler = myAWSIoTMQTTShadowClient.createShadowHandlerWithName(thingName, True)
-
-# Listen on deltas - customShadowCallback_Delta will be called when a shadow delta message is received
-deviceShadowHandler.shadowRegisterDeltaCallback(customShadowCallback_Delta)
-
-# Loop forever
-while True:
-	time.sleep(1)
+            document = json.loads(payload)
+            version = document["version"]
+            delta = document["state"].get("delta", {})
+            cached = stateCache.get(thingName) if stateCache is not None else None
+            if cached is not None and version < cached[1]:
+                # the shadow was recreated and its versions started over
+                deltaDispatcher.forgetVersion(thingName)
+                stateCache.forget(thingName)
+            if "property" in delta:
+                trace = delta.get("trace")
+                if isinstance(trace, dict):
+                    trace["delta"] = round(time.time(), 3)
+                else:
+                    trace = None
+                deltaDispatcher.offer(thingName, version, checkState(delta["property"]), trace)
+        except (ValueError, KeyError, TypeError, ShadowSchemaError) as e:
+            print("Unexpected shadow document for " + thingName + ": " + str(e))
+    return customShadowCallback_Get
+
+# Reports every light's cached state right away, then reconciles with the shadow: a desired state
+# newer than the cached one is applied through deltaDispatcher as if it had arrived as a delta
+def resumeFromCache():
+    for lightName, handler in deviceShadowHandlers.items():
+        cached = stateCache.get(lightName)
+        if cached is not None:
+            light, version = cached
+            print("Resuming " + lightName + " from cache: " + light + " (version " + str(version) + ")")
+            deltaDispatcher.setVersion(lightName, version)
+            handler.shadowUpdate(reportedPayload(light), customShadowCallback_Update, 5)
+        handler.shadowGet(shadowGetCallback(lightName), 5)
+
+# The connection flow below only runs when this file is executed directly,
+# so the callbacks above can also be imported (e.g. by benchmarks/loadBenchmark.py)
+if __name__ == "__main__":
+    # Read in command-line parameters
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-e", "--endpoint", action="store", required=True, dest="host", help="Your AWS IoT custom endpoint")
+    parser.add_argument("-r", "--rootCA", action="store", required=True, dest="rootCAPath", help="Root CA file path")
+    parser.add_argument("-c", "--cert", action="store", dest="certificatePath", help="Certificate file path")
+    parser.add_argument("-k", "--key", action="store", dest="privateKeyPath", help="Private key file path")
+    parser.add_argument("-n", "--thingName", action="store", dest="thingName", default="Bot",
+                        help="Targeted thing name, or a comma-separated list of lights served over one connection")
+    parser.add_argument("-id", "--clientId", action="store", dest="clientId", default="trafficLight",
+                        help="Targeted client id")
+    parser.add_argument("--statsInterval", action="store", dest="statsInterval", type=int, default=60,
+                        help="Seconds between delta dispatch statistics, 0 to disable")
+    parser.add_argument("--discoveryTTL", action="store", dest="discoveryTTL", type=int, default=DISCOVERY_TTL,
+                        help="Seconds a cached discovery result is reused")
+    parser.add_argument("--metricsPort", action="store", dest="metricsPort", type=int, default=0,
+                        help="Serve hop latency histograms on http://<host>:<port>/metrics, 0 to disable")
+    parser.add_argument("--stateCache", action="store", dest="stateCachePath", default=STATE_CACHE_PATH,
+                        help="File keeping the last applied state of every light")
+
+    args = parser.parse_args()
+    host = args.host
+    iotCAPath = args.rootCAPath
+    certificatePath = args.certificatePath
+    privateKeyPath = args.privateKeyPath
+    thingName = args.thingName
+    clientId = args.clientId
+
+    # Configure logging
+    logger = logging.getLogger("AWSIoTPythonSDK.core")
+    logger.setLevel(logging.INFO) # set to logging.DEBUG for additional logging
+    streamHandler = logging.StreamHandler()
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    streamHandler.setFormatter(formatter)
+    logger.addHandler(streamHandler)
+
+    print("Private Key of trafficLight thing Path: " + privateKeyPath)
+    print("Certificate of trafficLight thing Path: " + certificatePath)
+    print("Client ID(thing name for trafficLight): " + clientId)
+    print("Target shadow thing ID(thing name for trafficLight): " + thingName)
+
+    # Init AWSIoTMQTTShadowClient
+    myAWSIoTMQTTShadowClient = AWSIoTMQTTShadowClient(clientId)
+
+    # AWSIoTMQTTShadowClient configuration
+    myAWSIoTMQTTShadowClient.configureAutoReconnectBackoffTime(1, 32, 20)
+    myAWSIoTMQTTShadowClient.configureConnectDisconnectTimeout(10)  # 10 sec
+    myAWSIoTMQTTShadowClient.configureMQTTOperationTimeout(5)  # 5 sec
+
+    # Report the last known state again after every reconnect (on a separate thread, MQTT callbacks
+    # must not block). The SDK only picks up onOnline in connect(), so it is set before connecting;
+    # on the first connect there are no handlers yet and the resume below covers it
+    stateCache = ShadowStateCache(args.stateCachePath)
+    deviceShadowHandlers = {}
+    def onOnline():
+        if not deviceShadowHandlers:
+            return
+        resumeThread = threading.Thread(target=resumeFromCache, name="resumeFromCache")
+        resumeThread.daemon = True
+        resumeThread.start()
+    myAWSIoTMQTTShadowClient.onOnline = onOnline
+
+    # Run Discovery service to check which GGC to connect to, unless a recent result is cached
+    # Discovery talks with the IoT cloud to get the GGC CA cert and endpoints
+    # All endpoints are probed and the fastest reachable one is used; if connecting
+    # fails, discovery runs once more before giving up
+    connectShadowClient(myAWSIoTMQTTShadowClient, host, iotCAPath, certificatePath, privateKeyPath,
+                        clientId, args.discoveryTTL)
+
+    # Create a deviceShadow with persistent subscription for every light. A gateway serving several lights
+    # shares the connection through a ShadowConnectionManager: one set of wildcard subscriptions, with
+    # deltas and responses fanned out to the lights locally
+    thingNames = thingName.split(",")
+    if len(thingNames) > 1:
+        shadowSource = ShadowConnectionManager(myAWSIoTMQTTShadowClient.getMQTTConnection())
+        shadowSource.start()
+    else:
+        shadowSource = myAWSIoTMQTTShadowClient
+    for lightName in thingNames:
+        deviceShadowHandlers[lightName] = shadowSource.createShadowHandlerWithName(lightName, True)
+
+        # Listen on deltas - customShadowCallback_Delta will be called when a shadow delta message is received
+        deviceShadowHandlers[lightName].shadowRegisterDeltaCallback(customShadowCallback_Delta)
+
+    if args.metricsPort:
+        serveMetrics(traceMetrics, args.metricsPort)
+
+    # Report the last known state immediately instead of waiting for the controller
+    resumeFromCache()
+
+    # Loop forever
+    lastStats = time.time()
+    while True:
+        time.sleep(1)
+        if args.statsInterval and time.time() - lastStats >= args.statsInterval:
+            lastStats = time.time()
+            print("Delta dispatch: " + str(deltaDispatcher.stats()))
+            if shadowSource is not myAWSIoTMQTTShadowClient:
+                print("Shared connection: " + str(shadowSource.stats()))
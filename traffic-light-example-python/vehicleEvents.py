@@ -0,0 +1,181 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+
+# vehicleEvents.py
+# High-rate ingestion of per-vehicle detection events for carAggregator.py.
+#
+# Detections from every intersection are appended to one set of preallocated
+# NumPy arrays used as a ring buffer (timestamp, intersection, lane, speed).
+# Nothing is aggregated per vehicle. Once MICRO_BATCH_SIZE events are waiting
+# (or a count is requested), the unprocessed slice of the ring is reduced in
+# one pass: np.bincount over intersection * phase gives per-phase car counts
+# and speed sums for every intersection at once.
+#
+# The phase a detection is counted in is the one its intersection was in at
+# the detection's timestamp, looked up in the last PHASE_HISTORY phase
+# changes when the event is reduced. A detection that arrives late still
+# lands in the right phase, as long as it arrives before that phase is
+# counted (takePhaseCount).
+#
+# Detection messages look like either of
+#   {"thingName": "Bot", "detections": [{"t": 1500000000.1, "lane": 1, "speed": 12.5}, ...]}
+#   {"thingName": "Bot", "detections": {"t": [...], "lane": [...], "speed": [...]}}
+# The second, columnar form converts to arrays without a Python loop.
+
+import time
+
+import numpy as np
+
+RING_CAPACITY = 1 << 16       # events kept in the ring
+MICRO_BATCH_SIZE = 512        # unprocessed events that trigger a reduction
+PHASES = ('R', 'G', 'Y')
+PHASE_INDEX = {'R': 0, 'G': 1, 'Y': 2}
+UNKNOWN_PHASE = -1            # no shadow report seen yet
+PHASE_HISTORY = 8             # phase changes kept per intersection
+
+
+class VehicleEventIngestor(object):
+
+    def __init__(self, capacity=RING_CAPACITY, microBatchSize=MICRO_BATCH_SIZE, intersections=64):
+        self.capacity = capacity
+        self.microBatchSize = microBatchSize
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.intersections = np.zeros(capacity, dtype=np.int32)
+        self.lanes = np.zeros(capacity, dtype=np.int16)
+        self.speeds = np.zeros(capacity, dtype=np.float32)
+        self.written = 0       # events ever appended
+        self.processed = 0     # events ever reduced
+        self.overwritten = 0   # events lost because the ring wrapped before a reduction
+
+        # per-intersection state, grown as intersections appear
+        self.currentPhase = np.full(intersections, UNKNOWN_PHASE, dtype=np.int8)
+        # the last PHASE_HISTORY phase changes, oldest first
+        self.phaseTimes = np.full((intersections, PHASE_HISTORY), -np.inf)
+        self.phaseValues = np.full((intersections, PHASE_HISTORY), UNKNOWN_PHASE, dtype=np.int8)
+        self.phaseCounts = np.zeros((intersections, len(PHASES)), dtype=np.int64)
+        self.phaseSpeedSums = np.zeros((intersections, len(PHASES)), dtype=np.float64)
+        self.hasDetections = np.zeros(intersections, dtype=bool)
+
+    # Append the detections of one message for intersection `index`
+    def ingest(self, index, detections):
+        timestamps, lanes, speeds = self._columns(detections)
+        count = len(timestamps)
+        if count == 0:
+            return 0
+        self._ensureIntersection(index)
+        self.hasDetections[index] = True
+        if self.written + count - self.processed > self.capacity:
+            self.reduce()
+        if count > self.capacity:
+            # keep only what fits; older detections would be overwritten anyway
+            self.overwritten += count - self.capacity
+            timestamps, lanes, speeds = timestamps[-self.capacity:], lanes[-self.capacity:], speeds[-self.capacity:]
+            count = self.capacity
+
+        start = self.written % self.capacity
+        first = min(count, self.capacity - start)
+        for column, values in ((self.timestamps, timestamps), (self.lanes, lanes), (self.speeds, speeds)):
+            column[start:start + first] = values[:first]
+            column[:count - first] = values[first:]
+        self.intersections[start:start + first] = index
+        self.intersections[:count - first] = index
+        self.written += count
+
+        if self.written - self.processed >= self.microBatchSize:
+            self.reduce()
+        return count
+
+    # Vectorized reduction of every event appended since the last one
+    def reduce(self):
+        pending = self.written - self.processed
+        if pending == 0:
+            return
+        if pending > self.capacity:
+            self.overwritten += pending - self.capacity
+            self.processed = self.written - self.capacity
+            pending = self.capacity
+        start = self.processed % self.capacity
+        end = start + pending
+        if end <= self.capacity:
+            slices = [slice(start, end)]
+        else:
+            slices = [slice(start, self.capacity), slice(0, end - self.capacity)]
+
+        phaseCount = len(PHASES)
+        bins = self.phaseCounts.size
+        for part in slices:
+            intersections = self.intersections[part]
+            keys = intersections.astype(np.int64) * phaseCount + self._phasesAt(intersections, self.timestamps[part])
+            self.phaseCounts += np.bincount(keys, minlength=bins).reshape(self.phaseCounts.shape)
+            self.phaseSpeedSums += np.bincount(keys, weights=self.speeds[part], minlength=bins).reshape(self.phaseSpeedSums.shape)
+        self.processed = self.written
+
+    # Record the light phase an intersection reported at `timestamp`.
+    # Returns the previous phase letter (None if unknown).
+    def setPhase(self, index, phase, timestamp=None):
+        self._ensureIntersection(index)
+        previous = self.currentPhase[index]
+        if phase in PHASE_INDEX and PHASE_INDEX[phase] != previous:
+            self.currentPhase[index] = PHASE_INDEX[phase]
+            self.phaseTimes[index, :-1] = self.phaseTimes[index, 1:]
+            self.phaseValues[index, :-1] = self.phaseValues[index, 1:]
+            self.phaseTimes[index, -1] = time.time() if timestamp is None else timestamp
+            self.phaseValues[index, -1] = PHASE_INDEX[phase]
+        if previous == UNKNOWN_PHASE:
+            return None
+        return PHASES[previous]
+
+    # Cars counted during `phase` since the last call, with their mean speed
+    def takePhaseCount(self, index, phase):
+        self.reduce()
+        column = PHASE_INDEX[phase]
+        cars = int(self.phaseCounts[index, column])
+        meanSpeed = float(self.phaseSpeedSums[index, column] / cars) if cars else 0.0
+        self.phaseCounts[index, column] = 0
+        self.phaseSpeedSums[index, column] = 0.0
+        return cars, meanSpeed
+
+    def detectionsEnabled(self, index):
+        return index < len(self.hasDetections) and bool(self.hasDetections[index])
+
+    def stats(self):
+        return {
+            'written': self.written,
+            'pending': self.written - self.processed,
+            'overwritten': self.overwritten,
+        }
+
+    # Phase index of every (intersection, timestamp) pair: the last change at
+    # or before the timestamp. Detections before the first shadow report
+    # count as red, ones older than the history as its oldest phase.
+    def _phasesAt(self, intersections, timestamps):
+        changes = (self.phaseTimes[intersections] <= timestamps[:, None]).sum(axis=1)
+        phases = self.phaseValues[intersections, np.maximum(changes - 1, 0)]
+        return np.maximum(phases, PHASE_INDEX['R'])
+
+    def _columns(self, detections):
+        if isinstance(detections, dict):
+            timestamps = np.asarray(detections.get("t", []), dtype=np.float64)
+            lanes = np.asarray(detections.get("lane", np.zeros(len(timestamps))), dtype=np.int16)
+            speeds = np.asarray(detections.get("speed", np.zeros(len(timestamps))), dtype=np.float32)
+        else:
+            now = time.time()
+            timestamps = np.fromiter((d.get("t", now) for d in detections), dtype=np.float64, count=len(detections))
+            lanes = np.fromiter((d.get("lane", 0) for d in detections), dtype=np.int16, count=len(detections))
+            speeds = np.fromiter((d.get("speed", 0.0) for d in detections), dtype=np.float32, count=len(detections))
+        return timestamps, lanes, speeds
+
+    def _ensureIntersection(self, index):
+        size = len(self.currentPhase)
+        if index < size:
+            return
+        self.reduce()
+        newSize = max(index + 1, size * 2)
+        self.currentPhase = np.concatenate([self.currentPhase, np.full(newSize - size, UNKNOWN_PHASE, dtype=np.int8)])
+        self.hasDetections = np.concatenate([self.hasDetections, np.zeros(newSize - size, dtype=bool)])
+        self.phaseTimes = np.concatenate([self.phaseTimes, np.full((newSize - size, PHASE_HISTORY), -np.inf)])
+        self.phaseValues = np.concatenate([self.phaseValues, np.full((newSize - size, PHASE_HISTORY), UNKNOWN_PHASE, dtype=np.int8)])
+        extra = np.zeros((newSize - size, len(PHASES)))
+        self.phaseCounts = np.concatenate([self.phaseCounts, extra.astype(np.int64)])
+        self.phaseSpeedSums = np.concatenate([self.phaseSpeedSums, extra])
@@ -0,0 +1,216 @@
+#
+# Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+
+# windowStats.py
+# Streaming window statistics for carAggregator.py.
+#
+# Every window keeps a WindowSummary: count, sum, min, max and a
+# QuantileSketch. The sketch uses logarithmically spaced buckets, so any
+# quantile it returns is within RELATIVE_ACCURACY of the true value. The
+# bucket count is capped, which keeps memory constant per window. Two
+# summaries can be merged without looking at the raw values, so a sliding
+# window is kept as a ring of small panes that get merged when it is read.
+#
+# TumblingWindow and SlidingWindow both call onClose(kind, start, end, summary)
+# whenever a window closes, which carAggregator uses to write it to CarStats.
+
+import math
+from decimal import Decimal
+
+RELATIVE_ACCURACY = 0.01    # quantiles are within 1% of the true value
+MAX_BUCKETS = 128           # per sketch; the lowest buckets collapse beyond this
+
+
+class QuantileSketch(object):
+    __slots__ = ('relativeAccuracy', 'maxBuckets', 'count', 'zeroCount', 'bins', '_logGamma', '_gamma')
+
+    def __init__(self, relativeAccuracy=RELATIVE_ACCURACY, maxBuckets=MAX_BUCKETS):
+        self.relativeAccuracy = relativeAccuracy
+        self.maxBuckets = maxBuckets
+        self._gamma = (1 + relativeAccuracy) / (1 - relativeAccuracy)
+        self._logGamma = math.log(self._gamma)
+        self.count = 0
+        self.zeroCount = 0      # values <= 0 have no log bucket
+        self.bins = {}          # bucket index -> count
+
+    def add(self, value, weight=1):
+        self.count += weight
+        if value <= 0:
+            self.zeroCount += weight
+            return
+        key = int(math.ceil(math.log(value) / self._logGamma))
+        self.bins[key] = self.bins.get(key, 0) + weight
+        if len(self.bins) > self.maxBuckets:
+            self._collapse()
+
+    def merge(self, other):
+        if other.relativeAccuracy != self.relativeAccuracy:
+            raise ValueError("Cannot merge sketches with different accuracy")
+        self.count += other.count
+        self.zeroCount += other.zeroCount
+        for key, weight in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + weight
+        if len(self.bins) > self.maxBuckets:
+            self._collapse()
+
+    # q is in [0, 1]. Returns None for an empty sketch.
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeroCount
+        if rank < seen:
+            return 0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if rank < seen:
+                return 2 * self._gamma ** key / (self._gamma + 1)
+        return 2 * self._gamma ** max(self.bins) / (self._gamma + 1)
+
+    def copy(self):
+        sketch = QuantileSketch(self.relativeAccuracy, self.maxBuckets)
+        sketch.count = self.count
+        sketch.zeroCount = self.zeroCount
+        sketch.bins = dict(self.bins)
+        return sketch
+
+    # Fold the lowest buckets together; only low quantiles lose accuracy
+    def _collapse(self):
+        keys = sorted(self.bins)
+        excess = len(keys) - self.maxBuckets
+        target = keys[excess]
+        for key in keys[:excess]:
+            self.bins[target] += self.bins.pop(key)
+
+
+class WindowSummary(object):
+    __slots__ = ('count', 'total', 'minimum', 'maximum', 'sketch')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.minimum = None
+        self.maximum = None
+        self.sketch = QuantileSketch()
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        self.sketch.add(value)
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        self.count += other.count
+        self.total += other.total
+        if self.minimum is None or other.minimum < self.minimum:
+            self.minimum = other.minimum
+        if self.maximum is None or other.maximum > self.maximum:
+            self.maximum = other.maximum
+        self.sketch.merge(other.sketch)
+
+    def copy(self):
+        summary = WindowSummary()
+        summary.merge(self)
+        return summary
+
+    def quantile(self, q):
+        return self.sketch.quantile(q)
+
+    # DynamoDB attributes for this summary. boto3 refuses floats, so
+    # quantiles are rounded and sent as Decimal.
+    def toItem(self):
+        item = {
+            'Count': self.count,
+            'Sum': self.total,
+            'Min': self.minimum,
+            'Max': self.maximum,
+        }
+        for name, q in (('P50', 0.5), ('P95', 0.95), ('P99', 0.99)):
+            value = self.quantile(q)
+            if value is not None:
+                item[name] = Decimal(str(round(value, 3)))
+        return item
+
+
+# Fixed, non-overlapping windows of `size` seconds aligned to the epoch
+class TumblingWindow(object):
+
+    def __init__(self, size, onClose):
+        self.size = size
+        self.onClose = onClose
+        self.start = None
+        self.summary = WindowSummary()
+
+    def add(self, value, timestamp):
+        self.advance(timestamp)
+        if self.start is None:
+            self.start = self._alignedStart(timestamp)
+        self.summary.add(value)
+
+    # Close the current window if `now` is past its end
+    def advance(self, now):
+        if self.start is not None and now >= self.start + self.size:
+            if self.summary.count:
+                self.onClose('tumbling', self.start, self.start + self.size, self.summary)
+            self.start = self._alignedStart(now)
+            self.summary = WindowSummary()
+
+    def _alignedStart(self, timestamp):
+        return math.floor(timestamp / self.size) * self.size
+
+
+# Windows of `size` seconds that close every `step` seconds. The window is a
+# ring of size/step panes, so memory stays constant regardless of traffic.
+class SlidingWindow(object):
+
+    def __init__(self, size, step, onClose):
+        if size % step:
+            raise ValueError("Sliding window size must be a multiple of its step")
+        self.size = size
+        self.step = step
+        self.onClose = onClose
+        self.paneCount = int(size // step)
+        self.panes = [WindowSummary() for _ in range(self.paneCount)]
+        self.paneStart = None
+
+    def add(self, value, timestamp):
+        self.advance(timestamp)
+        if self.paneStart is None:
+            self.paneStart = math.floor(timestamp / self.step) * self.step
+        self.panes[self._paneIndex(self.paneStart)].add(value)
+
+    # Close every pane that ended before `now`; each close emits the window
+    # made of that pane and the ones before it.
+    def advance(self, now):
+        if self.paneStart is None:
+            return
+        while now >= self.paneStart + self.step:
+            end = self.paneStart + self.step
+            window = self.summary()
+            if window.count:
+                self.onClose('sliding', end - self.size, end, window)
+            self.paneStart = end
+            self.panes[self._paneIndex(self.paneStart)] = WindowSummary()
+            # Once every pane is empty the windows up to `now` would all
+            # be empty too, so a long quiet period is skipped in one go.
+            # Until then every window that still overlaps data is emitted,
+            # which is at most size/step more closes.
+            if not any(pane.count for pane in self.panes):
+                self.paneStart = math.floor(now / self.step) * self.step
+                return
+
+    # Summary of the last `size` seconds, including the open pane
+    def summary(self):
+        merged = WindowSummary()
+        for pane in self.panes:
+            merged.merge(pane)
+        return merged
+
+    def _paneIndex(self, paneStart):
+        return int(paneStart // self.step) % self.paneCount